@@ -0,0 +1,144 @@
+# Микробенчмарки горячих функций бота без сети и Telegram.
+#   python bench.py                 # все бенчмарки
+#   python bench.py split           # только разбиение длинных сообщений
+#   python bench.py split --repeat 20
+#   python bench.py preprocess      # очистка и редактирование ПДн во входящем тексте
+import argparse
+import logging
+import os
+import random
+import re
+import sys
+import time
+from typing import Callable, List
+
+# Модуль бота импортируется без токена и без файлов на диске
+os.environ.setdefault("STATE_BACKEND", "memory")
+os.environ.setdefault("AI_CACHE_DISK_ENABLED", "0")
+os.environ.setdefault("WEBHOOK_CAPTURE_PATH", "")
+logging.disable(logging.ERROR)
+
+import main as bot
+
+def legacy_split_message(text: str, max_length: int = 4096) -> List[str]:
+    # Прежняя реализация — для сравнения: склейка строк и длина в кодовых точках
+    if len(text) <= max_length:
+        return [text]
+    sentences = text.split('. ')
+    parts = []
+    current_part = ""
+    for sentence in sentences:
+        test_part = current_part + sentence + ". "
+        if len(test_part) <= max_length:
+            current_part = test_part
+        else:
+            if current_part:
+                parts.append(current_part.strip())
+            current_part = sentence + ". "
+    if current_part:
+        parts.append(current_part.strip())
+    final_parts = []
+    for part in parts:
+        if len(part) > max_length:
+            for i in range(0, len(part), max_length):
+                final_parts.append(part[i:i+max_length])
+        else:
+            final_parts.append(part)
+    return final_parts
+
+def legacy_sanitize_user_input(text: str, max_length: int = 2000) -> str:
+    # Прежняя реализация — посимвольный фильтр генератором, без нормализации и редактирования
+    if not text:
+        return ""
+    cleaned = ''.join(char for char in text if char.isprintable() or char in '\n\r\t')
+    return cleaned[:max_length]
+
+WORDS = ["маржа", "выручка", "логистика", "🚀", "📈", "👨‍👩‍👧", "**важно**", "`ACOS`", "_курсив_",
+         "[отчёт](https://example.com/report_1)", "итог.", "почему?", "😀😀"]
+
+def llm_like_text(size: int, seed: int = 1) -> str:
+    # Похоже на ответ модели: абзацы, эмодзи, разметка и блоки кода
+    rnd = random.Random(seed)
+    out, total = [], 0
+    while total < size:
+        r = rnd.random()
+        if r < 0.03:
+            chunk = "\n\n"
+        elif r < 0.04:
+            chunk = "\n```python\n" + "\n".join(f"margin_{i} = price - cost  # 💰" for i in range(rnd.randint(5, 120))) + "\n```\n"
+        else:
+            chunk = rnd.choice(WORDS) + " "
+        out.append(chunk)
+        total += len(chunk)
+    return "".join(out)
+
+def timeit(func: Callable, *args, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def check_parts(text: str, parts: List[str], max_length: int) -> str:
+    if any(bot.utf16_len(p) > max_length for p in parts):
+        return "превышен лимит UTF-16"
+    if any(p.count("```") % 2 for p in parts):
+        return "разорван блок кода"
+    strip = lambda t: re.sub(r"\s+", "", re.sub(r"```\w*", "", t))
+    if strip("".join(parts)) != strip(text):
+        return "потерян текст"
+    return "ok"
+
+def bench_split(args):
+    print("Разбиение сообщений (лимит 4096 UTF-16), лучшее из", args.repeat)
+    print(f"{'размер':>8} {'частей':>7} {'новый, мс':>10} {'мкс/КБ':>8} {'старый, мс':>11} {'старый > лимита':>16} {'проверка':>10}")
+    for kb in (10, 20, 50, 100):
+        text = llm_like_text(kb * 1024)
+        parts = bot.split_message_efficiently(text)
+        new = timeit(bot.split_message_efficiently, text, repeat=args.repeat)
+        old = timeit(legacy_split_message, text, repeat=args.repeat)
+        old_over = sum(bot.utf16_len(p) > 4096 for p in legacy_split_message(text))
+        print(f"{kb:>6}КБ {len(parts):>7} {new * 1000:>10.2f} {new * 1e6 / kb:>8.1f} {old * 1000:>11.2f} "
+              f"{old_over:>16} {check_parts(text, parts, 4096):>10}")
+
+INPUT_SAMPLES = {
+    "обычный": "Хочу научиться вести переговоры с поставщиками, бюджет 150000 руб, сроки три месяца. ",
+    "латиница": "I want to negotiate with suppliers better, budget 150000 rub, deadline three months. ",
+    "с ПДн": "Пишите на ivan.petrov@mail.ru или звоните +7 (999) 123-45-67, карта 4111 1111 1111 1111. ",
+    "мусор": "Текст  с\tтабами,\u00a0неразрывными\u200b пробелами\r\n\r\n\r\nи 👨\u200d👩\u200d👧 эмодзи. ",
+}
+
+def bench_preprocess(args):
+    loops = 200 * args.repeat
+    print(f"Очистка входящего текста (2000 символов), среднее из {loops}")
+    print(f"{'текст':>10} {'новый, мкс':>11} {'старый, мкс':>12} {'замен ПДн':>10}")
+    for name, sample in INPUT_SAMPLES.items():
+        text = (sample * (2000 // len(sample) + 1))[:2000]
+        redacted = bot.sanitize_user_input(text)
+        replaced = sum(redacted.count(p) for p in set(bot.PII_PLACEHOLDERS.values()))
+        timings = []
+        for func in (bot.sanitize_user_input, legacy_sanitize_user_input):
+            started = time.perf_counter()
+            for _ in range(loops):
+                func(text)
+            timings.append((time.perf_counter() - started) / loops)
+        print(f"{name:>10} {timings[0] * 1e6:>11.1f} {timings[1] * 1e6:>12.1f} {replaced:>10}")
+
+BENCHMARKS = {"split": bench_split, "preprocess": bench_preprocess}
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки бота")
+    parser.add_argument("only", nargs="*", help=f"какие бенчмарки запускать: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--repeat", type=int, default=5, help="повторов на замер")
+    args = parser.parse_args()
+    unknown = set(args.only) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"неизвестные бенчмарки: {', '.join(sorted(unknown))}")
+    for name in args.only or BENCHMARKS:
+        BENCHMARKS[name](args)
+        print()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
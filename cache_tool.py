@@ -0,0 +1,92 @@
+# Инструменты для L2-кэша AI-ответов (ai_cache.db).
+#   python cache_tool.py stats
+#   python cache_tool.py list [--prompt-key coach] [--limit 20]
+#   python cache_tool.py prune [--older-than-days 7] [--max-mb 32] [--prompt-key coach]
+#   python cache_tool.py export cache.jsonl
+#   python cache_tool.py warm cache.jsonl
+# Формат файла для warm/export — JSONL: {"prompt_key": ..., "query": ..., "response": ...}
+import argparse
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+# Модуль бота импортируется без токена: хранилище состояния в памяти, собственный L2-кэш бота не открывается
+os.environ.setdefault("STATE_BACKEND", "memory")
+os.environ.setdefault("AI_CACHE_DISK_ENABLED", "0")
+os.environ.setdefault("WEBHOOK_CAPTURE_PATH", "")
+logging.disable(logging.ERROR)
+
+from main import AI_CACHE_DB_PATH, DiskResponseCache
+
+def cmd_stats(cache: DiskResponseCache, args):
+    stats = cache.stats()
+    print(f"Файл: {stats['path']}")
+    print(f"Записей: {stats['entries']}")
+    print(f"Размер: {stats['bytes'] / 1024 / 1024:.2f} / {stats['max_bytes'] / 1024 / 1024:.2f} МБ")
+    print(f"Попаданий: {stats['hits']}")
+    per_key = {}
+    for entry in cache.entries():
+        count, size = per_key.get(entry['prompt_key'], (0, 0))
+        per_key[entry['prompt_key']] = (count + 1, size + entry['size'])
+    for prompt_key, (count, size) in sorted(per_key.items()):
+        print(f"  {prompt_key}: {count} записей, {size / 1024:.1f} КБ")
+
+def cmd_list(cache: DiskResponseCache, args):
+    for entry in cache.entries(prompt_key=args.prompt_key, limit=args.limit):
+        last_access = datetime.fromtimestamp(entry['last_access']).strftime('%d.%m.%Y %H:%M')
+        query = entry['query'] if len(entry['query']) <= 60 else entry['query'][:57] + "..."
+        print(f"{entry['key'][:10]}  {entry['prompt_key']:<12} hits={entry['hits']:<4} {entry['size']:>7} Б  {last_access}  {query}")
+
+def cmd_prune(cache: DiskResponseCache, args):
+    older_than = args.older_than_days * 86400 if args.older_than_days is not None else None
+    max_bytes = int(args.max_mb * 1024 * 1024) if args.max_mb is not None else None
+    removed = cache.prune(max_bytes=max_bytes, older_than=older_than, prompt_key=args.prompt_key)
+    print(f"Удалено записей: {removed}")
+
+def cmd_export(cache: DiskResponseCache, args):
+    exported = 0
+    with open(args.file, 'w', encoding='utf-8') as f:
+        for entry in cache.entries(prompt_key=args.prompt_key):
+            item = {k: entry[k] for k in ('prompt_key', 'query', 'response', 'created_at')}
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            exported += 1
+    print(f"Выгружено записей: {exported}")
+
+def cmd_warm(cache: DiskResponseCache, args):
+    print(f"Загружено записей: {cache.warm_from_file(args.file)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Управление L2-кэшем AI-ответов")
+    parser.add_argument("--db", default=AI_CACHE_DB_PATH, help="путь к файлу кэша")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="сводка по кэшу")
+    list_parser = commands.add_parser("list", help="последние записи")
+    list_parser.add_argument("--prompt-key")
+    list_parser.add_argument("--limit", type=int, default=20)
+    prune_parser = commands.add_parser("prune", help="удалить устаревшие записи и ужать до размера")
+    prune_parser.add_argument("--older-than-days", type=float)
+    prune_parser.add_argument("--max-mb", type=float)
+    prune_parser.add_argument("--prompt-key")
+    export_parser = commands.add_parser("export", help="выгрузить в JSONL")
+    export_parser.add_argument("file")
+    export_parser.add_argument("--prompt-key")
+    warm_parser = commands.add_parser("warm", help="загрузить из JSONL")
+    warm_parser.add_argument("file")
+    args = parser.parse_args()
+    cache = DiskResponseCache(args.db)
+    try:
+        {
+            "stats": cmd_stats,
+            "list": cmd_list,
+            "prune": cmd_prune,
+            "export": cmd_export,
+            "warm": cmd_warm,
+        }[args.command](cache, args)
+    finally:
+        cache.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
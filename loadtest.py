@@ -0,0 +1,561 @@
+# Нагрузочный стенд: поднимает aiohttp-приложение бота локально, подменяет Bot API и Groq
+# локальными фейковыми серверами и прогоняет синтетических пользователей через webhook.
+# Работает полностью офлайн.
+#   python loadtest.py --users 2000 --concurrency 300
+#   python loadtest.py --users 500 --mix ai=1 --groq-ttft 1.5 --groq-429-rate 0.05
+#   python loadtest.py --users 300 --mix skilltrainer=1 --groq-error-rate 0.02 --json result.json
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
+
+TOKEN = "123456:LOADTEST"
+METRICS_TOKEN = "loadtest-metrics"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "LoadBot", "username": "load_test_bot"}
+CURSOR = " ▌"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с фейковыми Bot API и Groq")
+    parser.add_argument("--users", type=int, default=1000, help="сколько синтетических пользователей")
+    parser.add_argument("--concurrency", type=int, default=200, help="сколько пользователей активны одновременно")
+    parser.add_argument("--mix", default="menu=0.2,calculator=0.3,ai=0.3,skilltrainer=0.2", help="доли сценариев")
+    parser.add_argument("--think-time", type=float, default=0.0, help="пауза пользователя между шагами, с")
+    parser.add_argument("--step-timeout", type=float, default=120.0)
+    parser.add_argument("--max-queue-wait", type=float, default=0.5,
+                        help="допустимое среднее ожидание апдейта в очереди воркеров, с; 0 — не проверять")
+    parser.add_argument("--query-pool", type=int, default=50, help="число разных AI-запросов (повторы бьют в кэш)")
+    add_stack_arguments(parser)
+    parser.add_argument("--json", help="сохранить результат в JSON")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+def add_stack_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="задержка фейкового Bot API, с")
+    parser.add_argument("--telegram-global-rate", type=float, help="лимит бота на исходящие, сообщений/с (по умолчанию как в проде)")
+    parser.add_argument("--telegram-429-rate", type=float, default=0.0, help="доля ответов Bot API 429 (flood wait)")
+    parser.add_argument("--groq-ttft", type=float, default=0.4, help="медиана времени до первого токена, с")
+    parser.add_argument("--groq-tail", type=float, default=0.5, help="sigma логнормального хвоста задержки")
+    parser.add_argument("--groq-tokens-per-second", type=float, default=400.0)
+    parser.add_argument("--groq-completion-words", type=int, default=250)
+    parser.add_argument("--groq-error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--groq-429-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--groq-retry-after", type=float, default=1.0)
+    parser.add_argument("--groq-incident-model", help="модель, у которой инцидент (проверка отката по цепочке)")
+    parser.add_argument("--groq-incident-error-rate", type=float, default=1.0, help="доля ответов 503 у модели с инцидентом")
+    parser.add_argument("--groq-incident-delay", type=float, default=0.0, help="доп. задержка ответа модели с инцидентом, с")
+    parser.add_argument("--no-streaming", action="store_true")
+    parser.add_argument("--verbose", action="store_true")
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+async def serve(app: web.Application) -> tuple:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.SockSite(runner, sock).start()
+    return runner, sock.getsockname()[1]
+
+# ==============================================================================
+# ФЕЙКОВЫЙ BOT API
+# ==============================================================================
+class FakeBotAPI:
+    def __init__(self, latency: float, flood_rate: float = 0.0):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_waits = 0
+        self.message_ids = itertools.count(1_000_000)
+        self.calls: Dict[int, List[Dict[str, Any]]] = {}
+        self.events: Dict[int, asyncio.Event] = {}
+        self.methods: Dict[str, int] = {}
+        self.app = web.Application()
+        self.app.add_routes([web.post("/bot{token}/{method}", self.handle)])
+    def message(self, chat_id: int, text: Optional[str], message_id: Optional[int] = None) -> Dict[str, Any]:
+        return {
+            "message_id": message_id or next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": text or "",
+        }
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.methods[method] = self.methods.get(method, 0) + 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = {}
+            for key, value in (await request.post()).items():
+                if key in ("chat_id", "message_id", "reply_markup") and isinstance(value, str):
+                    try:
+                        value = json.loads(value)
+                    except ValueError:
+                        pass
+                params[key] = value
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": BOT_USER})
+        if method.startswith(("send", "edit")) and random.random() < self.flood_rate:
+            self.flood_waits += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        chat_id = params.get("chat_id")
+        result: Any = True
+        if method in ("sendMessage", "editMessageText", "sendDocument", "sendPhoto"):
+            text = params.get("text") or params.get("caption")
+            result = self.message(chat_id, text, params.get("message_id"))
+            if method == "sendDocument":
+                result["document"] = {"file_id": "doc", "file_unique_id": "doc"}
+            self.record(chat_id, method, text, params.get("reply_markup"), result["message_id"])
+        elif chat_id is not None:
+            self.record(chat_id, method, None, None, params.get("message_id"))
+        return web.json_response({"ok": True, "result": result})
+    def record(self, chat_id: int, method: str, text: Optional[str], reply_markup: Any, message_id: Optional[int]):
+        self.calls.setdefault(chat_id, []).append({
+            "method": method, "text": text or "", "reply_markup": reply_markup,
+            "message_id": message_id, "t": time.monotonic(),
+        })
+        event = self.events.get(chat_id)
+        if event:
+            event.set()
+    async def wait_for(self, chat_id: int, start: int, predicate: Callable[[Dict[str, Any]], bool], timeout: float):
+        deadline = time.monotonic() + timeout
+        checked = start
+        event = self.events.setdefault(chat_id, asyncio.Event())
+        while True:
+            calls = self.calls.get(chat_id, [])
+            for call in calls[checked:]:
+                if predicate(call):
+                    return call
+            checked = len(calls)
+            event.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                raise
+    def forget(self, chat_id: int):
+        self.calls.pop(chat_id, None)
+        self.events.pop(chat_id, None)
+
+# ==============================================================================
+# ФЕЙКОВЫЙ GROQ
+# ==============================================================================
+LOREM = ("Практика важнее теории поэтому начните с малого шага и закрепите его ежедневным повторением "
+         "сформулируйте цель измеримо отслеживайте прогресс и корректируйте план раз в неделю").split()
+
+class FakeGroq:
+    def __init__(self, args):
+        self.args = args
+        self.requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.completion_tokens = 0
+        self.models: Dict[str, int] = {}
+        self.app = web.Application()
+        self.app.add_routes([web.post("/openai/v1/chat/completions", self.handle)])
+    def content(self, prompt: str, max_tokens: Optional[int] = None) -> str:
+        # Как настоящий API, ответ обрезается по max_tokens запроса
+        count = min(self.args.groq_completion_words, max_tokens or self.args.groq_completion_words)
+        words = [random.choice(LOREM) for _ in range(count)]
+        body = " ".join(words)
+        if "ЗАДАНИЕ" in prompt:
+            return f"**ЗАДАНИЕ:**\nТренировка\n**ИНСТРУКЦИЯ:**\n{body}\n**КРИТЕРИИ УСПЕХА (DOD):**\n1. Готово\n**ПОДСКАЗКА:**\nНе спешите"
+        return body
+    def usage(self, prompt: str, completion: str) -> Dict[str, int]:
+        prompt_tokens = len(prompt) // 3 + 1
+        completion_tokens = len(completion.split())
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        self.models[body["model"]] = self.models.get(body["model"], 0) + 1
+        if body["model"] == self.args.groq_incident_model:
+            if random.random() < self.args.groq_incident_error_rate:
+                self.errors += 1
+                return web.json_response({"error": {"message": "Service unavailable", "type": "internal_server_error"}},
+                                         status=503)
+            await asyncio.sleep(self.args.groq_incident_delay)
+        roll = random.random()
+        if roll < self.args.groq_429_rate:
+            self.rate_limited += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "tokens", "code": "rate_limit_exceeded"}},
+                status=429, headers={"retry-after": str(self.args.groq_retry_after)}
+            )
+        if roll < self.args.groq_429_rate + self.args.groq_error_rate:
+            self.errors += 1
+            return web.json_response({"error": {"message": "Internal error", "type": "internal_server_error"}}, status=500)
+        await asyncio.sleep(random.lognormvariate(0, self.args.groq_tail) * self.args.groq_ttft)
+        prompt = "\n".join(m.get("content", "") for m in body["messages"])
+        completion = self.content(prompt, body.get("max_tokens"))
+        usage = self.usage(prompt, completion)
+        self.completion_tokens += usage["completion_tokens"]
+        base = {"id": "chatcmpl-load", "created": int(time.time()), "model": body["model"]}
+        if not body.get("stream"):
+            await asyncio.sleep(usage["completion_tokens"] / self.args.groq_tokens_per_second)
+            return web.json_response({
+                **base, "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": completion}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        words = completion.split(" ")
+        batch = 8
+        for i in range(0, len(words), batch):
+            piece = " ".join(words[i:i + batch]) + (" " if i + batch < len(words) else "")
+            chunk = {**base, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            await asyncio.sleep(len(words[i:i + batch]) / self.args.groq_tokens_per_second)
+        final = {**base, "object": "chat.completion.chunk",
+                 "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                 "x_groq": {"id": "req-load", "usage": usage}}
+        await response.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+        await response.write_eof()
+        return response
+
+# ==============================================================================
+# СИНТЕТИЧЕСКИЕ ПОЛЬЗОВАТЕЛИ
+# ==============================================================================
+class StepFailed(Exception):
+    pass
+
+class Harness:
+    def __init__(self, args, api: FakeBotAPI, webhook_url: str, session: ClientSession, steps_text: List[str]):
+        self.args = args
+        self.api = api
+        self.webhook_url = webhook_url
+        self.session = session
+        self.calculator_steps = steps_text
+        self.update_ids = itertools.count(1)
+        self.flow_latencies: Dict[str, List[float]] = {}
+        self.step_latencies: Dict[str, List[float]] = {}
+        self.failures: Dict[str, int] = {}
+        self.failure_reasons: Dict[str, int] = {}
+        self.updates_sent = 0
+        self.webhook_rejections = 0
+    async def post(self, update: Dict[str, Any]):
+        while True:
+            async with self.session.post(self.webhook_url, json=update) as response:
+                self.updates_sent += 1
+                if response.status == 200:
+                    return
+                if response.status == 503:
+                    # Как Telegram: повторяем доставку, пока очередь бота переполнена
+                    self.webhook_rejections += 1
+                    await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+                    continue
+                raise StepFailed(f"webhook {response.status}")
+
+class SyntheticUser:
+    def __init__(self, harness: Harness, user_id: int):
+        self.h = harness
+        self.user_id = user_id
+        self.message_ids = itertools.count(1)
+        self.last_bot_message_id = None
+        self.last_bot_text = ""
+    def user(self) -> Dict[str, Any]:
+        return {"id": self.user_id, "is_bot": False, "first_name": "Load", "language_code": "ru"}
+    def text_update(self, text: str) -> Dict[str, Any]:
+        message = {
+            "message_id": next(self.message_ids), "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"}, "from": self.user(), "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self.h.update_ids), "message": message}
+    def callback_update(self, data: str) -> Dict[str, Any]:
+        return {"update_id": next(self.h.update_ids), "callback_query": {
+            "id": f"{self.user_id}-{next(self.message_ids)}", "from": self.user(), "chat_instance": "load", "data": data,
+            "message": {
+                "message_id": self.last_bot_message_id or 1, "date": int(time.time()),
+                "chat": {"id": self.user_id, "type": "private"}, "from": BOT_USER, "text": self.last_bot_text or "-",
+            },
+        }}
+    async def step(self, name: str, update: Dict[str, Any], predicate: Callable[[Dict[str, Any]], bool]):
+        if self.h.args.think_time:
+            await asyncio.sleep(random.expovariate(1 / self.h.args.think_time))
+        start_index = len(self.h.api.calls.get(self.user_id, []))
+        started = time.monotonic()
+        await self.h.post(update)
+        try:
+            call = await self.h.api.wait_for(self.user_id, start_index, predicate, self.h.args.step_timeout)
+        except asyncio.TimeoutError:
+            raise StepFailed(f"таймаут шага {name}")
+        self.h.step_latencies.setdefault(name, []).append(time.monotonic() - started)
+        if call["message_id"]:
+            self.last_bot_message_id = call["message_id"]
+            self.last_bot_text = call["text"]
+        return call
+    async def command(self, name: str, text: str, predicate):
+        return await self.step(name, self.text_update(text), predicate)
+    async def press(self, name: str, data: str, predicate):
+        return await self.step(name, self.callback_update(data), predicate)
+
+def has_text(*needles: str) -> Callable[[Dict[str, Any]], bool]:
+    return lambda call: any(needle in call["text"] for needle in needles)
+
+def final_text(*needles: str) -> Callable[[Dict[str, Any]], bool]:
+    # Потоковые правки заканчиваются курсором; итоговая — без него
+    return lambda call: any(needle in call["text"] for needle in needles) and not call["text"].endswith(CURSOR)
+
+async def flow_menu(u: SyntheticUser):
+    await u.command("start", "/start", has_text("Выберите"))
+    await u.press("menu_self", "menu_self", has_text("Для себя"))
+    await u.press("main_menu", "main_menu", has_text("Выберите раздел"))
+    await u.press("menu_business", "menu_business", has_text("Для дела"))
+    await u.command("progress", "/progress", has_text("🎯"))
+
+async def flow_calculator(u: SyntheticUser):
+    await u.command("start", "/start", has_text("Выберите"))
+    await u.press("menu_business", "menu_business", has_text("Для дела"))
+    steps = u.h.calculator_steps
+    await u.press("calculator_open", "menu_calculator", has_text(steps[0]))
+    values = [random.randint(100, 900), random.randint(1000, 3000), 15, 10, random.randint(3, 20), 6]
+    for i, value in enumerate(values):
+        expected = has_text(steps[i + 1]) if i + 1 < len(steps) else has_text("ФИНАНСОВЫЙ АНАЛИЗ")
+        await u.command("calculator_input" if i + 1 < len(steps) else "calculator_result", str(value), expected)
+
+async def flow_calculator_oneshot(u: SyntheticUser):
+    await u.command("start", "/start", has_text("Выберите"))
+    await u.press("menu_business", "menu_business", has_text("Для дела"))
+    await u.press("calculator_open", "menu_calculator", has_text(u.h.calculator_steps[0]))
+    text = (f"себестоимость {random.randint(100, 900)}, цена {random.randint(1000, 3000)}, "
+            f"комиссия 15%, логистика 10%, ACOS {random.randint(3, 20)}%, налог 6%")
+    await u.command("calculator_oneshot", text, has_text("ФИНАНСОВЫЙ АНАЛИЗ"))
+
+async def flow_ai(u: SyntheticUser):
+    tool = random.choice(["coach", "generator", "analyzer", "grimoire"])
+    await u.command("start", "/start", has_text("Выберите"))
+    await u.press("menu_self", "menu_self", has_text("Для себя"))
+    await u.press("ai_select", f"ai_{tool}_self", has_text("Чтобы начать"))
+    await u.press("ai_activate", f"activate_{tool}", has_text("активирован"))
+    for _ in range(2):
+        query = f"Как мне улучшить навык номер {random.randrange(u.h.args.query_pool)} в работе?"
+        await u.command("ai_query", query, final_text("🤖 Ответ"))
+
+async def flow_skilltrainer(u: SyntheticUser):
+    await u.command("start", "/start", has_text("Выберите"))
+    await u.press("menu_business", "menu_business", has_text("Для дела"))
+    await u.press("st_select", "ai_skilltrainer_business", has_text("Чтобы начать"))
+    await u.press("st_activate", "activate_skilltrainer", has_text("Шаг 1/7"))
+    answers = [
+        "Хочу научиться вести сложные переговоры с клиентами",
+        "Примерно пять из десяти",
+        "На встречах с крупными клиентами и при обсуждении цены",
+        "Сложнее всего держать паузу и не уступать сразу",
+        "Закрывать сделки без скидок больше десяти процентов",
+        "Около трёх часов в неделю",
+    ]
+    for i, answer in enumerate(answers):
+        expected = has_text(f"Шаг {i + 2}/7") if i < 5 else has_text("Выберите режим")
+        await u.command("st_answer", answer, expected)
+    await u.press("st_mode", "st_mode_sim", has_text("РЕЖИМ: SIM"))
+    await u.press("st_training", "st_start_training", lambda c: "ЗАДАНИЕ" in c["text"] and c["reply_markup"] is not None and not c["text"].endswith(CURSOR))
+    await u.press("st_finish", "st_finish_session", has_text("СЕССИЯ SKILLTRAINER ЗАВЕРШЕНА"))
+
+FLOWS = {
+    "menu": flow_menu,
+    "calculator": flow_calculator,
+    "calculator_oneshot": flow_calculator_oneshot,
+    "ai": flow_ai,
+    "skilltrainer": flow_skilltrainer,
+}
+
+async def run_user(harness: Harness, user_id: int, flow_name: str):
+    user = SyntheticUser(harness, user_id)
+    started = time.monotonic()
+    try:
+        await FLOWS[flow_name](user)
+    except StepFailed as e:
+        harness.failures[flow_name] = harness.failures.get(flow_name, 0) + 1
+        harness.failure_reasons[str(e)] = harness.failure_reasons.get(str(e), 0) + 1
+        return
+    except Exception as e:
+        harness.failures[flow_name] = harness.failures.get(flow_name, 0) + 1
+        harness.failure_reasons[type(e).__name__] = harness.failure_reasons.get(type(e).__name__, 0) + 1
+        return
+    finally:
+        harness.api.forget(user_id)
+    harness.flow_latencies.setdefault(flow_name, []).append(time.monotonic() - started)
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in FLOWS:
+            raise SystemExit(f"Неизвестный сценарий: {name}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+def summarize(title: str, values: List[float], failures: int = 0) -> Dict[str, Any]:
+    return {
+        "name": title, "count": len(values), "failures": failures,
+        "p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99),
+        "max": max(values) if values else 0.0,
+    }
+
+def print_table(rows: List[Dict[str, Any]]):
+    print(f"  {'сценарий':<20}{'ок':>7}{'ошибок':>8}{'p50, с':>9}{'p95, с':>9}{'p99, с':>9}{'max, с':>9}")
+    for row in rows:
+        print(f"  {row['name']:<20}{row['count']:>7}{row['failures']:>8}"
+              f"{row['p50']:>9.3f}{row['p95']:>9.3f}{row['p99']:>9.3f}{row['max']:>9.3f}")
+
+class Stack:
+    def __init__(self, bot, api: FakeBotAPI, groq: FakeGroq, runners: List[web.AppRunner], bot_port: int):
+        self.bot = bot
+        self.api = api
+        self.groq = groq
+        self.runners = runners
+        self.bot_port = bot_port
+    @property
+    def webhook_url(self) -> str:
+        return f"http://127.0.0.1:{self.bot_port}/"
+
+async def start_stack(args) -> Stack:
+    # Бот импортируется только после подмены окружения: main читает конфиг при импорте
+    api = FakeBotAPI(args.telegram_latency, args.telegram_429_rate)
+    groq = FakeGroq(args)
+    api_runner, api_port = await serve(api.app)
+    groq_runner, groq_port = await serve(groq.app)
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    os.environ.update({
+        "TELEGRAM_TOKEN": TOKEN,
+        "GROQ_API_KEY": "loadtest",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{api_port}",
+        "GROQ_BASE_URL": f"http://127.0.0.1:{groq_port}",
+        "STATE_DB_PATH": os.path.join(workdir, "state.db"),
+        "AI_CACHE_DB_PATH": os.path.join(workdir, "ai_cache.db"),
+        "STREAMING_ENABLED": "0" if args.no_streaming else "1",
+        "GROQ_TOKENS_PER_MINUTE": "0",
+        "WEBHOOK_CAPTURE_PATH": "",
+        "METRICS_TOKEN": METRICS_TOKEN,
+    })
+    if args.telegram_global_rate:
+        os.environ["TELEGRAM_GLOBAL_RATE"] = str(args.telegram_global_rate)
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    import main as bot
+    await bot.start_services(bot.application)
+    bot_runner, bot_port = await serve(bot.build_web_app())
+    return Stack(bot, api, groq, [bot_runner, api_runner, groq_runner], bot_port)
+
+async def stop_stack(stack: Stack):
+    bot_runner, api_runner, groq_runner = stack.runners
+    await bot_runner.cleanup()
+    await stack.bot.stop_services(stack.bot.application)
+    await api_runner.cleanup()
+    await groq_runner.cleanup()
+
+async def main_async(args) -> Dict[str, Any]:
+    random.seed(args.seed)
+    stack = await start_stack(args)
+    bot, api, groq = stack.bot, stack.api, stack.groq
+    bot.PREMIUM_USER_IDS.update(range(1, args.users + 1))
+    bot_port = stack.bot_port
+    connector = TCPConnector(limit=args.concurrency)
+    session = ClientSession(connector=connector, timeout=ClientTimeout(total=args.step_timeout))
+    harness = Harness(args, api, f"http://127.0.0.1:{bot_port}/", session, bot.CALCULATOR_STEPS)
+    weights = parse_mix(args.mix)
+    flow_names = random.choices(list(weights), weights=list(weights.values()), k=args.users)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    async def limited(user_id: int, flow_name: str):
+        async with semaphore:
+            await run_user(harness, user_id, flow_name)
+    started = time.monotonic()
+    await asyncio.gather(*(limited(i + 1, name) for i, name in enumerate(flow_names)))
+    elapsed = time.monotonic() - started
+    async with session.get(f"http://127.0.0.1:{bot_port}/metrics",
+                           headers={"Authorization": f"Bearer {METRICS_TOKEN}"}) as response:
+        response.raise_for_status()
+        metrics_size = len(await response.text())
+    result = {
+        "users": args.users,
+        "elapsed_seconds": elapsed,
+        "flows_per_second": sum(len(v) for v in harness.flow_latencies.values()) / elapsed,
+        "updates_per_second": harness.updates_sent / elapsed,
+        "webhook_rejections": harness.webhook_rejections,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "flows": [summarize(name, harness.flow_latencies.get(name, []), harness.failures.get(name, 0)) for name in weights],
+        "steps": [summarize(name, values) for name, values in sorted(harness.step_latencies.items())],
+        "failure_reasons": harness.failure_reasons,
+        "telegram_calls": api.methods,
+        "telegram_flood_waits": api.flood_waits,
+        "groq": {"requests": groq.requests, "rate_limited": groq.rate_limited, "errors": groq.errors,
+                 "completion_tokens": groq.completion_tokens, "models": groq.models},
+        "bot": {
+            "queue": bot.update_queue.stats(),
+            "ai_cache": bot.ai_cache.stats(),
+            "singleflight": bot.llm_singleflight.stats(),
+            "memory": bot.conversation_memory.stats(),
+            "background": {**bot.background_jobs.stats(),
+                           "precomputed": {"/".join(labels): int(v) for labels, v in bot.SKILLTRAINER_PRECOMPUTE.values.items()}},
+            "scheduler": bot.llm_client.scheduler.stats(),
+            "router": bot.llm_client.router.stats(),
+            "hedges": bot.llm_client.hedges.stats(),
+            "outbound": bot.outbound_dispatcher.stats(),
+            "metrics_bytes": metrics_size,
+        },
+    }
+    queue_wait = result["bot"]["queue"]["wait_time_avg"]
+    if args.max_queue_wait and queue_wait > args.max_queue_wait:
+        # Воркеры не должны простаивать в ожидании (лимиты Telegram, Groq): иначе апдейты других пользователей ждут их
+        result["failure_reasons"][f"среднее ожидание в очереди {queue_wait:.2f} с > {args.max_queue_wait:.2f} с"] = 1
+    await session.close()
+    await stop_stack(stack)
+    return result
+
+def main():
+    args = parse_args()
+    result = asyncio.run(main_async(args))
+    print(f"\nПользователей: {result['users']}, время: {result['elapsed_seconds']:.1f} с")
+    print(f"Пропускная способность: {result['flows_per_second']:.1f} сценариев/с, {result['updates_per_second']:.1f} апдейтов/с")
+    print(f"Пиковая память процесса (бот + стенд): {result['peak_rss_mb']:.1f} МБ")
+    print(f"Отказы webhook (503): {result['webhook_rejections']}")
+    print("\nСценарии целиком:")
+    print_table(result["flows"])
+    print("\nОтдельные шаги:")
+    print_table(result["steps"])
+    if result["failure_reasons"]:
+        print("\nПричины ошибок:")
+        for reason, count in sorted(result["failure_reasons"].items(), key=lambda x: -x[1]):
+            print(f"  {count:>6}  {reason}")
+    print(f"\nGroq: {result['groq']}")
+    print(f"Кэш AI: {result['bot']['ai_cache']}")
+    print(f"Single-flight: {result['bot']['singleflight']}")
+    print(f"Память диалогов: {result['bot']['memory']}")
+    print(f"Фоновые задачи: {result['bot']['background']}")
+    print(f"Планировщик: {result['bot']['scheduler']}")
+    print(f"Маршрутизатор моделей: {result['bot']['router']}")
+    print(f"Хеджирование: {result['bot']['hedges']}")
+    print(f"Очередь: {result['bot']['queue']}")
+    print(f"Исходящие в Telegram: {result['bot']['outbound']}, flood wait от стенда: {result['telegram_flood_waits']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return 0 if not result["failure_reasons"] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,18 +1,40 @@
 import os
 import logging
 import asyncio
+import contextvars
+import bisect
+import functools
 import time
 import hashlib
-from typing import Dict, Any, List, Optional, Set
+import hmac
+import heapq
+import itertools
+import random
+import json
+import re
+import unicodedata
+import sqlite3
+import gzip
+import threading
+import zlib
+import csv
+import io
+from abc import ABC, abstractmethod
+from typing import Dict, Any, List, Optional, Set, AsyncIterator, Awaitable, Callable
 from datetime import datetime, timedelta
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from enum import Enum
 import httpx
+import numpy as np
+import openpyxl
 from aiohttp import web
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from groq import Groq, APIError
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, InputFile
+from telegram.ext import Application, BaseRateLimiter, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes
+from groq import AsyncGroq, APIError, APIConnectionError, InternalServerError, NotFoundError, RateLimitError
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 
 # ==============================================================================
 # 0. КОНФИГУРАЦИЯ И ВЕРСИОНИРОВАНИЕ
@@ -29,10 +51,402 @@ TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
 PORT = int(os.environ.get("PORT", 10000))  # Render default
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")  # /metrics и /queue: заголовок Authorization: Bearer <токен>; пусто — выключены
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")  # для локальных стендов и нагрузочных тестов
+
+# 🔹 LLM: единое место настройки модели, лимитов токенов, таймаутов и пула соединений
+LLM_MODEL = os.environ.get("LLM_MODEL", "llama-3.1-8b-instant")
+LLM_MAX_TOKENS: Dict[str, int] = {
+    'chat': 4000,
+    'training': 1500,
+    'finish': 4000,
+    'finish_section': 700,
+    'summary': 400,
+}
+LLM_TIMEOUTS: Dict[str, float] = {
+    'chat': 60.0,
+    'training': 45.0,
+    'finish': 90.0,
+    'finish_section': 40.0,
+    'summary': 30.0,
+}
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 20))
+LLM_MAX_KEEPALIVE = int(os.environ.get("LLM_MAX_KEEPALIVE", 10))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", 5.0))
+
+# 🔹 Планировщик вызовов Groq: адаптивная конкурентность (AIMD), Retry-After, повторы с джиттером, приоритеты
+LLM_PRIORITIES: Dict[str, int] = {
+    'chat': 0,       # интерактивные ответы AI-инструментов
+    'training': 1,   # генерация тренировочных заданий
+    'finish': 2,     # Finish Packet
+    'finish_section': 2,  # раздел Finish Packet при параллельной генерации
+    'summary': 3,    # сжатие памяти диалога — фоновая работа, уступает всем
+}
+LLM_MAX_ATTEMPTS: Dict[str, int] = {'chat': 3, 'training': 4, 'finish': 5, 'finish_section': 3, 'summary': 2}
+LLM_LATENCY_TARGETS: Dict[str, float] = {'chat': 10.0, 'training': 12.0, 'finish': 25.0, 'finish_section': 12.0, 'summary': 15.0}
+LLM_INITIAL_CONCURRENCY = int(os.environ.get("LLM_INITIAL_CONCURRENCY", 8))
+LLM_MIN_CONCURRENCY = 1
+LLM_BACKOFF_BASE = 0.5
+LLM_BACKOFF_MAX = 20.0
+
+# 🔹 Маршрутизация по моделям: инструмент и тип вызова → уровень → цепочка моделей, по которой идёт откат
+LLM_MODEL_TIERS: Dict[str, List[str]] = {
+    'fast': [LLM_MODEL, "llama-3.3-70b-versatile"],
+    'quality': ["llama-3.3-70b-versatile", LLM_MODEL],
+}
+# LLM_MODEL_TIERS="fast=llama-3.1-8b-instant|gemma2-9b-it;quality=llama-3.3-70b-versatile" — свои цепочки
+LLM_MODEL_TIERS.update({
+    name.strip(): [m.strip() for m in chain.split("|") if m.strip()]
+    for name, _, chain in (item.partition("=") for item in os.environ.get("LLM_MODEL_TIERS", "").split(";")) if chain
+})
+# Ключ — «инструмент/тип вызова», инструмент (ключ SYSTEM_PROMPTS) или тип вызова; первый найденный задаёт уровень
+LLM_ROUTES: Dict[str, str] = {
+    'finish': 'quality',
+    'finish_section': 'quality',
+}
+# LLM_ROUTES="analyzer=quality,skilltrainer/training=fast"
+LLM_ROUTES.update({
+    key.strip(): tier.strip()
+    for key, _, tier in (item.partition("=") for item in os.environ.get("LLM_ROUTES", "").split(",")) if tier
+})
+LLM_DEFAULT_TIER = os.environ.get("LLM_DEFAULT_TIER", "fast")
+LLM_ROUTER_WINDOW = float(os.environ.get("LLM_ROUTER_WINDOW", 120))  # окно скользящей статистики модели, с
+LLM_ROUTER_SAMPLES = 200  # не больше замеров на модель в окне
+LLM_BREAKER_MIN_CALLS = int(os.environ.get("LLM_BREAKER_MIN_CALLS", 5))
+LLM_BREAKER_ERROR_RATE = float(os.environ.get("LLM_BREAKER_ERROR_RATE", 0.5))
+LLM_BREAKER_COOLDOWN = float(os.environ.get("LLM_BREAKER_COOLDOWN", 30))
+
+# 🔹 Хеджирование: если идемпотентный запрос не ответил к перцентилю обычной задержки, отправляем второй такой же
+LLM_HEDGE_ENABLED = os.environ.get("LLM_HEDGE_ENABLED", "1") != "0"
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", 95))
+LLM_HEDGE_MIN_DELAY = float(os.environ.get("LLM_HEDGE_MIN_DELAY", 0.5))  # раньше не хеджируем, даже если модель быстрая
+LLM_HEDGE_MIN_SAMPLES = 20  # без такой статистики по модели и типу вызова перцентиль ненадёжен — не хеджируем
+LLM_HEDGE_BUDGET = float(os.environ.get("LLM_HEDGE_BUDGET", 0.05))  # лишних запросов на один обычный
+LLM_HEDGE_BURST = 5.0
+
+# 🔹 Лимиты: token bucket на пользователя и инструмент, тарифы, общий бюджет токенов Groq в минуту
+RATE_LIMITS: Dict[str, Dict[str, tuple]] = {
+    # тариф → инструмент → (запросов, за секунд)
+    'free': {'default': (15, 60), 'skilltrainer': (20, 60)},
+    'premium': {'default': (60, 60), 'skilltrainer': (60, 60)},
+}
+PREMIUM_USER_IDS: Set[int] = {int(x) for x in os.environ.get("PREMIUM_USER_IDS", "").split(",") if x.strip()}
+RATE_LIMIT_IDLE_TTL = float(os.environ.get("RATE_LIMIT_IDLE_TTL", 600))
+GROQ_TOKENS_PER_MINUTE = int(os.environ.get("GROQ_TOKENS_PER_MINUTE", 20000))  # 0 — без ограничения
+LLM_BUDGET_WAIT = float(os.environ.get("LLM_BUDGET_WAIT", 10.0))
+LLM_EXPECTED_COMPLETION_TOKENS: Dict[str, int] = {
+    'chat': 800,
+    'training': 600,
+    'finish': 2000,
+    'finish_section': 400,
+    'summary': 250,
+}
+# 🔹 Телефоны, почта, карты и т.п. заменяются плейсхолдерами до отправки в Groq и до ключа кэша
+PII_REDACTION_ENABLED = os.environ.get("PII_REDACTION_ENABLED", "1") != "0"
+
+# 🔹 Память диалога AI-инструментов: последние реплики в пределах бюджета токенов, старые сжимаются в сводку
+CONVERSATION_TOKEN_BUDGET = int(os.environ.get("CONVERSATION_TOKEN_BUDGET", 3000))  # история в промпте; 0 — без памяти
+CONVERSATION_KEEP_MESSAGES = 4  # последние реплики (2 обмена) не сжимаются никогда
+CONVERSATION_IDLE_TTL = float(os.environ.get("CONVERSATION_IDLE_TTL", 1800))
+CONVERSATION_SUMMARY_PROMPT = (
+    "Сожми диалог пользователя с ассистентом в краткую сводку до 120 слов: цели и контекст пользователя, "
+    "важные факты и числа, договорённости и что уже предложено. Только сводка, без вступлений."
+)
+
+# 🔹 Фоновые (спекулятивные) вызовы Groq: заранее готовим то, что пользователь скорее всего попросит
+BACKGROUND_MAX_JOBS = int(os.environ.get("BACKGROUND_MAX_JOBS", 4))
+BACKGROUND_MAX_CALLS = int(os.environ.get("BACKGROUND_MAX_CALLS", 4))  # одновременных вызовов Groq от всех фоновых задач
+LLM_BACKGROUND_PRIORITY = max(LLM_PRIORITIES.values()) + 1  # в планировщике фон уступает всем типам вызовов
+BACKGROUND_TOKEN_RESERVE = float(os.environ.get("BACKGROUND_TOKEN_RESERVE", 0.3))  # доля бюджета токенов, которую фон не трогает
+SKILLTRAINER_PREFETCH_MODES = int(os.environ.get("SKILLTRAINER_PREFETCH_MODES", 1))  # сколько режимов готовить заранее: 0 — выкл, 5 — все
+SKILLTRAINER_PREFETCH_TTL = float(os.environ.get("SKILLTRAINER_PREFETCH_TTL", 600))
+# 🔹 Finish Packet собирается из разделов, которые генерируются параллельно
+FINISH_SECTION_CONCURRENCY = int(os.environ.get("FINISH_SECTION_CONCURRENCY", 3))  # одновременных разделов на сессию
+FINISH_SECTION_TIMEOUT = float(os.environ.get("FINISH_SECTION_TIMEOUT", 30.0))
+
+# 🔹 Стриминг: ответ появляется по мере генерации, сообщение редактируется не чаще раза в STREAM_EDIT_INTERVAL
+STREAMING_ENABLED = os.environ.get("STREAMING_ENABLED", "1") != "0"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.0))
+STREAM_ROLLOVER_LENGTH = 3800  # в единицах UTF-16; запас до лимита Telegram 4096 под курсор
+STREAM_CURSOR = " ▌"
+
+# 🔹 Исходящие в Telegram: ~1 сообщение/с в личный чат, 20/мин в группу, ~30/с на бота
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30.0))
+TELEGRAM_PRIVATE_CHAT_RATE = float(os.environ.get("TELEGRAM_PRIVATE_CHAT_RATE", 1.0))
+TELEGRAM_GROUP_CHAT_RATE = float(os.environ.get("TELEGRAM_GROUP_CHAT_RATE", 20 / 60))
+TELEGRAM_CHAT_BURST = 3  # столько сообщений подряд в чат уходят без пауз
+TELEGRAM_MAX_FLOOD_RETRIES = 3
+TELEGRAM_THROTTLED_PREFIXES = ("send", "edit", "copy", "forward")  # answerCallbackQuery и служебные — без очереди
+
+# 🔹 Очередь апдейтов: webhook сразу отвечает 200, воркеры обрабатывают апдейты в порядке пользователя
+UPDATE_QUEUE_WORKERS = int(os.environ.get("UPDATE_QUEUE_WORKERS", 128))  # воркер почти всё время ждёт Groq и Telegram — это не потоки
+UPDATE_QUEUE_MAX_DEPTH = int(os.environ.get("UPDATE_QUEUE_MAX_DEPTH", 2000))
+UPDATE_QUEUE_OVERFLOW = os.environ.get("UPDATE_QUEUE_OVERFLOW", "reject")  # reject → 503 и повтор от Telegram, drop → отбросить
+
+# 🔹 Хранилище состояния: сессии, статистика и user_data переживают рестарт
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "sqlite")  # sqlite | memory
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "bot_state.db")
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", 2.0))
+STATE_COMPRESS_THRESHOLD = 512  # байт; короче — храним JSON как есть
+
+# 🔹 Кэш AI-ответов: нормализация запросов, поиск почти-дубликатов, TTL и бюджет в байтах
+AI_CACHE_MAX_BYTES = int(os.environ.get("AI_CACHE_MAX_BYTES", 8 * 1024 * 1024))
+AI_CACHE_TTL = float(os.environ.get("AI_CACHE_TTL", 24 * 3600))
+AI_CACHE_NEAR_DUPLICATES = os.environ.get("AI_CACHE_NEAR_DUPLICATES", "1") != "0"
+AI_CACHE_SIMILARITY_THRESHOLD = float(os.environ.get("AI_CACHE_SIMILARITY_THRESHOLD", 0.85))
+AI_CACHE_MIN_NEAR_LENGTH = 24  # короткие запросы ("да", "ещё") сравниваем только точно
+AI_CACHE_SHINGLE_SIZE = 4
+AI_CACHE_MINHASH_BANDS = 8
+AI_CACHE_MINHASH_ROWS = 4
+# L2: сжатые ответы в локальном SQLite-файле, переживают рестарт
+AI_CACHE_DISK_ENABLED = os.environ.get("AI_CACHE_DISK_ENABLED", "1") != "0"
+AI_CACHE_DB_PATH = os.environ.get("AI_CACHE_DB_PATH", "ai_cache.db")
+AI_CACHE_DISK_MAX_BYTES = int(os.environ.get("AI_CACHE_DISK_MAX_BYTES", 64 * 1024 * 1024))
+AI_CACHE_DISK_EVICTION = os.environ.get("AI_CACHE_DISK_EVICTION", "lru")  # lru | lfu
+AI_CACHE_WARM_FILE = os.environ.get("AI_CACHE_WARM_FILE")
+
+# 🔹 Пакетный расчёт калькулятора: CSV/XLSX с сотнями и тысячами SKU
+BULK_MAX_FILE_BYTES = int(os.environ.get("BULK_MAX_FILE_BYTES", 10 * 1024 * 1024))  # Bot API отдаёт файлы до 20 МБ
+BULK_MAX_ROWS = int(os.environ.get("BULK_MAX_ROWS", 100000))
+BULK_WORST_COUNT = 10
+MONTE_CARLO_DRAWS = int(os.environ.get("MONTE_CARLO_DRAWS", 200000))
+
+# 🔹 Запись входящих апдейтов для воспроизведения (replay.py); по умолчанию выключена
+WEBHOOK_CAPTURE_PATH = os.environ.get("WEBHOOK_CAPTURE_PATH")  # например captures/updates.jsonl.gz
+WEBHOOK_CAPTURE_MAX_BYTES = int(os.environ.get("WEBHOOK_CAPTURE_MAX_BYTES", 50 * 1024 * 1024))
+WEBHOOK_CAPTURE_BACKUPS = int(os.environ.get("WEBHOOK_CAPTURE_BACKUPS", 5))
+WEBHOOK_CAPTURE_ANONYMIZE = os.environ.get("WEBHOOK_CAPTURE_ANONYMIZE", "ids")  # off | ids | full
+WEBHOOK_CAPTURE_SALT = os.environ.get("WEBHOOK_CAPTURE_SALT", "")  # пусто — случайная соль на процесс
+WEBHOOK_CAPTURE_FLUSH_INTERVAL = 1.0
+WEBHOOK_CAPTURE_BUFFER = 10000  # апдейтов; при переполнении новые отбрасываются, а не тормозят webhook
 
 # ==============================================================================
 # 1. КЛАССЫ
 # ==============================================================================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+    def inc(self, *labels, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # labels → [счётчики по корзинам (последняя — +Inf), сумма]
+        self.values: Dict[tuple, list] = {}
+    def observe(self, value: float, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels + ('le',), labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+class CallbackMetric:
+    # Значение читается только в момент /metrics — на горячем пути ничего не стоит
+    def __init__(self, name: str, help_text: str, collect: Callable[[], Any], labels: tuple = (), kind: str = "gauge"):
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect
+        self.labels = labels
+        self.kind = kind
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.collect()
+        except Exception as e:
+            logger.error(f"Ошибка сбора метрики {self.name}: {e}")
+            return lines
+        series = value if isinstance(value, dict) else {(): value}
+        for labels, v in series.items():
+            labels = labels if isinstance(labels, tuple) else (labels,)
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {float(v)}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: List[Any] = []
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> Counter:
+        metric = Counter(name, help_text, labels)
+        self.metrics.append(metric)
+        return metric
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+    def callback(self, name: str, help_text: str, collect: Callable[[], Any], labels: tuple = (), kind: str = "gauge"):
+        self.metrics.append(CallbackMetric(name, help_text, collect, labels, kind))
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None) -> tuple:
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout
+            )
+        except Exception as e:
+            TELEGRAM_API_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_API_LATENCY.observe(time.perf_counter() - started, api_method)
+        if code != 200:
+            TELEGRAM_API_ERRORS.inc(api_method, str(code))
+        return code, payload
+
+# Чат апдейта, который сейчас обрабатывает воркер, и сколько ответов в него ещё уходят без лимита чата:
+# ответ пользователю ограничен темпом самого пользователя, а сон в воркере задержал бы апдейты всех остальных
+_REPLY_ALLOWANCE: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar('reply_allowance', default=None)
+
+class OutboundDispatcher(BaseRateLimiter):
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, private_rate: float = TELEGRAM_PRIVATE_CHAT_RATE,
+                 group_rate: float = TELEGRAM_GROUP_CHAT_RATE, burst: int = TELEGRAM_CHAT_BURST,
+                 max_retries: int = TELEGRAM_MAX_FLOOD_RETRIES):
+        self.global_interval = 1.0 / global_rate
+        self.private_interval = 1.0 / private_rate
+        self.group_interval = 1.0 / group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        # GCRA: храним «теоретическое время следующей отправки»; ожидание — его сдвиг относительно now
+        self.global_tat = 0.0
+        # chat_id → [tat, paused_until, lock, активные запросы]; lock держится на время вызова — порядок в чате сохраняется
+        self.chats: Dict[int, list] = {}
+        self.sent = 0
+        self.dropped = 0
+        self.flood_waits = 0
+        self.retries = 0
+        self.wait_total = 0.0
+    async def initialize(self) -> None:
+        pass
+    async def shutdown(self) -> None:
+        self.chats.clear()
+    def _reserve(self, tat: float, interval: float, burst: int, now: float) -> tuple:
+        tat = max(tat, now)
+        wait = max(0.0, tat - (burst - 1) * interval - now)
+        return tat + interval, wait
+    def _chat(self, chat_id: int) -> list:
+        state = self.chats.get(chat_id)
+        if state is None:
+            if len(self.chats) > 10000:
+                self._evict_idle()
+            state = [0.0, 0.0, asyncio.Lock(), 0]
+            self.chats[chat_id] = state
+        return state
+    def _evict_idle(self):
+        now = time.monotonic()
+        for chat_id in [c for c, state in self.chats.items() if not state[3] and state[0] <= now and state[1] <= now]:
+            del self.chats[chat_id]
+    async def _throttle(self, state: list, chat_id: int, endpoint: str, droppable: bool):
+        now = time.monotonic()
+        allowance = _REPLY_ALLOWANCE.get()
+        if endpoint.startswith("edit"):
+            # Правки не создают новых сообщений: для них только порядок в чате, глобальный лимит и flood wait
+            chat_tat, chat_wait = state[0], 0.0
+        elif allowance is not None and allowance[0] == chat_id and allowance[1] > 0:
+            # Первые ответы на апдейт пользователя — без паузы; темп всё равно учитываем для последующих отправок
+            allowance[1] -= 1
+            interval = self.group_interval if chat_id < 0 else self.private_interval
+            chat_tat, chat_wait = max(state[0], now) + interval, 0.0
+        else:
+            interval = self.group_interval if chat_id < 0 else self.private_interval
+            chat_tat, chat_wait = self._reserve(state[0], interval, self.burst, now)
+        chat_wait = max(chat_wait, state[1] - now)
+        if droppable and chat_wait > 0:
+            # Промежуточную правку (стрим) лучше пропустить, чем задержать — следующая всё равно её перекроет
+            self.dropped += 1
+            raise RetryAfter(max(1, int(chat_wait + 0.999)))
+        state[0] = chat_tat
+        if chat_wait > 0:
+            await asyncio.sleep(chat_wait)
+        # Глобальный слот берём только в момент готовности чата, иначе ждущий чат сдвигает очередь всем остальным
+        now_ready = time.monotonic()
+        global_tat, global_wait = self._reserve(self.global_tat, self.global_interval, self.burst, now_ready)
+        if droppable and global_wait > 0:
+            # Общий лимит исчерпан — промежуточная правка уступает место настоящим сообщениям
+            self.dropped += 1
+            raise RetryAfter(max(1, int(global_wait + 0.999)))
+        self.global_tat = global_tat
+        if global_wait > 0:
+            await asyncio.sleep(global_wait)
+        wait = chat_wait + global_wait
+        if wait > 0:
+            self.wait_total += wait
+            TELEGRAM_DISPATCH_WAIT.observe(wait)
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if not isinstance(chat_id, int) or not endpoint.startswith(TELEGRAM_THROTTLED_PREFIXES):
+            return await callback(*args, **kwargs)
+        droppable = bool(rate_limit_args and rate_limit_args.get('droppable'))
+        state = self._chat(chat_id)
+        state[3] += 1
+        try:
+            async with state[2]:
+                attempt = 0
+                while True:
+                    await self._throttle(state, chat_id, endpoint, droppable)
+                    try:
+                        result = await callback(*args, **kwargs)
+                        self.sent += 1
+                        return result
+                    except RetryAfter as e:
+                        self.flood_waits += 1
+                        TELEGRAM_FLOOD_WAITS.inc(endpoint)
+                        retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                        state[1] = time.monotonic() + retry_after
+                        if droppable or attempt >= self.max_retries:
+                            raise
+                        attempt += 1
+                        self.retries += 1
+                        logger.warning(f"Flood wait {retry_after:.0f} с в чате {chat_id} ({endpoint}), повтор {attempt}/{self.max_retries}")
+        finally:
+            state[3] -= 1
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'chats': len(self.chats),
+            'active': sum(state[3] for state in self.chats.values()),
+            'sent': self.sent,
+            'dropped_stream_edits': self.dropped,
+            'flood_waits': self.flood_waits,
+            'retries': self.retries,
+            'wait_time_total': self.wait_total,
+        }
+
 class LRUCache:
     def __init__(self, max_size: int = 1000):
         self.cache = OrderedDict()
@@ -52,35 +466,1542 @@ class LRUCache:
         return key in self.cache
 
 class RateLimiter:
-    def __init__(self, max_requests: int = 10, window_seconds: int = 60):
-        self.requests = {}
-        self.max_requests = max_requests
-        self.window = window_seconds
-    def is_allowed(self, user_id: int) -> bool:
-        now = time.time()
-        if user_id not in self.requests:
-            self.requests[user_id] = []
-        user_requests = [req_time for req_time in self.requests[user_id] 
-                        if now - req_time < self.window]
-        if len(user_requests) < self.max_requests:
-            user_requests.append(now)
-            self.requests[user_id] = user_requests
+    def __init__(self, limits: Dict[str, Dict[str, tuple]] = RATE_LIMITS, idle_ttl: float = RATE_LIMIT_IDLE_TTL):
+        self.limits = limits
+        self.idle_ttl = idle_ttl
+        # (user_id, инструмент) → [токены, время обновления]; порядок — от самых давно активных
+        self.buckets: OrderedDict = OrderedDict()
+        self.rejections = 0
+        self.evictions = 0
+        self.sweeper: Optional[asyncio.Task] = None
+    def get_limit(self, user_id: int, tool: str) -> tuple:
+        tier = self.limits['premium'] if user_id in PREMIUM_USER_IDS else self.limits['free']
+        return tier.get(tool, tier['default'])
+    def is_allowed(self, user_id: int, tool: str = 'default') -> bool:
+        capacity, period = self.get_limit(user_id, tool)
+        now = time.monotonic()
+        key = (user_id, tool)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = [float(capacity), now]
+            self.buckets[key] = bucket
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * capacity / period)
+            bucket[1] = now
+            self.buckets.move_to_end(key)
+        if bucket[0] >= 1:
+            bucket[0] -= 1
             return True
-        self.requests[user_id] = user_requests
+        self.rejections += 1
         return False
+    def evict_idle(self) -> int:
+        deadline = time.monotonic() - self.idle_ttl
+        evicted = 0
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if bucket[1] > deadline:
+                break
+            del self.buckets[key]
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+    async def run(self):
+        while True:
+            await asyncio.sleep(min(60.0, self.idle_ttl))
+            self.evict_idle()
+    def start(self):
+        self.sweeper = asyncio.create_task(self.run())
+    async def stop(self):
+        if self.sweeper:
+            self.sweeper.cancel()
+            await asyncio.gather(self.sweeper, return_exceptions=True)
+
+class TokenBudgetExceeded(Exception):
+    pass
+
+class TokenBudget:
+    def __init__(self, tokens_per_minute: int = GROQ_TOKENS_PER_MINUTE):
+        self.capacity = float(tokens_per_minute)
+        self.rate = tokens_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.rejections = 0
+        self.consumed = 0
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    async def acquire(self, estimate: int, timeout: float = LLM_BUDGET_WAIT):
+        if self.capacity <= 0:
+            return
+        # Запрос больше всего бюджета всё равно пропускаем, когда бюджет полон, иначе он не пройдёт никогда
+        needed = min(float(estimate), self.capacity)
+        deadline = time.monotonic() + timeout
+        while True:
+            self._refill()
+            if self.tokens >= needed:
+                self.tokens -= estimate
+                return
+            wait = (needed - self.tokens) / self.rate
+            if time.monotonic() + wait > deadline:
+                self.rejections += 1
+                raise TokenBudgetExceeded(f"Бюджет токенов исчерпан, нужно {estimate}, доступно {int(self.tokens)}")
+            await asyncio.sleep(wait)
+    def reconcile(self, estimate: int, actual: Optional[int]):
+        if actual is None:
+            actual = estimate
+        self.consumed += actual
+        if self.capacity > 0:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + estimate - actual)
+    def available_share(self) -> float:
+        if self.capacity <= 0:
+            return 1.0
+        self._refill()
+        return max(0.0, self.tokens) / self.capacity
+
+# Шум, не меняющий смысл вопроса: эмодзи и знаки препинания/кавычки по краям слов.
+# Операторы и знаки (+ - * / < > = % #) остаются: «2+2» и «2-2» — разные вопросы
+_CACHE_EMOJI_RE = re.compile(r"[\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF\uFE0F\u200D\u20E3]+")
+_CACHE_EDGE_PUNCT = r"[.,!?;:…\"'«»„“”()\[\]{}]+"
+_CACHE_NOISE_RE = re.compile(rf"(?<!\S){_CACHE_EDGE_PUNCT}|{_CACHE_EDGE_PUNCT}(?!\S)")
+_CACHE_SPACE_RE = re.compile(r"\s+")
+_CACHE_NUMBER_RE = re.compile(r"[-+]?\d+(?:[.,]\d+)?%?")
+_MINHASH_PRIME = (1 << 61) - 1
+_MINHASH_SEEDS = [
+    (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), 'big') % _MINHASH_PRIME | 1,
+     int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), 'big') % _MINHASH_PRIME)
+    for i in range(AI_CACHE_MINHASH_BANDS * AI_CACHE_MINHASH_ROWS)
+]
+
+def normalize_query(text: str) -> str:
+    text = unicodedata.normalize('NFKC', text).casefold().replace('ё', 'е')
+    text = _CACHE_SPACE_RE.sub(' ', _CACHE_EMOJI_RE.sub(' ', text)).strip()
+    normalized = _CACHE_SPACE_RE.sub(' ', _CACHE_NOISE_RE.sub('', text)).strip()
+    return normalized or _CACHE_SPACE_RE.sub(' ', text).strip()
+
+def make_cache_key(prompt_key: str, user_query: str) -> str:
+    content = f"{prompt_key}:{normalize_query(user_query)}"
+    return hashlib.md5(content.encode()).hexdigest()
+
+class CacheEntry:
+    __slots__ = ('key', 'prompt_key', 'response', 'shingles', 'numbers', 'bands', 'expires_at', 'size')
+    def __init__(self, key: str, prompt_key: str, response: str, shingles: frozenset,
+                 numbers: tuple, bands: List[tuple], expires_at: float):
+        self.key = key
+        self.prompt_key = prompt_key
+        self.response = response
+        self.shingles = shingles
+        self.numbers = numbers
+        self.bands = bands
+        self.expires_at = expires_at
+        self.size = len(response.encode()) + 8 * len(shingles) + 200
+
+class DiskResponseCache:
+    def __init__(self, path: str = AI_CACHE_DB_PATH, max_bytes: int = AI_CACHE_DISK_MAX_BYTES,
+                 ttl: float = AI_CACHE_TTL, eviction: str = AI_CACHE_DISK_EVICTION):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.eviction_order = "hits ASC, last_access ASC" if eviction == "lfu" else "last_access ASC"
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, prompt_key TEXT NOT NULL, query TEXT NOT NULL, value BLOB NOT NULL, "
+            "size INTEGER NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self.bytes_used = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+    def get(self, key: str) -> Optional[tuple]:
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT prompt_key, query, value, created_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[3] + self.ttl <= now:
+                self._delete(key)
+                return None
+            self.conn.execute("UPDATE entries SET last_access = ?, hits = hits + 1 WHERE key = ?", (now, key))
+        return row[0], row[1], zlib.decompress(row[2]).decode()
+    def put(self, key: str, prompt_key: str, query: str, response: str, created_at: Optional[float] = None):
+        value = zlib.compress(response.encode(), 6)
+        size = len(value) + len(query.encode()) + 64
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self.lock:
+            self._delete(key)
+            self.conn.execute(
+                "INSERT INTO entries (key, prompt_key, query, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, prompt_key, query, value, size, created_at or now, now)
+            )
+            self.bytes_used += size
+            if self.bytes_used > self.max_bytes:
+                # Освобождаем с запасом в 10%, чтобы не вытеснять по одной записи на каждую вставку
+                self._evict(int(self.max_bytes * 0.9))
+    def _delete(self, key: str):
+        row = self.conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+        if row:
+            self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.bytes_used -= row[0]
+    def _evict(self, target: int) -> int:
+        removed = 0
+        rows = self.conn.execute(f"SELECT key, size FROM entries ORDER BY {self.eviction_order}").fetchall()
+        self.conn.execute("BEGIN")
+        for key, size in rows:
+            if self.bytes_used <= target:
+                break
+            self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.bytes_used -= size
+            removed += 1
+        self.conn.execute("COMMIT")
+        return removed
+    def prune(self, max_bytes: Optional[int] = None, older_than: Optional[float] = None,
+              prompt_key: Optional[str] = None) -> int:
+        removed = 0
+        with self.lock:
+            conditions, params = ["created_at <= ?"], [time.time() - (older_than if older_than is not None else self.ttl)]
+            if prompt_key:
+                conditions.append("prompt_key = ?")
+                params.append(prompt_key)
+            where = " AND ".join(conditions)
+            freed = self.conn.execute(f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries WHERE {where}", params).fetchone()
+            self.conn.execute(f"DELETE FROM entries WHERE {where}", params)
+            removed += freed[0]
+            self.bytes_used -= freed[1]
+            if max_bytes is not None and self.bytes_used > max_bytes:
+                removed += self._evict(max_bytes)
+        return removed
+    def entries(self, prompt_key: Optional[str] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        query = "SELECT key, prompt_key, query, value, size, created_at, last_access, hits FROM entries"
+        params: List[Any] = []
+        if prompt_key:
+            query += " WHERE prompt_key = ?"
+            params.append(prompt_key)
+        query += " ORDER BY last_access DESC"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [
+            {'key': r[0], 'prompt_key': r[1], 'query': r[2], 'response': zlib.decompress(r[3]).decode(),
+             'size': r[4], 'created_at': r[5], 'last_access': r[6], 'hits': r[7]}
+            for r in rows
+        ]
+    def warm_from_file(self, path: str) -> int:
+        loaded = 0
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                # Ключ строится так же, как в живом пути: сначала чистка и редактирование ПДн, потом нормализация
+                query = sanitize_user_input(item['query'])
+                key = make_cache_key(item['prompt_key'], query)
+                self.put(key, item['prompt_key'], normalize_query(query), item['response'], item.get('created_at'))
+                loaded += 1
+        return loaded
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            count, hits = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM entries").fetchone()
+        return {'entries': count, 'bytes': self.bytes_used, 'max_bytes': self.max_bytes, 'hits': hits, 'path': self.path}
+    def close(self):
+        with self.lock:
+            self.conn.close()
 
 class AIResponseCache:
-    def __init__(self, max_size: int = 100):
-        self.cache = LRUCache(max_size)
+    def __init__(self, max_bytes: int = AI_CACHE_MAX_BYTES, ttl: float = AI_CACHE_TTL,
+                 near_duplicates: bool = AI_CACHE_NEAR_DUPLICATES,
+                 threshold: float = AI_CACHE_SIMILARITY_THRESHOLD, l2: Optional[DiskResponseCache] = None):
+        self.l2 = l2
+        self.l2_hits = 0
+        self.entries: OrderedDict = OrderedDict()
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.near_duplicates = near_duplicates
+        self.threshold = threshold
+        # LSH: (prompt_key, номер полосы, хэш полосы) → ключи записей
+        self.index: Dict[tuple, Set[str]] = {}
+        self.bytes_used = 0
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
     def get_cache_key(self, prompt_key: str, user_query: str) -> str:
-        content = f"{prompt_key}:{user_query}"
-        return hashlib.md5(content.encode()).hexdigest()
+        return make_cache_key(prompt_key, user_query)
+    def _fingerprint(self, normalized: str) -> tuple:
+        numbers = tuple(sorted(_CACHE_NUMBER_RE.findall(normalized)))
+        if not self.near_duplicates or len(normalized) < AI_CACHE_MIN_NEAR_LENGTH:
+            return frozenset(), numbers, []
+        size = AI_CACHE_SHINGLE_SIZE
+        shingles = frozenset(
+            zlib.crc32(normalized[i:i + size].encode()) for i in range(len(normalized) - size + 1)
+        )
+        signature = [min((a * h + b) % _MINHASH_PRIME for h in shingles) for a, b in _MINHASH_SEEDS]
+        rows = AI_CACHE_MINHASH_ROWS
+        bands = [(band, hash(tuple(signature[band * rows:(band + 1) * rows]))) for band in range(AI_CACHE_MINHASH_BANDS)]
+        return shingles, numbers, bands
+    def _remove(self, entry: CacheEntry):
+        self.entries.pop(entry.key, None)
+        self.bytes_used -= entry.size
+        for band in entry.bands:
+            bucket = self.index.get((entry.prompt_key,) + band)
+            if bucket is not None:
+                bucket.discard(entry.key)
+                if not bucket:
+                    del self.index[(entry.prompt_key,) + band]
+    def _live(self, key: str, now: float) -> Optional[CacheEntry]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= now:
+            self._remove(entry)
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry
+    def _peek(self, key: str, now: float) -> Optional[CacheEntry]:
+        # Как _live, но без подъёма в LRU: кандидаты, которые только смотрим, не должны вытеснять других
+        entry = self.entries.get(key)
+        if entry is not None and entry.expires_at <= now:
+            self._remove(entry)
+            self.expirations += 1
+            return None
+        return entry
+    def _find_near_duplicate(self, prompt_key: str, shingles: frozenset, numbers: tuple,
+                             bands: List[tuple], now: float) -> Optional[CacheEntry]:
+        candidates: Set[str] = set()
+        for band in bands:
+            candidates |= self.index.get((prompt_key,) + band, set())
+        best, best_score = None, self.threshold
+        for key in candidates:
+            entry = self._peek(key, now)
+            # Разные числа — это разные вопросы ("цена 300" и "цена 3000"), такое не подменяем
+            if entry is None or entry.numbers != numbers:
+                continue
+            score = len(shingles & entry.shingles) / len(shingles | entry.shingles)
+            if score >= best_score:
+                best, best_score = entry, score
+        if best is not None:
+            self.entries.move_to_end(best.key)
+        return best
+    def _get_l1(self, key: str, prompt_key: str, user_query: str) -> tuple:
+        now = time.monotonic()
+        entry = self._live(key, now)
+        if entry is not None:
+            return entry.response, False
+        if self.near_duplicates and self.index:
+            shingles, numbers, bands = self._fingerprint(normalize_query(user_query))
+            if bands:
+                entry = self._find_near_duplicate(prompt_key, shingles, numbers, bands, now)
+                if entry is not None:
+                    return entry.response, True
+        return None, False
     def get_cached_response(self, prompt_key: str, user_query: str) -> Optional[str]:
+        response, near = self._get_l1(self.get_cache_key(prompt_key, user_query), prompt_key, user_query)
+        if response is None:
+            self.misses += 1
+        elif near:
+            self.near_hits += 1
+        else:
+            self.hits += 1
+        return response
+    async def lookup(self, prompt_key: str, user_query: str) -> Optional[str]:
         key = self.get_cache_key(prompt_key, user_query)
-        return self.cache.get(key)
-    def cache_response(self, prompt_key: str, user_query: str, response: str):
+        response, near = self._get_l1(key, prompt_key, user_query)
+        if response is not None:
+            if near:
+                self.near_hits += 1
+            else:
+                self.hits += 1
+            return response
+        if self.l2 is not None:
+            try:
+                stored = await asyncio.to_thread(self.l2.get, key)
+            except Exception as e:
+                logger.error(f"Ошибка чтения L2-кэша: {e}")
+                stored = None
+            if stored is not None:
+                self.l2_hits += 1
+                self._store_l1(key, prompt_key, user_query, stored[2])
+                return stored[2]
+        self.misses += 1
+        return None
+    async def store(self, prompt_key: str, user_query: str, response: str):
         key = self.get_cache_key(prompt_key, user_query)
-        self.cache.set(key, response)
+        self._store_l1(key, prompt_key, user_query, response)
+        if self.l2 is not None:
+            try:
+                await asyncio.to_thread(self.l2.put, key, prompt_key, normalize_query(user_query), response)
+            except Exception as e:
+                logger.error(f"Ошибка записи L2-кэша: {e}")
+    def cache_response(self, prompt_key: str, user_query: str, response: str):
+        self._store_l1(self.get_cache_key(prompt_key, user_query), prompt_key, user_query, response)
+    def _store_l1(self, key: str, prompt_key: str, user_query: str, response: str):
+        if key in self.entries:
+            self._remove(self.entries[key])
+        shingles, numbers, bands = self._fingerprint(normalize_query(user_query))
+        entry = CacheEntry(key, prompt_key, response, shingles, numbers, bands, time.monotonic() + self.ttl)
+        if entry.size > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.bytes_used += entry.size
+        for band in bands:
+            self.index.setdefault((prompt_key,) + band, set()).add(key)
+        while self.bytes_used > self.max_bytes:
+            self._remove(next(iter(self.entries.values())))
+            self.evictions += 1
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.near_hits + self.l2_hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes_used,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'near_hits': self.near_hits,
+            'l2_hits': self.l2_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': (self.hits + self.near_hits + self.l2_hits) / lookups if lookups else 0.0,
+        }
+
+class LLMScheduler:
+    def __init__(self, initial: int = LLM_INITIAL_CONCURRENCY, min_limit: int = LLM_MIN_CONCURRENCY,
+                 max_limit: int = LLM_MAX_CONNECTIONS):
+        self.limit = float(min(initial, max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.active = 0
+        self.waiters: List[tuple] = []
+        self.seq = itertools.count()
+        self.paused_until = 0.0
+        self.wake_handle: Optional[asyncio.TimerHandle] = None
+        self.last_decrease = 0.0
+        self.rate_limited = 0
+        self.retries = 0
+    async def acquire(self, priority: int):
+        if not self.waiters and self.active < int(self.limit) and time.monotonic() >= self.paused_until:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.seq), future))
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+    def release(self):
+        self.active -= 1
+        self._wake()
+    def _wake(self):
+        now = time.monotonic()
+        if now < self.paused_until:
+            if self.wake_handle is None:
+                def resume():
+                    self.wake_handle = None
+                    self._wake()
+                self.wake_handle = asyncio.get_running_loop().call_later(self.paused_until - now, resume)
+            return
+        while self.waiters and self.active < int(self.limit):
+            _, _, future = heapq.heappop(self.waiters)
+            if future.cancelled():
+                continue
+            self.active += 1
+            future.set_result(None)
+    def _decrease(self, factor: float):
+        # Одна волна ошибок от параллельных запросов должна уменьшить лимит один раз, а не N
+        now = time.monotonic()
+        if now - self.last_decrease >= 1.0:
+            self.limit = max(float(self.min_limit), self.limit * factor)
+            self.last_decrease = now
+    def on_success(self, latency: float, call_type: str):
+        if latency > LLM_LATENCY_TARGETS.get(call_type, LLM_LATENCY_TARGETS['chat']):
+            self._decrease(0.9)
+        else:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self._wake()
+    def on_failure(self, error: Exception, attempt: int, call_type: str) -> Optional[float]:
+        if isinstance(error, RateLimitError):
+            self.rate_limited += 1
+            self._decrease(0.5)
+            retry_after = None
+            try:
+                retry_after = float(error.response.headers.get('retry-after'))
+            except (TypeError, ValueError, AttributeError):
+                pass
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        elif isinstance(error, (APIConnectionError, InternalServerError)):
+            self._decrease(0.9)
+            retry_after = None
+        else:
+            return None
+        if attempt + 1 >= LLM_MAX_ATTEMPTS.get(call_type, LLM_MAX_ATTEMPTS['chat']):
+            return None
+        self.retries += 1
+        backoff = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+        return max(backoff, retry_after or 0.0)
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'limit': round(self.limit, 2),
+            'active': self.active,
+            'waiting': sum(1 for _, _, f in self.waiters if not f.done()),
+            'paused_for': max(0.0, self.paused_until - time.monotonic()),
+            'rate_limited': self.rate_limited,
+            'retries': self.retries,
+        }
+
+def estimate_tokens(text: str) -> int:
+    # Грубая локальная оценка: для смеси кириллицы и латиницы у llama ~3 символа на токен
+    return len(text) // 3 + 1
+
+def estimate_request_tokens(messages: List[Dict[str, str]], call_type: str) -> int:
+    prompt_tokens = sum(estimate_tokens(m['content']) + 4 for m in messages)
+    return prompt_tokens + LLM_EXPECTED_COMPLETION_TOKENS.get(call_type, LLM_EXPECTED_COMPLETION_TOKENS['chat'])
+
+# Ошибки, которые говорят о проблеме модели или провайдера, а не запроса: по ним откатываемся и считаем отказы
+LLM_MODEL_FAILURES = (RateLimitError, APIConnectionError, InternalServerError, NotFoundError)
+
+class ModelHealth:
+    # Скользящая статистика модели и автомат выключения: closed → open (отказы) → half_open (одна проба) → closed
+    def __init__(self, model: str):
+        self.model = model
+        # (время, тип вызова, задержка, успех, поток): у потока задержка — до первого токена, у complete() — до конца ответа
+        self.samples: deque = deque(maxlen=LLM_ROUTER_SAMPLES)
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+        self.trips = 0
+    def _trim(self, now: float):
+        while self.samples and self.samples[0][0] < now - LLM_ROUTER_WINDOW:
+            self.samples.popleft()
+    def available(self, now: float) -> bool:
+        if self.state == 'open' and now - self.opened_at >= LLM_BREAKER_COOLDOWN:
+            self.state = 'half_open'
+            self.probe_started = 0.0
+        if self.state == 'half_open':
+            # Одна проба за раз; зависшая проба не держит модель выключенной дольше ещё одного периода
+            return now - self.probe_started >= LLM_BREAKER_COOLDOWN
+        return self.state == 'closed'
+    def begin(self, now: float):
+        if self.state == 'half_open':
+            self.probe_started = now
+    def record(self, now: float, call_type: str, latency: float, ok: bool, stream: bool = False):
+        if self.state == 'half_open':
+            if not ok:
+                self._open(now)
+                return
+            self.state = 'closed'
+            self.samples.clear()
+        self.samples.append((now, call_type, latency, ok, stream))
+        self._trim(now)
+        if not ok and self.state == 'closed' and len(self.samples) >= LLM_BREAKER_MIN_CALLS:
+            failures = sum(1 for sample in self.samples if not sample[3])
+            if failures >= LLM_BREAKER_ERROR_RATE * len(self.samples):
+                self._open(now)
+    def _open(self, now: float):
+        self.state = 'open'
+        self.opened_at = now
+        self.trips += 1
+        logger.warning(f"Модель {self.model} выключена на {LLM_BREAKER_COOLDOWN:.0f} с: слишком много отказов")
+    def latency(self, call_type: str, q: float, now: float, min_samples: int = LLM_BREAKER_MIN_CALLS,
+                stream: Optional[bool] = None) -> Optional[float]:
+        # stream=None — по всем вызовам; True/False — только по потокам или только по complete()
+        self._trim(now)
+        values = sorted(latency for _, kind, latency, ok, streamed in self.samples
+                        if ok and kind == call_type and (stream is None or streamed == stream))
+        if len(values) < min_samples:
+            return None
+        return values[min(len(values) - 1, int(q / 100 * len(values)))]
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        self._trim(now)
+        latencies = sorted(sample[2] for sample in self.samples if sample[3])
+        return {
+            'state': self.state,
+            'calls': len(self.samples),
+            'errors': sum(1 for sample in self.samples if not sample[3]),
+            'p50': latencies[len(latencies) // 2] if latencies else 0.0,
+            'p99': latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] if latencies else 0.0,
+            'trips': self.trips,
+        }
+
+class ModelRouter:
+    def __init__(self, tiers: Dict[str, List[str]] = LLM_MODEL_TIERS, routes: Dict[str, str] = LLM_ROUTES,
+                 default_tier: str = LLM_DEFAULT_TIER):
+        self.tiers = {name: list(dict.fromkeys(chain)) for name, chain in tiers.items() if chain}
+        self.routes = routes
+        self.default_tier = default_tier
+        self.models: Dict[str, ModelHealth] = {}
+        self.fallbacks = 0
+    def tier(self, call_type: str, tag: Optional[str]) -> str:
+        # Фоновые вызовы помечены «инструмент_назначение» (skilltrainer_prefetch) — маршрут у них как у инструмента
+        tool = (tag or '').split('_', 1)[0]
+        for key in (f"{tool}/{call_type}", tool, call_type):
+            if key in self.routes:
+                return self.routes[key]
+        return self.default_tier
+    def health(self, model: str) -> ModelHealth:
+        if model not in self.models:
+            self.models[model] = ModelHealth(model)
+        return self.models[model]
+    def chain(self, call_type: str, tag: Optional[str]) -> List[str]:
+        # Модели уровня по порядку: сначала укладывающиеся в цель по задержке, затем медленные; выключенные пропускаем
+        chain = self.tiers.get(self.tier(call_type, tag)) or self.tiers.get(self.default_tier) or [LLM_MODEL]
+        target = LLM_LATENCY_TARGETS.get(call_type, LLM_LATENCY_TARGETS['chat'])
+        now = time.monotonic()
+        ready, slow = [], []
+        for model in chain:
+            health = self.health(model)
+            if not health.available(now):
+                continue
+            p95 = health.latency(call_type, 95, now)
+            (slow if p95 is not None and p95 > target else ready).append(model)
+        # Выключена вся цепочка — пробуем первую модель: попытка лучше гарантированного отказа
+        return ready + slow or chain[:1]
+    def primary(self, call_type: str, tag: Optional[str]) -> str:
+        # Первая модель цепочки с закрытым автоматом — только чтение: состояние автоматов не меняется
+        chain = self.tiers.get(self.tier(call_type, tag)) or self.tiers.get(self.default_tier) or [LLM_MODEL]
+        return next((model for model in chain if model not in self.models or self.models[model].state == 'closed'), chain[0])
+    def begin(self, model: str):
+        self.health(model).begin(time.monotonic())
+    def record(self, model: str, call_type: str, latency: float, ok: bool, stream: bool = False):
+        self.health(model).record(time.monotonic(), call_type, latency, ok, stream)
+    def stats(self) -> Dict[str, Any]:
+        return {'fallbacks': self.fallbacks, 'models': {model: health.stats() for model, health in self.models.items()}}
+
+class HedgeBudget:
+    # Как бюджет повторов: каждый хеджируемый вызов добавляет ratio жетона, второй запрос тратит целый
+    def __init__(self, ratio: float = LLM_HEDGE_BUDGET, burst: float = LLM_HEDGE_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self.requests = 0
+        self.sent = 0
+        self.won = 0
+        self.rejected = 0
+    def on_request(self):
+        self.requests += 1
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+    def try_spend(self) -> bool:
+        if self.tokens < 1.0:
+            self.rejected += 1
+            return False
+        self.tokens -= 1.0
+        self.sent += 1
+        return True
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'sent': self.sent,
+            'won': self.won,
+            'rejected': self.rejected,
+            'hedge_rate': self.sent / self.requests if self.requests else 0.0,
+        }
+
+class LLMClient:
+    def __init__(self, api_key: str, max_connections: int = LLM_MAX_CONNECTIONS, max_keepalive: int = LLM_MAX_KEEPALIVE,
+                 budget: Optional[TokenBudget] = None, router: Optional[ModelRouter] = None):
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive),
+            timeout=httpx.Timeout(max(LLM_TIMEOUTS.values()), connect=LLM_CONNECT_TIMEOUT)
+        )
+        # Повторы делает планировщик, у SDK они отключены
+        self.client = AsyncGroq(api_key=api_key, http_client=self.http_client, max_retries=0)
+        self.scheduler = LLMScheduler(max_limit=max_connections)
+        self.budget = budget or TokenBudget(0)
+        self.router = router or ModelRouter()
+        self.hedges = HedgeBudget()
+    def _request(self, messages: List[Dict[str, str]], call_type: str, model: str,
+                 max_tokens: Optional[int], timeout: Optional[float], stream: bool, fallback: bool = False):
+        timeout = timeout or LLM_TIMEOUTS.get(call_type, LLM_TIMEOUTS['chat'])
+        if fallback:
+            # Пока в цепочке есть запасная модель, ждать дольше цели по задержке нет смысла
+            timeout = min(timeout, LLM_LATENCY_TARGETS.get(call_type, LLM_LATENCY_TARGETS['chat']))
+        return self.client.chat.completions.create(
+            messages=messages,
+            model=model,
+            max_tokens=max_tokens or LLM_MAX_TOKENS.get(call_type, LLM_MAX_TOKENS['chat']),
+            timeout=timeout,
+            stream=stream
+        )
+    async def _scheduled(self, call_type: str, tag: str, model: Optional[str],
+                         make_request: Callable[[str, bool], Awaitable[Any]], priority: Optional[int] = None) -> tuple:
+        # Возвращает (ответ, время старта, модель) с занятым слотом планировщика; слот освобождает вызывающий.
+        # Явно заданная модель не маршрутизируется; иначе отказ модели сразу переводит запрос на следующую в цепочке
+        if priority is None:
+            priority = LLM_PRIORITIES.get(call_type, LLM_PRIORITIES['chat'])
+        explicit = model is not None
+        chain = [model] if explicit else self.router.chain(call_type, tag)
+        index = 0
+        attempt = 0
+        while True:
+            model = chain[index]
+            await self.scheduler.acquire(priority)
+            self.router.begin(model)
+            started = time.monotonic()
+            try:
+                return await make_request(model, index + 1 < len(chain)), started, model
+            except asyncio.CancelledError:
+                self.scheduler.release()
+                raise
+            except Exception as e:
+                self.scheduler.release()
+                GROQ_REQUESTS.inc(tag, call_type, type(e).__name__)
+                if isinstance(e, LLM_MODEL_FAILURES):
+                    self.router.record(model, call_type, time.monotonic() - started, ok=False)
+                    if index + 1 < len(chain):
+                        index += 1
+                        self.router.fallbacks += 1
+                        LLM_FALLBACKS.inc(model, chain[index], type(e).__name__)
+                        logger.warning(f"Groq {call_type}: {model} — {type(e).__name__}, переключаюсь на {chain[index]}")
+                        continue
+                delay = self.scheduler.on_failure(e, attempt, call_type)
+                if delay is None:
+                    raise
+                logger.warning(f"Groq {call_type}: {type(e).__name__}, повтор через {delay:.1f} с (попытка {attempt + 2})")
+                await asyncio.sleep(delay)
+                attempt += 1
+                if not explicit:
+                    # После паузы цепочка могла измениться: часть моделей выключилась или восстановилась
+                    chain = self.router.chain(call_type, tag)
+                    index = 0
+    def _record_usage(self, tag: str, estimate: int, usage):
+        if usage is not None:
+            GROQ_TOKENS.inc(tag, 'prompt', amount=usage.prompt_tokens)
+            GROQ_TOKENS.inc(tag, 'completion', amount=usage.completion_tokens)
+        self.budget.reconcile(estimate, usage.total_tokens if usage is not None else None)
+    def hedge_delay(self, call_type: str, tag: str, model: Optional[str], stream: bool = False) -> Optional[float]:
+        if not LLM_HEDGE_ENABLED:
+            return None
+        model = model or self.router.primary(call_type, tag)
+        # Поток хеджируется по задержке первого токена, complete() — по времени полного ответа: окна не смешиваем
+        observed = self.router.health(model).latency(call_type, LLM_HEDGE_PERCENTILE, time.monotonic(),
+                                                     LLM_HEDGE_MIN_SAMPLES, stream)
+        return None if observed is None else max(LLM_HEDGE_MIN_DELAY, observed)
+    def _may_hedge(self) -> bool:
+        # Под нагрузкой второй запрос только удлинит очередь; бюджет токенов не отдаём хеджам до дна
+        if any(not f.done() for _, _, f in self.scheduler.waiters) or self.budget.available_share() < BACKGROUND_TOKEN_RESERVE:
+            self.hedges.rejected += 1
+            return False
+        return self.hedges.try_spend()
+    async def _hedged(self, call_type: str, tag: str, model: Optional[str], run: Callable[[], Awaitable[Any]],
+                      discard: Optional[Callable[[Any], Awaitable[None]]] = None, stream: bool = False) -> Any:
+        # Первый успешный из двух одинаковых запросов побеждает, второй отменяется
+        self.hedges.on_request()
+        delay = self.hedge_delay(call_type, tag, model, stream)
+        started = time.monotonic()
+        tasks = [asyncio.ensure_future(run())]
+        winner = None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self._may_hedge():
+                    LLM_HEDGES.inc(call_type, 'sent')
+                    tasks.append(asyncio.ensure_future(run()))
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in tasks if task in done and task.exception() is None), None)
+            if winner is None:
+                # Оба упали — отдаём ошибку основного запроса
+                return tasks[0].result()
+            if len(tasks) > 1:
+                outcome = 'won' if winner is tasks[1] else 'lost'
+                if outcome == 'won':
+                    self.hedges.won += 1
+                LLM_HEDGES.inc(call_type, outcome)
+                LLM_HEDGED_LATENCY.observe(time.monotonic() - started, call_type, 'hedge' if outcome == 'won' else 'primary')
+            return winner.result()
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if discard and task.done() and not task.cancelled() and task.exception() is None:
+                    await discard(task.result())
+                task.cancel()
+    async def complete(self, messages: List[Dict[str, str]], call_type: str = 'chat',
+                       model: Optional[str] = None, max_tokens: Optional[int] = None,
+                       timeout: Optional[float] = None, tag: Optional[str] = None, hedge: bool = False,
+                       priority: Optional[int] = None) -> str:
+        # hedge=True — только для идемпотентных вызовов: повтор того же запроса ничего не меняет, кроме расхода токенов
+        tag = tag or call_type
+        if hedge:
+            return await self._hedged(call_type, tag, model,
+                                      lambda: self._complete(messages, call_type, model, max_tokens, timeout, tag, priority))
+        return await self._complete(messages, call_type, model, max_tokens, timeout, tag, priority)
+    async def _complete(self, messages: List[Dict[str, str]], call_type: str, model: Optional[str],
+                        max_tokens: Optional[int], timeout: Optional[float], tag: str, priority: Optional[int]) -> str:
+        estimate = estimate_request_tokens(messages, call_type)
+        await self.budget.acquire(estimate)
+        settled = False
+        try:
+            chat_completion, started, model = await self._scheduled(
+                call_type, tag, model,
+                lambda model, fallback: self._request(messages, call_type, model, max_tokens, timeout, False, fallback), priority
+            )
+            self.scheduler.release()
+            latency = time.monotonic() - started
+            self.scheduler.on_success(latency, call_type)
+            self.router.record(model, call_type, latency, ok=True)
+            GROQ_LATENCY.observe(latency, tag, call_type)
+            GROQ_REQUESTS.inc(tag, call_type, 'ok')
+            settled = True
+            self._record_usage(tag, estimate, chat_completion.usage)
+            return chat_completion.choices[0].message.content
+        finally:
+            if not settled:
+                # Ошибка, таймаут или отмена (проигравший хедж): резерв целиком возвращается в бюджет
+                self.budget.reconcile(estimate, 0)
+    async def stream(self, messages: List[Dict[str, str]], call_type: str = 'chat',
+                     model: Optional[str] = None, max_tokens: Optional[int] = None,
+                     timeout: Optional[float] = None, tag: Optional[str] = None, hedge: bool = False) -> AsyncIterator[str]:
+        tag = tag or call_type
+        if not hedge:
+            # Закрываем явно: брошенный потребителем генератор иначе держит слот и резерв токенов до сборки мусора
+            chunks = self._stream(messages, call_type, model, max_tokens, timeout, tag)
+            try:
+                async for delta in chunks:
+                    yield delta
+            finally:
+                await chunks.aclose()
+            return
+        # Потоки соревнуются до первого токена; проигравший закрывается, дальше читаем победителя
+        async def open_stream() -> tuple:
+            chunks = self._stream(messages, call_type, model, max_tokens, timeout, tag)
+            try:
+                return await chunks.__anext__(), chunks
+            except StopAsyncIteration:
+                return "", chunks
+            except BaseException:
+                await chunks.aclose()
+                raise
+        first, chunks = await self._hedged(call_type, tag, model, open_stream,
+                                           discard=lambda opened: opened[1].aclose(), stream=True)
+        try:
+            if first:
+                yield first
+            async for delta in chunks:
+                yield delta
+        finally:
+            await chunks.aclose()
+    async def _stream(self, messages: List[Dict[str, str]], call_type: str, model: Optional[str],
+                      max_tokens: Optional[int], timeout: Optional[float], tag: str) -> AsyncIterator[str]:
+        estimate = estimate_request_tokens(messages, call_type)
+        await self.budget.acquire(estimate)
+        usage = None
+        settled = False
+        try:
+            # Повторять можно только до первого токена: 429 и ошибки соединения приходят на этапе открытия потока
+            chunks, started, model = await self._scheduled(
+                call_type, tag, model,
+                lambda model, fallback: self._request(messages, call_type, model, max_tokens, timeout, True, fallback)
+            )
+            try:
+                first_token_at = None
+                async for chunk in chunks:
+                    if chunk.x_groq and chunk.x_groq.usage:
+                        usage = chunk.x_groq.usage
+                    elif chunk.usage:
+                        usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if first_token_at is None:
+                            first_token_at = time.monotonic()
+                        yield chunk.choices[0].delta.content
+            except Exception as e:
+                GROQ_REQUESTS.inc(tag, call_type, type(e).__name__)
+                if isinstance(e, LLM_MODEL_FAILURES):
+                    self.router.record(model, call_type, time.monotonic() - started, ok=False, stream=True)
+                raise
+            finally:
+                self.scheduler.release()
+                await chunks.close()
+            latency = (first_token_at or time.monotonic()) - started
+            self.scheduler.on_success(latency, call_type)
+            self.router.record(model, call_type, latency, ok=True, stream=True)
+            GROQ_LATENCY.observe(latency, tag, call_type)
+            GROQ_REQUESTS.inc(tag, call_type, 'ok')
+            settled = True
+            self._record_usage(tag, estimate, usage)
+        finally:
+            if not settled:
+                # Поток не дочитан: ошибка, отмена или потребитель закрыл его раньше — резерв возвращается в бюджет
+                self.budget.reconcile(estimate, 0)
+    async def close(self):
+        await self.http_client.aclose()
+
+class SingleFlight:
+    def __init__(self):
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.leaders = 0
+        self.shared = 0
+        self.shared_failures = 0
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> tuple:
+        while key in self.inflight:
+            future = self.inflight[key]
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Отменили лидера, а не нас — становимся лидером сами
+                if future.cancelled() and not asyncio.current_task().cancelling():
+                    continue
+                raise
+            except Exception:
+                self.shared_failures += 1
+                raise
+            self.shared += 1
+            return result, True
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.inflight[key] = future
+        self.leaders += 1
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'inflight': len(self.inflight),
+            'leaders': self.leaders,
+            'upstream_calls_saved': self.shared,
+            'shared_failures': self.shared_failures,
+        }
+
+class Conversation:
+    __slots__ = ('summary', 'summary_tokens', 'messages', 'tokens', 'updated_at', 'compacting')
+    def __init__(self):
+        self.summary = ""
+        self.summary_tokens = 0
+        # (роль, текст, оценка токенов) — от старых к новым
+        self.messages: List[tuple] = []
+        self.tokens = 0
+        self.updated_at = time.monotonic()
+        self.compacting: Optional[asyncio.Task] = None
+
+class ConversationMemory:
+    def __init__(self, token_budget: int = CONVERSATION_TOKEN_BUDGET, idle_ttl: float = CONVERSATION_IDLE_TTL,
+                 keep_messages: int = CONVERSATION_KEEP_MESSAGES):
+        self.token_budget = token_budget
+        self.idle_ttl = idle_ttl
+        self.keep_messages = keep_messages
+        # (user_id, инструмент) → Conversation; порядок — от самых давно активных
+        self.conversations: OrderedDict = OrderedDict()
+        self.compactions = 0
+        self.compaction_failures = 0
+        self.dropped_messages = 0
+        self.evictions = 0
+        self.sweeper: Optional[asyncio.Task] = None
+    def get(self, user_id: int, tool: str) -> Optional[Conversation]:
+        conversation = self.conversations.get((user_id, tool))
+        if conversation and time.monotonic() - conversation.updated_at > self.idle_ttl:
+            self.reset(user_id, tool)
+            return None
+        return conversation
+    def has_history(self, user_id: int, tool: str) -> bool:
+        conversation = self.get(user_id, tool)
+        return bool(conversation and (conversation.messages or conversation.summary))
+    def build_messages(self, user_id: int, tool: str, system_prompt: str, user_query: str) -> List[Dict[str, str]]:
+        # История берётся с конца, пока помещается в бюджет, — размер промпта ограничен при любой длине диалога
+        conversation = self.get(user_id, tool)
+        if not conversation:
+            return [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_query}]
+        budget = self.token_budget
+        system = system_prompt
+        if conversation.summary and conversation.summary_tokens <= budget:
+            system = f"{system_prompt}\n\nКратко о предыдущей части диалога: {conversation.summary}"
+            budget -= conversation.summary_tokens
+        history = []
+        for role, content, tokens in reversed(conversation.messages):
+            if tokens > budget:
+                break
+            history.append({"role": role, "content": content})
+            budget -= tokens
+        history.reverse()
+        return [{"role": "system", "content": system}, *history, {"role": "user", "content": user_query}]
+    def append(self, user_id: int, tool: str, user_query: str, response: str):
+        if self.token_budget <= 0:
+            return
+        key = (user_id, tool)
+        conversation = self.get(user_id, tool)
+        if conversation is None:
+            conversation = self.conversations[key] = Conversation()
+        else:
+            self.conversations.move_to_end(key)
+        for role, content in (("user", user_query), ("assistant", response)):
+            tokens = estimate_tokens(content) + 4
+            conversation.messages.append((role, content, tokens))
+            conversation.tokens += tokens
+        conversation.updated_at = time.monotonic()
+        if conversation.tokens > self.token_budget and conversation.compacting is None:
+            conversation.compacting = asyncio.create_task(self.compact(key, conversation))
+    async def compact(self, key: tuple, conversation: Conversation):
+        # Старые реплики сворачиваются в сводку фоном, ответ пользователю не ждёт
+        count = max(0, len(conversation.messages) - self.keep_messages)
+        old = conversation.messages[:count]
+        try:
+            if not old:
+                return
+            transcript = "\n".join(f"{'Пользователь' if role == 'user' else 'Ассистент'}: {content}" for role, content, _ in old)
+            if conversation.summary:
+                transcript = f"Предыдущая сводка: {conversation.summary}\n\n{transcript}"
+            summary = conversation.summary
+            try:
+                if not llm_client:
+                    raise RuntimeError("Groq недоступен")
+                summary = (await llm_client.complete(
+                    [{"role": "system", "content": CONVERSATION_SUMMARY_PROMPT},
+                     {"role": "user", "content": transcript[-12000:]}],
+                    call_type='summary', tag='memory'
+                )).strip()
+                self.compactions += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Без сводки старые реплики просто отбрасываются — бюджет важнее полноты
+                self.compaction_failures += 1
+                logger.warning(f"Не удалось сжать диалог {key}: {type(e).__name__}: {e}")
+            if self.conversations.get(key) is not conversation:
+                return
+            # Пока шла сводка, в конец могли добавиться реплики — удаляем только сжатые
+            del conversation.messages[:count]
+            conversation.tokens -= sum(tokens for _, _, tokens in old)
+            conversation.summary = summary
+            conversation.summary_tokens = estimate_tokens(summary) + 4 if summary else 0
+            self.dropped_messages += count
+        finally:
+            conversation.compacting = None
+    def reset(self, user_id: int, tool: str):
+        conversation = self.conversations.pop((user_id, tool), None)
+        if conversation and conversation.compacting:
+            conversation.compacting.cancel()
+    def evict_idle(self) -> int:
+        deadline = time.monotonic() - self.idle_ttl
+        evicted = 0
+        while self.conversations:
+            key, conversation = next(iter(self.conversations.items()))
+            if conversation.updated_at > deadline:
+                break
+            self.reset(*key)
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+    async def run(self):
+        while True:
+            await asyncio.sleep(min(60.0, self.idle_ttl))
+            self.evict_idle()
+    def start(self):
+        self.sweeper = asyncio.create_task(self.run())
+    async def stop(self):
+        tasks = [c.compacting for c in self.conversations.values() if c.compacting]
+        if self.sweeper:
+            tasks.append(self.sweeper)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'conversations': len(self.conversations),
+            'messages': sum(len(c.messages) for c in self.conversations.values()),
+            'compactions': self.compactions,
+            'compaction_failures': self.compaction_failures,
+            'dropped_messages': self.dropped_messages,
+            'evictions': self.evictions,
+        }
+
+class BackgroundJobs:
+    # Спекулятивная работа не должна отнимать ресурсы у живых запросов: лишнее отклоняется, а не ставится в очередь
+    def __init__(self, max_jobs: int = BACKGROUND_MAX_JOBS, token_reserve: float = BACKGROUND_TOKEN_RESERVE,
+                 max_calls: int = BACKGROUND_MAX_CALLS):
+        self.max_jobs = max_jobs
+        self.token_reserve = token_reserve
+        self.max_calls = max_calls
+        self.calls = asyncio.Semaphore(max_calls)
+        self.tasks: Set[asyncio.Task] = set()
+        self.started: Dict[str, int] = {}
+        self.rejected = 0
+        self.failed = 0
+    def has_capacity(self) -> bool:
+        if not llm_client or len(self.tasks) >= self.max_jobs:
+            return False
+        # Живые запросы уже ждут слота планировщика или бюджет токенов на исходе — фон подождёт
+        if llm_client.scheduler.waiters:
+            return False
+        return llm_client.budget.available_share() >= self.token_reserve
+    def submit(self, kind: str, fn: Callable[[], Awaitable[Any]]) -> Optional[asyncio.Task]:
+        if not self.has_capacity():
+            self.rejected += 1
+            return None
+        task = asyncio.create_task(self._run(kind, fn))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        # Результат может так и не понадобиться — исключение забираем, чтобы не было «never retrieved»
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self.started[kind] = self.started.get(kind, 0) + 1
+        return task
+    async def complete(self, messages: List[Dict[str, str]], call_type: str, **kwargs) -> str:
+        # Каждый вызов Groq из фоновой задачи занимает свой слот и заново проверяет резерв бюджета:
+        # задача из нескольких запросов (разделы Finish Packet) не обходит лимиты фона
+        async with self.calls:
+            if llm_client.budget.available_share() < self.token_reserve:
+                raise TokenBudgetExceeded("резерв бюджета токенов оставлен живым запросам")
+            return await llm_client.complete(messages, call_type=call_type, priority=LLM_BACKGROUND_PRIORITY, **kwargs)
+    async def _run(self, kind: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            return await fn()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"Фоновая задача {kind} завершилась ошибкой: {type(e).__name__}: {e}")
+            raise
+    async def stop(self):
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'running': len(self.tasks),
+            'max_jobs': self.max_jobs,
+            'calls': self.max_calls - self.calls._value,
+            'started': dict(self.started),
+            'rejected': self.rejected,
+            'failed': self.failed,
+        }
+
+class StreamingReply:
+    def __init__(self, bot, chat_id: int, prefix: str = "", message=None,
+                 interval: float = STREAM_EDIT_INTERVAL, limit: int = STREAM_ROLLOVER_LENGTH):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.prefix = prefix
+        self.messages = [message] if message else []
+        self.rendered: List[str] = [""] * len(self.messages)
+        self.interval = interval
+        self.limit = limit
+        self.chunks: List[str] = []
+        self.frozen_upto = 0
+        self.last_edit = 0.0
+    async def start(self, placeholder: str, parse_mode: Optional[str] = None):
+        if self.messages:
+            await self._edit(0, placeholder, parse_mode=parse_mode)
+        else:
+            self.messages.append(await self.bot.send_message(self.chat_id, placeholder, parse_mode=parse_mode))
+            self.rendered.append(placeholder)
+    async def feed(self, delta: str):
+        self.chunks.append(delta)
+        now = time.monotonic()
+        if now - self.last_edit >= self.interval:
+            self.last_edit = now
+            try:
+                await self._render(cursor=True)
+            except TelegramError as e:
+                # Промежуточный показ — best effort, итог всё равно допишет finish()
+                logger.warning(f"Не удалось показать потоковый фрагмент: {e}")
+    @property
+    def text(self) -> str:
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0] if self.chunks else ""
+    async def _render(self, cursor: bool):
+        text = self.text
+        while True:
+            head = self.prefix if len(self.messages) <= 1 else ""
+            tail = text[self.frozen_upto:]
+            # Лимит Telegram — в единицах UTF-16: эмодзи занимают по две
+            budget = self.limit - utf16_len(head)
+            if utf16_len(tail) <= budget:
+                break
+            window = tail[:utf16_window_end(tail, 0, budget)]
+            cut = max(window.rfind('\n'), window.rfind(' '))
+            if cut < len(window) // 2:
+                cut = len(window)
+            await self._edit(len(self.messages) - 1, head + tail[:cut])
+            self.frozen_upto += cut
+            self.messages.append(await self.bot.send_message(self.chat_id, "…"))
+            self.rendered.append("…")
+        if tail:
+            await self._edit(len(self.messages) - 1, head + tail + (STREAM_CURSOR if cursor else ""), droppable=cursor)
+    async def _edit(self, index: int, text: str, parse_mode: Optional[str] = None, reply_markup=None,
+                    droppable: bool = False) -> bool:
+        if self.rendered[index] == text and reply_markup is None:
+            return True
+        try:
+            if droppable and getattr(self.bot, 'rate_limiter', None):
+                message = self.messages[index]
+                await self.bot.edit_message_text(text, chat_id=message.chat_id, message_id=message.message_id,
+                                                 parse_mode=parse_mode, reply_markup=reply_markup,
+                                                 rate_limit_args={'droppable': True})
+            else:
+                await self.messages[index].edit_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+        except RetryAfter:
+            return False
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return True
+            if parse_mode is None:
+                logger.warning(f"Не удалось обновить потоковое сообщение: {e}")
+                return False
+            # Markdown от модели может быть битым — повторяем без разметки
+            return await self._edit(index, text, reply_markup=reply_markup)
+        except TelegramError as e:
+            logger.warning(f"Не удалось обновить потоковое сообщение: {e}")
+            return False
+        self.rendered[index] = text
+        return True
+    async def finish(self, final_text: Optional[str] = None, parse_mode: Optional[str] = None, reply_markup=None):
+        if final_text is None:
+            final_text = self.prefix + self.text
+        parts = split_message_efficiently(final_text)
+        for i, part in enumerate(parts):
+            markup = reply_markup if i == len(parts) - 1 else None
+            if i < len(self.messages):
+                await self._edit(i, part, parse_mode=parse_mode, reply_markup=markup)
+            else:
+                try:
+                    message = await self.bot.send_message(self.chat_id, part, parse_mode=parse_mode, reply_markup=markup)
+                except BadRequest:
+                    message = await self.bot.send_message(self.chat_id, part, reply_markup=markup)
+                self.messages.append(message)
+                self.rendered.append(part)
+        for message in self.messages[len(parts):]:
+            try:
+                await message.delete()
+            except TelegramError:
+                pass
+        del self.messages[len(parts):]
+        del self.rendered[len(parts):]
+    async def fail(self, error_text: str, parse_mode: Optional[str] = None):
+        if not self.text and self.messages:
+            await self._edit(len(self.messages) - 1, error_text, parse_mode=parse_mode)
+            return
+        if self.messages:
+            await self._render(cursor=False)
+        await self.bot.send_message(self.chat_id, error_text, parse_mode=parse_mode)
+
+class UpdateQueue:
+    def __init__(self, process, workers: int = UPDATE_QUEUE_WORKERS, max_depth: int = UPDATE_QUEUE_MAX_DEPTH):
+        self.process = process
+        self.workers_count = workers
+        self.max_depth = max_depth
+        # Ключ пользователя лежит в pending, пока у него есть апдейты в очереди или в обработке,
+        # и в ready — только когда ни один воркер его не держит. Так порядок внутри пользователя сохраняется.
+        self.pending: Dict[int, deque] = {}
+        self.ready: Optional[asyncio.Queue] = None
+        self.workers: List[asyncio.Task] = []
+        self.depth = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.in_progress = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.last_wait_time = 0.0
+    def start(self):
+        self.ready = asyncio.Queue()
+        self.workers = [asyncio.create_task(self._worker(i)) for i in range(self.workers_count)]
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+    def put(self, key: int, item: Any) -> bool:
+        if self.ready is None or self.depth >= self.max_depth:
+            self.rejected += 1
+            return False
+        self.depth += 1
+        self.accepted += 1
+        queue = self.pending.get(key)
+        if queue is None:
+            self.pending[key] = deque([(time.monotonic(), item)])
+            self.ready.put_nowait(key)
+        else:
+            queue.append((time.monotonic(), item))
+        return True
+    async def _worker(self, index: int):
+        while True:
+            key = await self.ready.get()
+            queue = self.pending[key]
+            enqueued_at, item = queue.popleft()
+            self.depth -= 1
+            wait_time = time.monotonic() - enqueued_at
+            self.last_wait_time = wait_time
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+            UPDATE_QUEUE_WAIT.observe(wait_time)
+            self.in_progress += 1
+            try:
+                await self.process(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка обработки апдейта в воркере {index}: {e}")
+            finally:
+                self.in_progress -= 1
+                self.processed += 1
+                if queue:
+                    self.ready.put_nowait(key)
+                else:
+                    del self.pending[key]
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'users_pending': len(self.pending),
+            'in_progress': self.in_progress,
+            'workers': len(self.workers),
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'wait_time_avg': self.wait_time_total / self.processed if self.processed else 0.0,
+            'wait_time_max': self.wait_time_max,
+            'wait_time_last': self.last_wait_time,
+        }
+
+# Поля, которые при анонимизации заменяются или удаляются целиком
+_CAPTURE_NAME_FIELDS = ('first_name', 'last_name', 'username', 'title', 'bio')
+_CAPTURE_DROP_FIELDS = ('contact', 'location', 'venue', 'photo', 'document', 'voice', 'video', 'audio', 'sticker')
+_CAPTURE_ID_FIELDS = ('id', 'chat_id', 'user_id')
+
+class WebhookCapture:
+    def __init__(self, path: str, max_bytes: int = WEBHOOK_CAPTURE_MAX_BYTES, backups: int = WEBHOOK_CAPTURE_BACKUPS,
+                 anonymize: str = WEBHOOK_CAPTURE_ANONYMIZE, salt: str = WEBHOOK_CAPTURE_SALT,
+                 flush_interval: float = WEBHOOK_CAPTURE_FLUSH_INTERVAL, buffer_size: int = WEBHOOK_CAPTURE_BUFFER):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.anonymize = anonymize
+        self.salt = (salt or os.urandom(16).hex()).encode()
+        self.flush_interval = flush_interval
+        # webhook только кладёт (время, payload) в буфер; анонимизация, сериализация и запись — в фоне
+        self.buffer: deque = deque(maxlen=buffer_size)
+        self.flush_task: Optional[asyncio.Task] = None
+        self.captured = 0
+        self.dropped = 0
+        self.written = 0
+        self.rotations = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    def record(self, payload: Dict[str, Any]):
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+            return
+        self.buffer.append((time.time(), payload))
+        self.captured += 1
+    def pseudonymize(self, value: int) -> int:
+        digest = hashlib.blake2b(str(abs(value)).encode(), key=self.salt[:64], digest_size=6).digest()
+        pseudo = int.from_bytes(digest, 'big') or 1
+        return -pseudo if value < 0 else pseudo
+    def scrub(self, value: Any) -> Any:
+        if isinstance(value, list):
+            return [self.scrub(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+        result = {}
+        for key, item in value.items():
+            if key in _CAPTURE_DROP_FIELDS:
+                continue
+            if key in _CAPTURE_ID_FIELDS and isinstance(item, int) and not isinstance(item, bool):
+                result[key] = self.pseudonymize(item)
+            elif key in _CAPTURE_NAME_FIELDS and isinstance(item, str):
+                result[key] = "user"
+            elif key in ('text', 'caption') and isinstance(item, str) and self.anonymize == "full":
+                # Команды и числа сохраняем — от них зависит маршрутизация и калькулятор
+                result[key] = item if item.startswith('/') else re.sub(r'[^\W\d_]', 'x', item)
+            else:
+                result[key] = self.scrub(item)
+        return result
+    def encode(self, batch: List[tuple]) -> bytes:
+        lines = []
+        for arrived, payload in batch:
+            if self.anonymize != "off":
+                payload = self.scrub(payload)
+            lines.append(json.dumps({'t': round(arrived, 4), 'u': payload}, ensure_ascii=False, separators=(',', ':')))
+        # Каждый сброс — отдельный gzip-member; склеенные члены читаются gzip.open как один поток
+        return gzip.compress(("\n".join(lines) + "\n").encode('utf-8'))
+    def rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+    def write(self, batch: List[tuple]):
+        data = self.encode(batch)
+        if os.path.exists(self.path) and os.path.getsize(self.path) + len(data) > self.max_bytes:
+            self.rotate()
+        with open(self.path, 'ab') as f:
+            f.write(data)
+    async def flush(self):
+        if not self.buffer:
+            return
+        batch = list(self.buffer)
+        self.buffer.clear()
+        try:
+            await asyncio.to_thread(self.write, batch)
+            self.written += len(batch)
+        except Exception as e:
+            self.dropped += len(batch)
+            logger.error(f"Ошибка записи захвата webhook ({len(batch)} апдейтов): {e}")
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+    def start(self):
+        self.flush_task = asyncio.create_task(self.run())
+    async def stop(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+        await self.flush()
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'path': self.path,
+            'anonymize': self.anonymize,
+            'captured': self.captured,
+            'written': self.written,
+            'dropped': self.dropped,
+            'buffered': len(self.buffer),
+            'rotations': self.rotations,
+        }
+
+class StateStore(ABC):
+    @abstractmethod
+    def load(self, namespace: str, key: int) -> Optional[bytes]:
+        ...
+    @abstractmethod
+    def write_batch(self, items: List[tuple]):
+        ...
+    def close(self):
+        pass
+
+class MemoryStateStore(StateStore):
+    def __init__(self):
+        self.data: Dict[tuple, bytes] = {}
+    def load(self, namespace: str, key: int) -> Optional[bytes]:
+        return self.data.get((namespace, key))
+    def write_batch(self, items: List[tuple]):
+        for namespace, key, value in items:
+            if value is None:
+                self.data.pop((namespace, key), None)
+            else:
+                self.data[(namespace, key)] = value
+
+class SQLiteStateStore(StateStore):
+    def __init__(self, path: str = STATE_DB_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "ns TEXT NOT NULL, key INTEGER NOT NULL, value BLOB NOT NULL, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (ns, key)) WITHOUT ROWID"
+        )
+    def load(self, namespace: str, key: int) -> Optional[bytes]:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM state WHERE ns = ? AND key = ?", (namespace, key)).fetchone()
+        return row[0] if row else None
+    def write_batch(self, items: List[tuple]):
+        now = time.time()
+        upserts = [(namespace, key, value, now) for namespace, key, value in items if value is not None]
+        deletes = [(namespace, key) for namespace, key, value in items if value is None]
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                if upserts:
+                    self.conn.executemany("INSERT OR REPLACE INTO state (ns, key, value, updated_at) VALUES (?, ?, ?, ?)", upserts)
+                if deletes:
+                    self.conn.executemany("DELETE FROM state WHERE ns = ? AND key = ?", deletes)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class StateManager:
+    def __init__(self, store: StateStore, flush_interval: float = STATE_FLUSH_INTERVAL):
+        self.store = store
+        self.flush_interval = flush_interval
+        # Живые объекты, изменённые с последнего сброса; кодируются только в момент сброса,
+        # поэтому несколько изменений одного ключа сливаются в одну запись
+        self.dirty: Dict[tuple, Any] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.rows_written = 0
+    async def load(self, namespace: str, key: int) -> Optional[Any]:
+        if (namespace, key) in self.dirty:
+            return self.dirty[(namespace, key)]
+        raw = await asyncio.to_thread(self.store.load, namespace, key)
+        if raw is None:
+            return None
+        try:
+            return decode_state(raw)
+        except Exception as e:
+            logger.error(f"Не удалось прочитать состояние {namespace}/{key}: {e}")
+            return None
+    def mark_dirty(self, namespace: str, key: int, value: Any):
+        self.dirty[(namespace, key)] = value
+    def mark_deleted(self, namespace: str, key: int):
+        self.dirty[(namespace, key)] = None
+    async def flush(self):
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, {}
+        batch = []
+        for (namespace, key), value in dirty.items():
+            try:
+                batch.append((namespace, key, None if value is None else encode_state(value)))
+            except Exception as e:
+                logger.error(f"Не удалось сериализовать состояние {namespace}/{key}: {e}")
+        try:
+            await asyncio.to_thread(self.store.write_batch, batch)
+        except Exception as e:
+            logger.error(f"Ошибка записи состояния ({len(batch)} записей): {e}")
+            for (namespace, key), value in dirty.items():
+                self.dirty.setdefault((namespace, key), value)
+            return
+        self.flushes += 1
+        self.rows_written += len(batch)
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+    def start(self):
+        self.flush_task = asyncio.create_task(self.run())
+    async def stop(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+        await self.flush()
+        self.store.close()
 
 class BotState(Enum):
     MAIN_MENU = "main_menu"
@@ -116,9 +2037,23 @@ class SkillSession:
         self.progress: float = 0.0
         self.finish_packet: Optional[str] = None
         self.training_complete: bool = False
+        # Фоновые задачи живут только в памяти — to_state пропускает атрибуты с «_»
+        self._prefetch: Dict[TrainingMode, tuple] = {}
+        self._finish_job: Optional[tuple] = None
+    def cancel_finish_job(self):
+        if self._finish_job:
+            self._finish_job[0].cancel()
+            self._finish_job = None
+    def cancel_background(self):
+        for task, _, _ in self._prefetch.values():
+            task.cancel()
+        self._prefetch.clear()
+        self.cancel_finish_job()
     def update_progress(self):
         self.progress = min(1.0, (self.current_step + 1) / self.max_steps)
     def add_answer(self, step: int, answer: str):
+        # Ответы — вход Finish Packet: заготовленный заранее больше не годится
+        self.cancel_finish_job()
         self.answers[step] = answer
         self.current_step = step + 1
         self.update_progress()
@@ -129,24 +2064,117 @@ class SkillSession:
             self.last_hint = hint
     def is_gate_passed(self, gate_id: str) -> bool:
         return gate_id in self.gates_passed
+    def to_state(self) -> Dict[str, Any]:
+        return {k: v for k, v in vars(self).items() if not k.startswith('_')}
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> 'SkillSession':
+        session = cls(state['user_id'])
+        session.__dict__.update(state)
+        return session
+
+class SkillSessionMap:
+    def __init__(self, state: StateManager, checked_size: int = 10000):
+        self.state = state
+        self.sessions: Dict[int, SkillSession] = {}
+        # Пользователи, для которых уже сходили в хранилище; ограничено, чтобы не расти бесконечно
+        self.checked = LRUCache(max_size=checked_size)
+    async def ensure_loaded(self, user_id: int):
+        if user_id in self.sessions or user_id in self.checked:
+            return
+        session = await self.state.load('session', user_id)
+        self.checked.set(user_id, True)
+        if session is not None and user_id not in self.sessions:
+            self.sessions[user_id] = session
+    def mark_dirty(self, user_id: int):
+        if user_id in self.sessions:
+            self.state.mark_dirty('session', user_id, self.sessions[user_id])
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.sessions
+    def __getitem__(self, user_id: int) -> SkillSession:
+        return self.sessions[user_id]
+    def __setitem__(self, user_id: int, session: SkillSession):
+        previous = self.sessions.get(user_id)
+        if previous is not None and previous is not session:
+            previous.cancel_background()
+        self.sessions[user_id] = session
+        self.checked.set(user_id, True)
+        self.state.mark_dirty('session', user_id, session)
+    def __delitem__(self, user_id: int):
+        self.sessions.pop(user_id).cancel_background()
+        self.state.mark_deleted('session', user_id)
+    def __len__(self) -> int:
+        return len(self.sessions)
+    def get(self, user_id: int, default: Optional[SkillSession] = None) -> Optional[SkillSession]:
+        return self.sessions.get(user_id, default)
 
 # ==============================================================================
 # 2. ИНИЦИАЛИЗАЦИЯ
 # ==============================================================================
-groq_client: Optional[Groq] = None
+metrics = MetricsRegistry()
+WEBHOOK_LATENCY = metrics.histogram("bot_webhook_latency_seconds", "Время ответа webhook", ("status",))
+HANDLER_LATENCY = metrics.histogram("bot_handler_latency_seconds", "Время работы хендлера PTB", ("handler",))
+HANDLER_ERRORS = metrics.counter("bot_handler_errors_total", "Исключения в хендлерах PTB", ("handler",))
+UPDATE_QUEUE_WAIT = metrics.histogram("bot_update_queue_wait_seconds", "Время ожидания апдейта в очереди")
+GROQ_LATENCY = metrics.histogram("bot_groq_latency_seconds", "Время вызова Groq (для стрима — до первого токена)", ("prompt_key", "call_type"))
+GROQ_REQUESTS = metrics.counter("bot_groq_requests_total", "Вызовы Groq по исходу", ("prompt_key", "call_type", "outcome"))
+GROQ_TOKENS = metrics.counter("bot_groq_tokens_total", "Токены Groq по данным usage", ("prompt_key", "kind"))
+TELEGRAM_API_LATENCY = metrics.histogram("bot_telegram_api_latency_seconds", "Время исходящих вызовов Bot API", ("method",))
+TELEGRAM_API_ERRORS = metrics.counter("bot_telegram_api_errors_total", "Ошибки исходящих вызовов Bot API", ("method", "code"))
+TELEGRAM_DISPATCH_WAIT = metrics.histogram("bot_telegram_dispatch_wait_seconds", "Ожидание исходящего сообщения в лимитах Telegram")
+FINISH_SECTIONS = metrics.counter("bot_finish_packet_sections_total", "Разделы Finish Packet по исходу", ("section", "outcome"))
+SKILLTRAINER_PRECOMPUTE = metrics.counter("bot_skilltrainer_precompute_total", "Заранее подготовленные ответы SKILLTRAINER по исходу",
+                                          ("kind", "outcome"))
+PII_REDACTIONS = metrics.counter("bot_pii_redactions_total", "Замены персональных данных во входящем тексте", ("kind",))
+LLM_FALLBACKS = metrics.counter("bot_llm_fallbacks_total", "Переходы запроса на следующую модель цепочки",
+                                ("from_model", "to_model", "reason"))
+LLM_HEDGES = metrics.counter("bot_llm_hedges_total", "Хеджирующие запросы: отправлен, выиграл, проиграл основному",
+                             ("call_type", "outcome"))
+LLM_HEDGED_LATENCY = metrics.histogram("bot_llm_hedged_latency_seconds", "Время вызовов с хеджем от старта основного запроса",
+                                       ("call_type", "winner"))
+TELEGRAM_FLOOD_WAITS = metrics.counter("bot_telegram_flood_waits_total", "Ответы Telegram 429 (flood wait)", ("method",))
+
+llm_client: Optional[LLMClient] = None
 if GROQ_API_KEY:
     try:
-        groq_client = Groq(api_key=GROQ_API_KEY)
-        logger.info("Groq client initialized successfully")
+        llm_client = LLMClient(api_key=GROQ_API_KEY, budget=TokenBudget(GROQ_TOKENS_PER_MINUTE))
+        logger.info(f"Async Groq client initialized successfully (tiers={llm_client.router.tiers}, pool={LLM_MAX_CONNECTIONS})")
     except Exception as e:
         logger.error(f"Ошибка инициализации Groq клиента: {type(e).__name__}")
 else:
     logger.warning("GROQ_API_KEY не установлен. Функции AI будут недоступны.")
 
+if STATE_BACKEND == "sqlite":
+    try:
+        state_store: StateStore = SQLiteStateStore(STATE_DB_PATH)
+        logger.info(f"State store: SQLite WAL ({STATE_DB_PATH})")
+    except Exception as e:
+        logger.error(f"Не удалось открыть SQLite ({STATE_DB_PATH}): {e}. Состояние будет только в памяти.")
+        state_store = MemoryStateStore()
+else:
+    state_store = MemoryStateStore()
+state_manager = StateManager(state_store)
+
 user_stats_cache = LRUCache(max_size=500)
-rate_limiter = RateLimiter(max_requests=15, window_seconds=60)
-ai_cache = AIResponseCache(max_size=100)
-active_skill_sessions: Dict[int, SkillSession] = {}
+rate_limiter = RateLimiter()
+ai_disk_cache: Optional[DiskResponseCache] = None
+if AI_CACHE_DISK_ENABLED:
+    try:
+        ai_disk_cache = DiskResponseCache(AI_CACHE_DB_PATH)
+        logger.info(f"AI cache L2: {AI_CACHE_DB_PATH} ({ai_disk_cache.bytes_used} / {AI_CACHE_DISK_MAX_BYTES} байт)")
+    except Exception as e:
+        logger.error(f"Не удалось открыть L2-кэш ({AI_CACHE_DB_PATH}): {e}")
+ai_cache = AIResponseCache(l2=ai_disk_cache)
+llm_singleflight = SingleFlight()
+conversation_memory = ConversationMemory()
+background_jobs = BackgroundJobs()
+webhook_capture: Optional[WebhookCapture] = None
+if WEBHOOK_CAPTURE_PATH:
+    try:
+        webhook_capture = WebhookCapture(WEBHOOK_CAPTURE_PATH)
+        logger.info(f"Захват webhook включён: {WEBHOOK_CAPTURE_PATH} (анонимизация: {WEBHOOK_CAPTURE_ANONYMIZE})")
+    except Exception as e:
+        logger.error(f"Не удалось включить захват webhook ({WEBHOOK_CAPTURE_PATH}): {e}")
+active_skill_sessions = SkillSessionMap(state_manager)
 
 # ==============================================================================
 # 3. КОНСТАНТЫ
@@ -171,6 +2199,71 @@ BENCHMARKS = {
     'чистая_маржа': {'низкая': 20, 'средняя': 30, 'высокая': 40}
 }
 
+CALCULATOR_WHATIF_BUTTON = "📈 Что если: цена и ACOS"
+# Сетка «что если»: цена ±30%, ACOS 0–30%, комиссия ±5 п.п. — ~40 тыс. сценариев на запрос
+WHATIF_PRICE_RANGE = (0.7, 1.3, 61)  # шаг 1%
+WHATIF_ACOS_RANGE = (0.0, 30.0, 31)
+WHATIF_COMMISSION_DELTA = (-5.0, 5.0, 21)
+WHATIF_TABLE_PRICE_STEPS = (-20, -10, 0, 10, 20)  # % к текущей цене
+WHATIF_TABLE_ACOS = (0, 5, 10, 15, 20)
+CALCULATOR_RISK_BUTTON = "🎲 Риск: Монте-Карло"
+# Диапазоны по умолчанию (± доля от введённого значения) и возвраты — их в пошаговом калькуляторе нет
+MONTE_CARLO_DEFAULT_SPREAD = {'cost': 0.1, 'price': 0.1, 'commission': 0.1, 'logistics': 0.3, 'acos': 0.5, 'tax': 0.0}
+MONTE_CARLO_DEFAULT_RETURNS = (0.0, 10.0)
+MONTE_CARLO_FIELD_TITLES = {
+    'cost': "Себестоимость", 'price': "Цена", 'commission': "Комиссия", 'logistics': "Логистика",
+    'acos': "ACOS", 'tax': "Налог", 'returns': "Возвраты",
+}
+MONTE_CARLO_RETURN_ALIASES = ('возврат', 'возвраты', 'выкуп', 'returns')
+MONTE_CARLO_PERCENTILES = (5, 25, 50, 75, 95)
+CALCULATOR_SHORT_TITLES = ("себестоимость", "цена", "комиссия", "логистика", "ACOS", "налог")
+# Основы слов для разбора «себестоимость 300, цена 1200, комиссия 15%...»: падежи и синонимы
+CALCULATOR_LABEL_STEMS = (
+    ('себест', 'закуп', 'cost'),
+    ('цен', 'прода', 'price'),
+    ('комис', 'commission', 'fee'),
+    ('логист', 'достав', 'fbs', 'logistics'),
+    ('acos', 'реклам', 'дрр', 'drr', 'ads'),
+    ('налог', 'усн', 'tax'),
+)
+CALCULATOR_ONESHOT_HINT = "⚡ Или всё сразу: «себестоимость 300, цена 1200, комиссия 15%, логистика 10%, ACOS 8%, налог 6%» либо шесть чисел через «;».\n"
+CALCULATOR_BULK_HINT = "📎 Много товаров? Пришлите CSV/XLSX с колонками себестоимость, цена, комиссия, логистика, ACOS, налог.\n"
+
+# (метрика, порог «выше», рекомендация, порог «ниже», рекомендация) — общие для одиночного и пакетного расчёта
+RECOMMENDATION_RULES = [
+    ('наценка_%', BENCHMARKS['наценка']['высокая'], "🚀 Отличная наценка! Товар имеет высокий потенциал прибыли",
+     BENCHMARKS['наценка']['низкая'], "📈 Низкая наценка. Рассмотрите повышение цены или поиск поставщика с лучшими условиями"),
+    ('комиссия_%', BENCHMARKS['комиссия_mp']['высокая'], "📊 Комиссия выше среднего. Рассмотрите маркетплейсы с меньшей комиссией",
+     BENCHMARKS['комиссия_mp']['низкая'], "💰 Низкая комиссия - хорошие условия!"),
+    ('логистика_%', BENCHMARKS['логистика']['высокая'], "🚚 Логистика дороговата. Ищите способы оптимизации доставки или упаковки",
+     BENCHMARKS['логистика']['низкая'], "📦 Логистика эффективна!"),
+    ('acos_%', BENCHMARKS['acos']['высокий'], "📢 Высокий ACOS. Оптимизируйте рекламные кампании или когорты",
+     BENCHMARKS['acos']['низкий'], "🎯 Эффективная реклама!"),
+    ('чистая_маржа_%', BENCHMARKS['чистая_маржа']['высокая'], "✅ Отличная рентабельность! Товар готов к масштабированию",
+     BENCHMARKS['чистая_маржа']['низкая'], "💸 Низкая рентабельность. Рассмотрите повышение цены или снижение закупочной стоимости"),
+]
+DEFAULT_RECOMMENDATION = "📊 Показатели в норме. Продолжайте в том же духе!"
+
+# Поля калькулятора в порядке CALCULATOR_STEPS и варианты заголовков колонок в файлах
+CALCULATOR_FIELDS = ('cost', 'price', 'commission', 'logistics', 'acos', 'tax')
+BULK_COLUMN_ALIASES = {
+    'cost': ('себестоимость', 'закупка', 'закупочная', 'cost'),
+    'price': ('цена', 'price'),
+    'commission': ('комиссия', 'commission', 'fee'),
+    'logistics': ('логистика', 'доставка', 'logistics', 'fbs'),
+    'acos': ('acos', 'реклама', 'рекламу', 'ads', 'drr', 'дрр'),
+    'tax': ('налог', 'усн', 'tax'),
+    'sku': ('sku', 'артикул', 'товар', 'наименование', 'название', 'name', 'id'),
+}
+BULK_RESULT_COLUMNS = [
+    ('SKU', None),
+    ('Себестоимость', 'себестоимость'), ('Цена', 'выручка'), ('Комиссия %', 'комиссия_%'),
+    ('Логистика %', 'логистика_%'), ('ACOS %', 'acos_%'), ('Налог %', 'налог_%'),
+    ('Комиссия', 'комиссия'), ('Логистика', 'логистика'), ('CM1', 'cm1'), ('Маржа CM1 %', 'маржа_cm1_%'),
+    ('Реклама', 'реклама'), ('CM2', 'cm2'), ('Маржа CM2 %', 'маржа_cm2_%'), ('Налог', 'налог'),
+    ('Чистая прибыль', 'чистая_прибыль'), ('Чистая маржа %', 'чистая_маржа_%'), ('Наценка %', 'наценка_%'),
+]
+
 SYSTEM_PROMPTS: Dict[str, str] = {
     'grimoire': "Действуй как таинственный Гримуар...",
     'negotiator': "Ты — тренер навыков. Задавай 5-7 вопросов для диагностики. Предлагай методики тренировок. Проводи сессии в разных режимах. Используй только обычный текст без форматирования.",
@@ -246,44 +2339,287 @@ SKILLTRAINER_GATES = {
     }
 }
 
+# (заголовок, что написать, max_tokens, запасной текст на случай таймаута или ошибки)
+FINISH_PACKET_SECTIONS = [
+    ("КРАТКАЯ ДИАГНОСТИКА", "основные выводы из ответов: сильные стороны, главный барьер, с чего начать", 350,
+     "Опирайтесь на свои ответы выше: выберите один главный барьер и начните работу с него."),
+    ("РЕКОМЕНДОВАННЫЕ МЕТОДИКИ", "3-5 конкретных методик для развития навыка, по 1-2 предложения о каждой", 600,
+     "Ежедневная 15-минутная практика в выбранном режиме и разбор одной реальной ситуации в день."),
+    ("ПЛАН ТРЕНИРОВОК", "понедельный план на 4 недели: цель недели и 2-3 упражнения", 700,
+     "Неделя 1 — основы, неделя 2 — отработка техник, неделя 3 — применение в реальных ситуациях, неделя 4 — закрепление и оценка."),
+    ("ИНСТРУМЕНТЫ И РЕСУРСЫ", "полезные инструменты, книги, курсы", 450,
+     "Ведите дневник практики и подберите одну книгу или курс по ключевому навыку из вашей цели."),
+    ("КРИТЕРИИ ПРОГРЕССА", "как отслеживать улучшения: измеримые признаки и частота оценки", 400,
+     "Раз в неделю оценивайте навык по шкале 1–10 и записывайте ситуации, где применили его."),
+    ("ЧЕК-ЛИСТ ПРОВЕРКИ", "5-7 пунктов, что проверить через 2 недели", 350,
+     "Через 2 недели проверьте: была ли практика регулярной, есть ли 3 успешных применения, вырос ли балл самооценки."),
+]
+
 # ==============================================================================
 # 4. ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # ==============================================================================
-def sanitize_user_input(text: str, max_length: int = 2000) -> str:
+STATE_ENUMS = {cls.__name__: cls for cls in (BotState, SessionState, TrainingMode)}
+
+def _to_plain(value: Any) -> Any:
+    if isinstance(value, Enum):
+        return {"$e": f"{type(value).__name__}.{value.name}"}
+    if isinstance(value, datetime):
+        return {"$t": value.timestamp()}
+    if isinstance(value, SkillSession):
+        return {"$k": _to_plain(value.to_state())}
+    if isinstance(value, (set, frozenset)):
+        return {"$s": [_to_plain(v) for v in value]}
+    if isinstance(value, dict):
+        if all(isinstance(k, str) for k in value):
+            return {k: _to_plain(v) for k, v in value.items()}
+        return {"$m": [[_to_plain(k), _to_plain(v)] for k, v in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [_to_plain(v) for v in value]
+    return value
+
+def _from_plain(value: Any) -> Any:
+    if isinstance(value, list):
+        return [_from_plain(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if len(value) == 1:
+        tag, payload = next(iter(value.items()))
+        if tag == "$e":
+            enum_name, member = payload.split('.', 1)
+            return STATE_ENUMS[enum_name][member]
+        if tag == "$t":
+            return datetime.fromtimestamp(payload)
+        if tag == "$k":
+            return SkillSession.from_state(_from_plain(payload))
+        if tag == "$s":
+            return {_from_plain(v) for v in payload}
+        if tag == "$m":
+            return {_from_plain(k): _from_plain(v) for k, v in payload}
+    return {k: _from_plain(v) for k, v in value.items()}
+
+def encode_state(value: Any) -> bytes:
+    raw = json.dumps(_to_plain(value), ensure_ascii=False, separators=(',', ':')).encode()
+    if len(raw) >= STATE_COMPRESS_THRESHOLD:
+        return b'z' + zlib.compress(raw, 6)
+    return b'j' + raw
+
+def decode_state(raw: bytes) -> Any:
+    raw = bytes(raw)
+    body = zlib.decompress(raw[1:]) if raw[:1] == b'z' else raw[1:]
+    return _from_plain(json.loads(body))
+
+PII_PLACEHOLDERS = {
+    'email': '[email]',
+    'phone': '[телефон]',
+    'card': '[карта]',
+    'snils': '[снилс]',
+    'account': '[счёт]',
+    'passport': '[паспорт]',
+}
+# Кандидаты ищутся одним проходом. Шаблон начинается с класса символов — sre пропускает обычный текст
+# быстрым поиском по классу, а не пробует ветки в каждой позиции; границу слова проверяет ретроспектива
+_PII_EMAIL = r"(?<=[A-Za-z0-9._%+-])(?<![A-Za-z0-9._%+-]{2})(?P<email>[A-Za-z0-9._%+-]*+@[\w-]+(?:\.[\w-]+)+)"
+_PII_NUMBER = r"(?<=[+(0-9])(?<![\w+][+(0-9])(?P<number>[0-9 ()-]{8,}[0-9](?!\w))"
+_PII_CANDIDATE_RE = re.compile(rf"[+(0-9](?:{_PII_NUMBER})")
+_PII_CANDIDATE_EMAIL_RE = re.compile(rf"[A-Za-z0-9._%+(-](?:{_PII_EMAIL}|{_PII_NUMBER})")
+# Разбор найденной цепочки цифр: в ней может оказаться несколько номеров подряд
+_PII_NUMBER_RE = re.compile(r"""(?<![0-9])(?:
+    (?P<snils>[0-9]{3}-[0-9]{3}-[0-9]{3}[ -][0-9]{2})
+  | (?P<phone>(?:\+7|8)[ -]?\(?[0-9]{3}\)?[ -]?[0-9]{3}[ -]?[0-9]{2}[ -]?[0-9]{2}
+      | \+[0-9]{1,3}[ -]?\(?[0-9]{1,4}\)?(?:[ -]?[0-9]){6,10}
+      | \(?9[0-9]{2}\)?[ -]?[0-9]{3}[ -]?[0-9]{2}[ -]?[0-9]{2})
+  | (?P<card>[0-9](?:[ -]?[0-9]){12,18})
+  | (?P<account>[0-9]{20})
+  | (?P<passport>[0-9]{2}[ ]?[0-9]{2}[ ][0-9]{6})
+)(?![0-9])""", re.VERBOSE)
+
+# Управляющие, форматирующие (кроме ZWJ — он склеивает составные эмодзи), приватные и суррогаты
+_INPUT_INVISIBLE_RE = re.compile("[\x00-\x1f\x7f-\x9f\xad\u0600-\u0605\u061c\u06dd\u070f\u180e\u200b\u200c\u200e\u200f"
+                                 "\u202a-\u202e\u2060-\u2064\u2066-\u206f\ufeff\ufff9-\ufffb\ue000-\uf8ff\ud800-\udfff"
+                                 "\U000f0000-\U0010ffff]+")
+_CARD_SEPARATORS = str.maketrans('', '', ' -')
+
+def luhn_valid(digits: str) -> bool:
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        n = ord(digit) - 48
+        if i % 2:
+            n = n * 2 - 9 if n > 4 else n * 2
+        total += n
+    return total % 10 == 0
+
+def _redact_number(match) -> str:
+    kind = match.lastgroup
+    if kind == 'card' and not luhn_valid(match.group().translate(_CARD_SEPARATORS)):
+        # Длинные суммы и артикулы не похожи на карту по контрольной цифре
+        return match.group()
+    PII_REDACTIONS.inc(kind)
+    return PII_PLACEHOLDERS[kind]
+
+def _redact_candidate(match) -> str:
+    if match.lastgroup == 'email':
+        PII_REDACTIONS.inc('email')
+        return PII_PLACEHOLDERS['email']
+    return _PII_NUMBER_RE.sub(_redact_number, match.group())
+
+def redact_pii(text: str) -> str:
+    pattern = _PII_CANDIDATE_EMAIL_RE if '@' in text else _PII_CANDIDATE_RE
+    return pattern.sub(_redact_candidate, text)
+
+def sanitize_user_input(text: str, max_length: int = 2000, redact: bool = PII_REDACTION_ENABLED) -> str:
     if not text:
         return ""
-    cleaned = ''.join(char for char in text if char.isprintable() or char in '\n\r\t')
-    return cleaned[:max_length]
+    # Пробелы схлопываются, пустые строки — до одной; split/splitlines работают на C и знают все юникодные пробелы
+    lines = []
+    blank = False
+    for line in text[:max_length].splitlines():
+        if not line.isprintable() or '  ' in line:
+            line = ' '.join(line.split())
+            if not line.isprintable():
+                line = _INPUT_INVISIBLE_RE.sub('', line)
+        line = line.strip(' ')
+        if not line:
+            blank = True
+            continue
+        if blank and lines:
+            lines.append('')
+        lines.append(line)
+        blank = False
+    text = '\n'.join(lines)
+    # После чистки пробелов текст обычно уже нормализован, и дорогой NFKC не нужен
+    if not unicodedata.is_normalized('NFKC', text):
+        text = unicodedata.normalize('NFKC', text)
+    if redact:
+        text = redact_pii(text)
+    return text[:max_length]
+
+def utf16_len(text: str) -> int:
+    # Лимиты Telegram (4096 на сообщение) считаются в UTF-16: эмодзи вне BMP занимают две единицы
+    return len(text.encode('utf-16-le')) // 2
+
+# Сущности, внутри которых резать нельзя: блоки и строки кода, ссылки, жирный и курсив
+_MARKDOWN_SPAN_RE = re.compile(r"(?s:```.*?```)|`[^`\n]+`|\[[^\]\n]*\]\([^)\n]*\)|\*\*[^\n]+?\*\*|__[^\n]+?__|\*[^*\n]+\*|_[^_\n]+_")
+# Границы по убыванию предпочтения: абзац, конец предложения, строка, слово; второе число — сдвиг точки разреза
+_SPLIT_BOUNDARIES = (
+    (("\n\n",), 0),
+    ((". ", "! ", "? ", "… ", ".\n", "!\n", "?\n"), 1),
+    (("\n",), 0),
+    ((" ",), 0),
+)
+_CODE_FENCE_CLOSE = "\n```"
+
+def utf16_window_end(text: str, start: int, budget: int) -> int:
+    # Наибольший end, при котором text[start:end] укладывается в budget единиц UTF-16 (но не меньше одного символа)
+    hi = min(len(text), start + budget)
+    if utf16_len(text[start:hi]) <= budget:
+        return hi
+    lo = start + 1
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if utf16_len(text[start:mid]) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
 
 def split_message_efficiently(text: str, max_length: int = 4096) -> List[str]:
-    if len(text) <= max_length:
+    # Один проход: каждое окно кодируется и просматривается константное число раз, окна сдвигаются минимум на половину.
+    # Каждая часть не длиннее max_length единиц UTF-16 (при max_length >= 2)
+    if utf16_len(text) <= max_length:
         return [text]
-    sentences = text.split('. ')
+    # Закрывающий ``` дописываем, только если он не съедает заметную долю лимита
+    fence_reserve = len(_CODE_FENCE_CLOSE) if max_length >= 4 * len(_CODE_FENCE_CLOSE) else 0
+    spans = [(m.start(), m.end()) for m in _MARKDOWN_SPAN_RE.finditer(text)]
+    span_starts = [start for start, _ in spans]
+    def containing(position: int) -> Optional[tuple]:
+        index = bisect.bisect_right(span_starts, position - 1) - 1
+        if index >= 0 and spans[index][0] < position < spans[index][1]:
+            return spans[index]
+        return None
     parts = []
-    current_part = ""
-    for sentence in sentences:
-        test_part = current_part + sentence + ". "
-        if len(test_part) <= max_length:
-            current_part = test_part
-        else:
-            if current_part:
-                parts.append(current_part.strip())
-            current_part = sentence + ". "
-    if current_part:
-        parts.append(current_part.strip())
-    final_parts = []
-    for part in parts:
-        if len(part) > max_length:
-            for i in range(0, len(part), max_length):
-                final_parts.append(part[i:i+max_length])
-        else:
-            final_parts.append(part)
-    return final_parts
+    length = len(text)
+    i = 0
+    while i < length:
+        span = containing(i)
+        head = ""
+        if span and text.startswith("```", span[0]):
+            # Продолжение разрезанного блока кода: заново открываем его с тем же языком
+            head = text[span[0]:text.find("\n", span[0], span[1]) + 1] or "```\n"
+            if utf16_len(head) + fence_reserve > max_length // 2:
+                # Заголовок блока слишком длинный, чтобы повторять его в каждой части, — продолжаем без него
+                head = ""
+        budget = max(1, max_length - utf16_len(head) - fence_reserve)
+        j = utf16_window_end(text, i, budget)
+        if j >= length:
+            parts.append(head + text[i:])
+            break
+        cut = None
+        min_cut = i + (j - i) // 2
+        for separators, shift in _SPLIT_BOUNDARIES:
+            limit = j
+            while cut is None:
+                found = max(text.rfind(separator, min_cut, limit) for separator in separators)
+                if found < 0:
+                    break
+                candidate = found + shift
+                inside = containing(candidate)
+                if inside is None:
+                    cut = candidate
+                else:
+                    limit = inside[0]
+            if cut is not None:
+                break
+        tail = ""
+        if cut is None:
+            inside = containing(j)
+            if inside and inside[0] > i:
+                # Сущность начинается в этом окне — переносим её целиком в следующую часть
+                cut = inside[0]
+            elif inside and text.startswith("```", inside[0]):
+                # Блок кода длиннее сообщения: режем по строке внутри и закрываем блок в этой части
+                newline = text.rfind("\n", i + 1, j)
+                cut = newline if newline > i + budget // 2 else j
+                tail = _CODE_FENCE_CLOSE[:fence_reserve]
+            else:
+                cut = j
+        if cut <= i:
+            # Граница не нашлась — режем по краю окна, но хотя бы на один символ вперёд
+            cut = j
+        part = (head + text[i:cut]).rstrip() + tail
+        if part.strip():
+            parts.append(part)
+        i = cut
+        if not containing(i):
+            while i < length and text[i] in " \n\t":
+                i += 1
+        elif text[i] == "\n":
+            i += 1
+    return parts
 
 def get_calculator_data_safe(context, index: int, default: float = 0.0) -> float:
     data = context.user_data.get('calculator_data', {})
     return data.get(index, default)
 
+_NUMBER_JUNK_RE = re.compile(r"[\s\u00a0\u202f'₽%]|руб\.?|р\.|rub", re.IGNORECASE)
+
+def parse_number(value: Any) -> Optional[float]:
+    # «1 200,50 ₽», «15%», «1.200,5» → число; None, если это не число
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if not isinstance(value, str):
+        return None
+    text = _NUMBER_JUNK_RE.sub("", value)
+    if ',' in text and '.' in text:
+        # Десятичный разделитель — тот, что стоит последним
+        text = text.replace('.', '').replace(',', '.') if text.rfind(',') > text.rfind('.') else text.replace(',', '')
+    else:
+        text = text.replace(',', '.')
+    try:
+        number = float(text)
+    except ValueError:
+        return None
+    return number if np.isfinite(number) else None
+
 def generate_hud(session: SkillSession) -> str:
     filled = int(session.progress * 10)
     progress_bar = f"[{'█' * filled}{'▒' * (10 - filled)}]"
@@ -358,6 +2694,10 @@ def format_finish_packet(session: SkillSession, ai_response: str) -> str:
 # 5. GROWTH, КАЛЬКУЛЯТОР, GROQ — стандартные функции (без изменений)
 # ==============================================================================
 async def get_usage_stats(user_id: int) -> Dict[str, Any]:
+    if user_id not in user_stats_cache:
+        stored = await state_manager.load('stats', user_id)
+        if stored is not None:
+            user_stats_cache.set(user_id, stored)
     if user_id not in user_stats_cache:
         user_stats_cache.set(user_id, {
             'tools_used': 0,
@@ -371,6 +2711,7 @@ async def get_usage_stats(user_id: int) -> Dict[str, Any]:
     stats = user_stats_cache.get(user_id)
     stats['last_active'] = datetime.now()
     user_stats_cache.set(user_id, stats)
+    state_manager.mark_dirty('stats', user_id, stats)
     return stats
 
 async def update_usage_stats(user_id: int, tool_type: str):
@@ -391,6 +2732,7 @@ async def update_usage_stats(user_id: int, tool_type: str):
     stats['tools_used'] = len(tools_used)
     stats['last_tool'] = tool_type
     user_stats_cache.set(user_id, stats)
+    state_manager.mark_dirty('stats', user_id, stats)
 
 async def show_usage_progress(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
@@ -474,29 +2816,111 @@ def calculate_economy_metrics(data):
         'наценка_%': наценка_процент
     }
 
+def calculate_economy_metrics_batch(data: np.ndarray) -> Dict[str, np.ndarray]:
+    # Те же формулы, что в calculate_economy_metrics, но над колонками массива (n, 6) за один проход
+    себестоимость, цена, комиссия_процент, логистика_процент, acos_процент, налог_процент = data.T
+    выручка = цена
+    комиссия = выручка * комиссия_процент / 100
+    логистика = выручка * логистика_процент / 100
+    cm1 = выручка - себестоимость - комиссия - логистика
+    реклама = выручка * acos_процент / 100
+    cm2 = cm1 - реклама
+    налог = выручка * налог_процент / 100
+    чистая_прибыль = cm2 - налог
+    есть_себестоимость = себестоимость > 0
+    есть_выручка = выручка > 0
+    делитель_себестоимости = np.where(есть_себестоимость, себестоимость, 1.0)
+    делитель_выручки = np.where(есть_выручка, выручка, 1.0)
+    return {
+        'выручка': выручка,
+        'себестоимость': себестоимость,
+        'комиссия': комиссия,
+        'комиссия_%': комиссия_процент,
+        'логистика': логистика,
+        'логистика_%': логистика_процент,
+        'cm1': cm1,
+        'маржа_cm1_%': np.where(есть_выручка, cm1 / делитель_выручки * 100, 0.0),
+        'реклама': реклама,
+        'acos_%': acos_процент,
+        'cm2': cm2,
+        'маржа_cm2_%': np.where(есть_выручка, cm2 / делитель_выручки * 100, 0.0),
+        'налог': налог,
+        'налог_%': налог_процент,
+        'чистая_прибыль': чистая_прибыль,
+        'чистая_маржа_%': np.where(есть_выручка, чистая_прибыль / делитель_выручки * 100, 0.0),
+        'наценка_%': np.where(есть_себестоимость, (цена - себестоимость) / делитель_себестоимости * 100, 0.0),
+    }
+
 def generate_recommendations(metrics):
     recommendations = []
-    if metrics['наценка_%'] > BENCHMARKS['наценка']['высокая']:
-        recommendations.append("🚀 Отличная наценка! Товар имеет высокий потенциал прибыли")
-    elif metrics['наценка_%'] < BENCHMARKS['наценка']['низкая']:
-        recommendations.append("📈 Низкая наценка. Рассмотрите повышение цены или поиск поставщика с лучшими условиями")
-    if metrics['комиссия_%'] > BENCHMARKS['комиссия_mp']['высокая']:
-        recommendations.append("📊 Комиссия выше среднего. Рассмотрите маркетплейсы с меньшей комиссией")
-    elif metrics['комиссия_%'] < BENCHMARKS['комиссия_mp']['низкая']:
-        recommendations.append("💰 Низкая комиссия - хорошие условия!")
-    if metrics['логистика_%'] > BENCHMARKS['логистика']['высокая']:
-        recommendations.append("🚚 Логистика дороговата. Ищите способы оптимизации доставки или упаковки")
-    elif metrics['логистика_%'] < BENCHMARKS['логистика']['низкая']:
-        recommendations.append("📦 Логистика эффективна!")
-    if metrics['acos_%'] > BENCHMARKS['acos']['высокий']:
-        recommendations.append("📢 Высокий ACOS. Оптимизируйте рекламные кампании или когорты")
-    elif metrics['acos_%'] < BENCHMARKS['acos']['низкий']:
-        recommendations.append("🎯 Эффективная реклама!")
-    if metrics['чистая_маржа_%'] > BENCHMARKS['чистая_маржа']['высокая']:
-        recommendations.append("✅ Отличная рентабельность! Товар готов к масштабированию")
-    elif metrics['чистая_маржа_%'] < BENCHMARKS['чистая_маржа']['низкая']:
-        recommendations.append("💸 Низкая рентабельность. Рассмотрите повышение цены или снижение закупочной стоимости")
-    return recommendations if recommendations else ["📊 Показатели в норме. Продолжайте в том же духе!"]
+    for metric, high, high_text, low, low_text in RECOMMENDATION_RULES:
+        if metrics[metric] > high:
+            recommendations.append(high_text)
+        elif metrics[metric] < low:
+            recommendations.append(low_text)
+    return recommendations if recommendations else [DEFAULT_RECOMMENDATION]
+
+def generate_recommendations_batch(metrics: Dict[str, np.ndarray]) -> List[str]:
+    columns = []
+    for metric, high, high_text, low, low_text in RECOMMENDATION_RULES:
+        values = metrics[metric]
+        columns.append(np.where(values > high, high_text, np.where(values < low, low_text, "")))
+    return ["; ".join(filter(None, row)) or DEFAULT_RECOMMENDATION for row in zip(*columns)]
+
+def classify_margin_batch(metrics: Dict[str, np.ndarray]) -> np.ndarray:
+    margin = metrics['чистая_маржа_%']
+    return np.select(
+        [metrics['чистая_прибыль'] < 0, margin < BENCHMARKS['чистая_маржа']['низкая'], margin > BENCHMARKS['чистая_маржа']['высокая']],
+        ["убыток", "низкая маржа", "отлично"],
+        "норма",
+    )
+
+# Число: пробелы и точки внутри допустимы только как разделители тысяч («1 200,50», «1.200,5»)
+_CALCULATOR_AMOUNT = r"\d{1,3}(?:[ \u00a0\u202f.]\d{3})+(?:[.,]\d+)?|\d+(?:[.,]\d+)?"
+_CALCULATOR_UNIT = r"(?:%|₽|руб\.?|р\.?)?"
+# Метка (слова) и число
+_CALCULATOR_LABELED_RE = re.compile(
+    rf"([a-zа-яё][a-zа-яё\s]*?)\s*[:=—–-]?\s*({_CALCULATOR_AMOUNT})\s*{_CALCULATOR_UNIT}",
+    re.IGNORECASE,
+)
+# Ровно одно значение: «1 200,50 ₽», «15%», «-300»
+_CALCULATOR_VALUE_RE = re.compile(rf"\s*(-?(?:{_CALCULATOR_AMOUNT}))\s*{_CALCULATOR_UNIT}\s*", re.IGNORECASE)
+_CALCULATOR_SEPARATORS_RE = re.compile(r"[;\n]|,\s")
+
+def parse_calculator_value(text: str) -> Optional[float]:
+    # «1200 150» — это не «1 200 150», а два числа без разделителя: такое не угадываем
+    match = _CALCULATOR_VALUE_RE.fullmatch(text)
+    return parse_number(match.group(1)) if match else None
+
+def match_calculator_label(label: str) -> Optional[int]:
+    # Смотрим с конца: в «цена после скидки» метка ближе к числу, чем начало фразы
+    for word in reversed(label.lower().split()):
+        for index, stems in enumerate(CALCULATOR_LABEL_STEMS):
+            if any(word.startswith(stem) for stem in stems):
+                return index
+    return None
+
+def parse_calculator_message(text: str, step: int = 0) -> Dict[int, float]:
+    values: Dict[int, float] = {}
+    for label, number in _CALCULATOR_LABELED_RE.findall(text):
+        index = match_calculator_label(label)
+        value = parse_number(number)
+        if index is not None and value is not None:
+            values[index] = value
+    if values:
+        return values
+    if re.search(r"[a-zа-яё]", text, re.IGNORECASE) or not _CALCULATOR_SEPARATORS_RE.search(text):
+        # Одно число (в том числе «1 200,50 ₽») — обычный пошаговый ввод
+        return {}
+    # Несколько значений — только через явные разделители; каждое — ровно одно число
+    numbers = [parse_calculator_value(chunk) for chunk in _CALCULATOR_SEPARATORS_RE.split(text) if chunk.strip()]
+    if len(numbers) < 2 or None in numbers:
+        return {}
+    # Шесть чисел — все поля по порядку; меньше — продолжаем с текущего шага
+    start_index = 0 if len(numbers) == len(CALCULATOR_STEPS) else step
+    if start_index + len(numbers) > len(CALCULATOR_STEPS):
+        return {}
+    return {start_index + i: value for i, value in enumerate(numbers)}
 
 async def calculate_and_show_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = [get_calculator_data_safe(context, i) for i in range(6)]
@@ -522,6 +2946,7 @@ async def calculate_and_show_results(update: Update, context: ContextTypes.DEFAU
     for rec in recommendations:
         report += f"• {rec}\n"
     keyboard = [
+        [KeyboardButton(CALCULATOR_WHATIF_BUTTON), KeyboardButton(CALCULATOR_RISK_BUTTON)],
         [KeyboardButton("🔄 Новый расчет")],
         [KeyboardButton("🔙 Назад")]
     ]
@@ -529,20 +2954,215 @@ async def calculate_and_show_results(update: Update, context: ContextTypes.DEFAU
     await update.message.reply_text(report, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
     await update_usage_stats(update.message.from_user.id, 'calculator')
 
+def solve_price_for_margin(cost, percent_costs, target_margin):
+    # Чистая маржа = 1 − Σ%/100 − себестоимость/цена ⇒ цена = себестоимость / (1 − Σ%/100 − маржа/100)
+    denominator = 1 - (percent_costs + target_margin) / 100
+    return np.where(denominator > 0, cost / np.where(denominator > 0, denominator, 1.0), np.inf)
+
+def solve_calculator_targets(data: List[float], target_margins: tuple = (0, BENCHMARKS['чистая_маржа']['низкая'],
+                                                                         BENCHMARKS['чистая_маржа']['средняя'])) -> Dict[str, Any]:
+    себестоимость, цена, комиссия, логистика, acos, налог = data
+    percent_costs = комиссия + логистика + acos + налог
+    prices = solve_price_for_margin(себестоимость, percent_costs, np.array(target_margins, dtype=float))
+    # Максимальный ACOS при текущей цене: всё, что остаётся после себестоимости и прочих процентов
+    acos_limits = 100 - (комиссия + логистика + налог) - 100 * себестоимость / цена - np.array(target_margins) if цена > 0 else None
+    return {
+        'target_margins': target_margins,
+        'prices': prices.tolist(),
+        'max_acos': acos_limits.tolist() if acos_limits is not None else None,
+    }
+
+def compute_sensitivity_grid(data: List[float]) -> Dict[str, np.ndarray]:
+    base = np.asarray(data, dtype=float)
+    prices = base[1] * np.linspace(*WHATIF_PRICE_RANGE)
+    acos_levels = np.linspace(*WHATIF_ACOS_RANGE)
+    commissions = np.clip(base[2] + np.linspace(*WHATIF_COMMISSION_DELTA), 0, None)
+    price_grid, acos_grid, commission_grid = np.meshgrid(prices, acos_levels, commissions, indexing='ij')
+    points = np.empty(price_grid.shape + (6,))
+    points[..., 0] = base[0]
+    points[..., 1] = price_grid
+    points[..., 2] = commission_grid
+    points[..., 3] = base[3]
+    points[..., 4] = acos_grid
+    points[..., 5] = base[5]
+    metrics = calculate_economy_metrics_batch(points.reshape(-1, 6))
+    return {
+        'prices': prices,
+        'acos': acos_levels,
+        'commissions': commissions,
+        'margin': metrics['чистая_маржа_%'].reshape(price_grid.shape),
+        'profit': metrics['чистая_прибыль'].reshape(price_grid.shape),
+    }
+
+def format_sensitivity_report(data: List[float]) -> str:
+    себестоимость, цена, комиссия, логистика, acos, налог = data
+    if цена <= 0:
+        return "❌ Для анализа чувствительности нужна цена больше нуля."
+    grid = compute_sensitivity_grid(data)
+    targets = solve_calculator_targets(data)
+    lines = ["📈 **ЧТО ЕСЛИ: ЦЕНА, ACOS, КОМИССИЯ**", "", "🎯 **ЦЕЛЕВЫЕ ЗНАЧЕНИЯ:**"]
+    for margin, price, max_acos in zip(targets['target_margins'], targets['prices'], targets['max_acos']):
+        label = "Безубыточность" if margin == 0 else f"Маржа {margin}%"
+        price_text = f"цена от {price:.0f} ₽" if np.isfinite(price) else "недостижимо при текущих %"
+        acos_text = f"ACOS до {max_acos:.1f}%" if max_acos > 0 else "ACOS не помещается"
+        lines.append(f"• {label}: {price_text}; при текущей цене {acos_text}")
+    # Таблица: чистая маржа при текущей комиссии, строки — цена, колонки — ACOS
+    commission_index = int(np.argmin(np.abs(grid['commissions'] - комиссия)))
+    header = "цена    ACOS" + "".join(f"{level:>6}%" for level in WHATIF_TABLE_ACOS)
+    rows = [header]
+    for step in WHATIF_TABLE_PRICE_STEPS:
+        price_index = int(np.argmin(np.abs(grid['prices'] - цена * (1 + step / 100))))
+        cells = []
+        for level in WHATIF_TABLE_ACOS:
+            acos_index = int(np.argmin(np.abs(grid['acos'] - level)))
+            cells.append(f"{grid['margin'][price_index, acos_index, commission_index]:>7.1f}")
+        rows.append(f"{grid['prices'][price_index]:>6.0f} {step:+3d}%" + "".join(cells))
+    lines += ["", "📊 **ЧИСТАЯ МАРЖА, %:**", "```", *rows, "```"]
+    profitable = float((grid['profit'] > 0).mean() * 100)
+    # Чувствительность: на сколько п.п. меняется маржа от +1 п.п. комиссии/ACOS и от +1% цены
+    price_effect = 100 * себестоимость / цена * (1 - 1 / 1.01)
+    lines += [
+        f"• Прибыльны {profitable:.0f}% из {grid['margin'].size} сценариев "
+        f"(цена ±30%, ACOS 0–30%, комиссия ±5 п.п.)",
+        f"• +1 п.п. комиссии или ACOS: −1.0 п.п. маржи; +1% к цене: +{price_effect:.2f} п.п.",
+    ]
+    return "\n".join(lines)
+
+MONTE_CARLO_PROMPT = """🎲 **РИСК: МОНТЕ-КАРЛО**
+Укажите диапазоны для неуверенных параметров — через точку с запятой или с новой строки:
+`логистика 8-15; acos 5-20; возвраты 3-12; цена ±10%`
+Значение внутри диапазона считается самым вероятным (треугольное распределение).
+Отправьте `-`, чтобы взять диапазоны по умолчанию: логистика ±30%, ACOS ±50%, цена, себестоимость и комиссия ±10%, возвраты 0–10%."""
+
+# «логистика 8-15», «цена ±10%», «acos до 20», «возвраты: 3,5 – 12»
+_MONTE_CARLO_RANGE_RE = re.compile(
+    r"\s*([^\d±+\-–]+?)\s*[:=]?\s*(±|\+-|\+/-|до)?\s*(\d[\d.,\s]*?)\s*(%?)\s*(?:(?:-|–|—|до)\s*(\d[\d.,\s]*?)\s*%?)?\s*$"
+)
+
+def parse_monte_carlo_ranges(text: str, data: List[float]) -> Dict[str, tuple]:
+    # Значения по умолчанию: ± доля от введённого, возвраты 0–10%; строки пользователя их перекрывают
+    ranges = {field: (value * (1 - MONTE_CARLO_DEFAULT_SPREAD[field]), value * (1 + MONTE_CARLO_DEFAULT_SPREAD[field]))
+              for field, value in zip(CALCULATOR_FIELDS, data)}
+    ranges['returns'] = MONTE_CARLO_DEFAULT_RETURNS
+    if text.strip() in ('-', '—', 'по умолчанию'):
+        return ranges
+    aliases = {**BULK_COLUMN_ALIASES, 'returns': MONTE_CARLO_RETURN_ALIASES}
+    for segment in re.split(r"[;\n]|,\s+", text):
+        match = _MONTE_CARLO_RANGE_RE.match(segment.lower())
+        if not match:
+            if segment.strip():
+                raise ValueError(f"Не понял «{segment.strip()}»")
+            continue
+        label, plus_minus, first, percent, second = match.groups()
+        field = next((f for f, names in aliases.items() if f != 'sku' and any(label.startswith(n) or n in label.split() for n in names)), None)
+        if field is None:
+            raise ValueError(f"Неизвестный параметр «{label.strip()}»")
+        low, high = parse_number(first), parse_number(second) if second else None
+        if low is None:
+            raise ValueError(f"Не понял число в «{segment.strip()}»")
+        if plus_minus == 'до':
+            low, high = 0.0, low
+        elif plus_minus:
+            center = data[CALCULATOR_FIELDS.index(field)] if field != 'returns' else 0.0
+            delta = center * low / 100 if percent else low
+            low, high = center - delta, center + delta
+        elif high is None:
+            high = low
+        if high < low:
+            low, high = high, low
+        ranges[field] = (max(low, 0.0), max(high, 0.0))
+    return ranges
+
+def run_monte_carlo(data: List[float], ranges: Dict[str, tuple], draws: int = MONTE_CARLO_DRAWS,
+                    seed: Optional[int] = None) -> Dict[str, Any]:
+    rng = np.random.default_rng(seed)
+    samples = {}
+    for field, (low, high) in ranges.items():
+        if high <= low:
+            samples[field] = np.full(draws, low)
+            continue
+        # Введённое значение — мода треугольного распределения; если оно вне диапазона — равномерное
+        mode = data[CALCULATOR_FIELDS.index(field)] if field in CALCULATOR_FIELDS else (low + high) / 2
+        samples[field] = rng.triangular(low, mode, high, draws) if low <= mode <= high else rng.uniform(low, high, draws)
+    points = np.column_stack([samples[field] for field in CALCULATOR_FIELDS])
+    metrics = calculate_economy_metrics_batch(points)
+    # Возврат: выручки нет, логистика оплачена дважды (туда и обратно), товар возвращается на склад
+    returns_share = samples['returns'] / 100
+    profit = (1 - returns_share) * metrics['чистая_прибыль'] - returns_share * 2 * metrics['логистика']
+    price = samples['price']
+    margin = np.where(price > 0, profit / np.where(price > 0, price, 1.0) * 100, 0.0)
+    drivers = {}
+    for field, values in samples.items():
+        if values.std() > 0 and margin.std() > 0:
+            drivers[field] = float(np.corrcoef(values, margin)[0, 1] ** 2)
+    total = sum(drivers.values()) or 1.0
+    return {
+        'draws': draws,
+        'loss_probability': float((profit < 0).mean()),
+        'margin_percentiles': dict(zip(MONTE_CARLO_PERCENTILES, np.percentile(margin, MONTE_CARLO_PERCENTILES).tolist())),
+        'profit_percentiles': dict(zip(MONTE_CARLO_PERCENTILES, np.percentile(profit, MONTE_CARLO_PERCENTILES).tolist())),
+        'expected_profit': float(profit.mean()),
+        # Доля объяснённой дисперсии маржи (квадрат корреляции, нормированный на сумму)
+        'drivers': sorted(((field, share / total) for field, share in drivers.items()), key=lambda x: -x[1]),
+    }
+
+def format_monte_carlo_report(result: Dict[str, Any], ranges: Dict[str, tuple], elapsed: float) -> str:
+    lines = [f"🎲 **РИСК: {result['draws']:,} СЦЕНАРИЕВ**".replace(",", " "), "", "📥 **ДИАПАЗОНЫ:**"]
+    for field, (low, high) in ranges.items():
+        if high > low:
+            lines.append(f"• {MONTE_CARLO_FIELD_TITLES[field]}: {low:.1f}–{high:.1f}")
+    loss = result['loss_probability'] * 100
+    lines += [
+        "",
+        f"⚠️ **Вероятность убытка: {loss:.1f}%** {'🔴' if loss > 20 else '🟡' if loss > 5 else '🟢'}",
+        f"• Средняя чистая прибыль: {result['expected_profit']:.1f} ₽",
+        "",
+        "📊 **ЧИСТАЯ МАРЖА ПО ПЕРЦЕНТИЛЯМ:**",
+        "```",
+        "  ".join(f"P{q:<5}" for q in MONTE_CARLO_PERCENTILES),
+        "  ".join(f"{result['margin_percentiles'][q]:<6.1f}" for q in MONTE_CARLO_PERCENTILES),
+        "```",
+        "🧭 **ЧТО СИЛЬНЕЕ ВСЕГО ВЛИЯЕТ НА МАРЖУ:**",
+    ]
+    for field, share in result['drivers'][:4]:
+        filled = int(round(share * 10))
+        lines.append(f"• {MONTE_CARLO_FIELD_TITLES[field]}: {'█' * filled}{'▒' * (10 - filled)} {share * 100:.0f}%")
+    lines.append(f"\n⏱ Расчет занял {elapsed * 1000:.0f} мс.")
+    return "\n".join(lines)
+
+async def run_monte_carlo_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    data = [get_calculator_data_safe(context, i) for i in range(6)]
+    try:
+        ranges = parse_monte_carlo_ranges(text, data)
+    except ValueError as e:
+        context.user_data['calculator_pending'] = 'montecarlo'
+        await update.message.reply_text(f"❌ {e}. Пример: логистика 8-15; acos 5-20; возвраты 3-12")
+        return
+    started = time.perf_counter()
+    # 100k+ розыгрышей — десятки миллисекунд CPU; уводим с event loop, чтобы не задерживать других пользователей
+    result = await asyncio.to_thread(run_monte_carlo, data, ranges)
+    await update.message.reply_text(format_monte_carlo_report(result, ranges, time.perf_counter() - started),
+                                    parse_mode=ParseMode.MARKDOWN)
+
 async def start_economy_calculator(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     context.user_data['calculator_step'] = 0
     context.user_data['calculator_data'] = {}
+    context.user_data.pop('calculator_oneshot', None)
     if update.callback_query:
         await update.callback_query.message.reply_text(
             "🛍️ **РАСЧЕТ ЭКОНОМИКИ МАРКЕТПЛЕЙСА**\n"
-            "Введите данные вашего товара:\n"
+            + CALCULATOR_BULK_HINT
+            + CALCULATOR_ONESHOT_HINT
+            + "Введите данные вашего товара:\n"
             + CALCULATOR_STEPS[0],
             parse_mode=ParseMode.MARKDOWN
         )
     else:
         await update.message.reply_text(
             "🛍️ **РАСЧЕТ ЭКОНОМИКИ МАРКЕТПЛЕЙСА**\n"
-            "Введите данные вашего товара:\n"
+            + CALCULATOR_BULK_HINT
+            + CALCULATOR_ONESHOT_HINT
+            + "Введите данные вашего товара:\n"
             + CALCULATOR_STEPS[0],
             parse_mode=ParseMode.MARKDOWN
         )
@@ -550,6 +3170,7 @@ async def start_economy_calculator(update: Update, context: ContextTypes.DEFAULT
 async def handle_economy_calculator(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text = update.message.text
     step = context.user_data.get('calculator_step', 0)
+    pending = context.user_data.pop('calculator_pending', None)
     if text == "🔙 Назад":
         if step == 0:
             context.user_data['state'] = BotState.BUSINESS_MENU
@@ -558,88 +3179,294 @@ async def handle_economy_calculator(update: Update, context: ContextTypes.DEFAUL
             context.user_data['calculator_step'] = step - 1
             await update.message.reply_text(CALCULATOR_STEPS[step - 1])
         return
+    if text == CALCULATOR_WHATIF_BUTTON:
+        if step < len(CALCULATOR_STEPS):
+            await update.message.reply_text("📈 Сначала заполните все шаги расчета.\n" + CALCULATOR_STEPS[step])
+            return
+        data = [get_calculator_data_safe(context, i) for i in range(6)]
+        await update.message.reply_text(format_sensitivity_report(data), parse_mode=ParseMode.MARKDOWN)
+        return
+    if text == CALCULATOR_RISK_BUTTON:
+        if step < len(CALCULATOR_STEPS):
+            await update.message.reply_text("🎲 Сначала заполните все шаги расчета.\n" + CALCULATOR_STEPS[step])
+            return
+        context.user_data['calculator_pending'] = 'montecarlo'
+        await update.message.reply_text(MONTE_CARLO_PROMPT, parse_mode=ParseMode.MARKDOWN)
+        return
+    if pending == 'montecarlo' and text != "🔄 Новый расчет":
+        await run_monte_carlo_reply(update, context, text)
+        return
     if text == "🔄 Новый расчет":
-        context.user_data['calculator_step'] = 0
-        context.user_data['calculator_data'] = {}
         await start_economy_calculator(update, context)
         return
+    values = parse_calculator_message(text, step)
+    if values:
+        # Быстрый путь: несколько значений одним сообщением — сразу к недостающим шагам или к результату
+        data = context.user_data.setdefault('calculator_data', {})
+        data.update(values)
+        missing = [i for i in range(len(CALCULATOR_STEPS)) if i not in data]
+        if not missing:
+            context.user_data['calculator_step'] = len(CALCULATOR_STEPS)
+            await calculate_and_show_results(update, context)
+            return
+        context.user_data['calculator_step'] = missing[0]
+        context.user_data['calculator_oneshot'] = True
+        accepted = ", ".join(f"{CALCULATOR_SHORT_TITLES[i]} {value:g}" for i, value in sorted(values.items()))
+        await update.message.reply_text(f"✅ Принято: {accepted}\nОсталось шагов: {len(missing)}\n{CALCULATOR_STEPS[missing[0]]}")
+        return
     try:
-        value = float(text)
+        value = parse_calculator_value(text)
+        if value is None:
+            raise ValueError(text)
         if value < 0:
             await update.message.reply_text("❌ Число должно быть положительным. Попробуйте еще раз:")
             return
         context.user_data['calculator_data'][step] = value
-        context.user_data['calculator_step'] = step + 1
-        if step + 1 < len(CALCULATOR_STEPS):
-            await update.message.reply_text(CALCULATOR_STEPS[step + 1])
+        next_step = step + 1
+        if context.user_data.get('calculator_oneshot'):
+            # После частичного ввода одним сообщением пропускаем уже заполненные шаги
+            next_step = next((i for i in range(step + 1, len(CALCULATOR_STEPS)) if i not in context.user_data['calculator_data']),
+                             len(CALCULATOR_STEPS))
+        context.user_data['calculator_step'] = next_step
+        if next_step < len(CALCULATOR_STEPS):
+            await update.message.reply_text(CALCULATOR_STEPS[next_step])
         else:
             await calculate_and_show_results(update, context)
     except ValueError:
         await update.message.reply_text("❌ Пожалуйста, введите число:")
 
+def read_bulk_rows(content: bytes, filename: str) -> List[list]:
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        workbook = openpyxl.load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+        try:
+            return [list(row) for row in workbook.worksheets[0].iter_rows(values_only=True)]
+        finally:
+            workbook.close()
+    try:
+        text = content.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = content.decode('cp1251')
+    # csv.Sniffer путается в десятичных запятых («1200,50»), поэтому смотрим только на первую строку
+    first_line = text.split('\n', 1)[0]
+    delimiter = '\t' if '\t' in first_line else ';' if ';' in first_line else ','
+    return list(csv.reader(io.StringIO(text), delimiter=delimiter))
+
+def map_bulk_columns(header: list) -> Dict[str, int]:
+    columns: Dict[str, int] = {}
+    for index, cell in enumerate(header):
+        name = re.sub(r"[^\w]+", " ", str(cell or "")).lower().strip()
+        if not name:
+            continue
+        # Сначала числовые поля: «Себестоимость товара» — это себестоимость, а не название товара
+        for field in CALCULATOR_FIELDS + ('sku',):
+            if field not in columns and any(alias in name.split() or name.startswith(alias) for alias in BULK_COLUMN_ALIASES[field]):
+                columns[field] = index
+                break
+    missing = [BULK_COLUMN_ALIASES[field][0] for field in CALCULATOR_FIELDS if field not in columns]
+    if missing:
+        raise ValueError("Не найдены колонки: " + ", ".join(missing))
+    return columns
+
+def build_bulk_input(rows: List[list]) -> tuple:
+    rows = [row for row in rows if any(cell not in (None, "") for cell in row)]
+    if not rows:
+        raise ValueError("Файл пустой")
+    first = rows[0]
+    if len(first) >= 6 and all(parse_number(cell) is not None for cell in first[-6:]):
+        # Без заголовка: шесть последних колонок в порядке калькулятора, перед ними — SKU, если есть
+        offset = len(first) - 6
+        columns = {field: offset + i for i, field in enumerate(CALCULATOR_FIELDS)}
+        if offset:
+            columns['sku'] = 0
+    else:
+        columns = map_bulk_columns(first)
+        rows = rows[1:]
+    if len(rows) > BULK_MAX_ROWS:
+        raise ValueError(f"Слишком много строк: {len(rows)} (максимум {BULK_MAX_ROWS})")
+    data = np.full((len(rows), 6), np.nan)
+    for field_index, field in enumerate(CALCULATOR_FIELDS):
+        column = columns[field]
+        data[:, field_index] = parse_number_column([row[column] if column < len(row) else None for row in rows])
+    sku_column = columns.get('sku')
+    skus = [str(row[sku_column]) if sku_column is not None and sku_column < len(row) and row[sku_column] not in (None, "")
+            else f"#{i + 1}" for i, row in enumerate(rows)]
+    valid = np.isfinite(data).all(axis=1) & (data >= 0).all(axis=1)
+    return skus, data, valid
+
+def parse_number_column(cells: list) -> np.ndarray:
+    # Быстрые пути без Python-цикла: чистые числа и десятичная запятая; иначе — поячеечный parse_number
+    try:
+        return np.array(cells, dtype=np.float64)
+    except (ValueError, TypeError):
+        pass
+    try:
+        return np.char.replace(np.array(cells, dtype=str), ',', '.').astype(np.float64)
+    except (ValueError, TypeError):
+        pass
+    parsed = [parse_number(cell) for cell in cells]
+    return np.array([np.nan if value is None else value for value in parsed], dtype=np.float64)
+
+def write_bulk_result(skus: List[str], metrics: Dict[str, np.ndarray], valid: np.ndarray, verdicts: np.ndarray,
+                      recommendations: List[str]) -> bytes:
+    header = [title for title, _ in BULK_RESULT_COLUMNS] + ["Вердикт", "Рекомендации"]
+    numeric = np.round(np.column_stack([metrics[key] for _, key in BULK_RESULT_COLUMNS[1:]]), 2).tolist()
+    valid_list = valid.tolist()
+    verdict_list = verdicts.tolist()
+    rows = []
+    for i, sku in enumerate(skus):
+        if valid_list[i]:
+            rows.append([sku] + numeric[i] + [verdict_list[i], recommendations[i]])
+        else:
+            rows.append([sku] + [None] * len(numeric[i]) + ["ошибка данных", "Проверьте числа в строке"])
+    # Результат всегда CSV: запись XLSX через openpyxl на 10k строк в разы дольше самого расчёта
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(header)
+    writer.writerows(rows)
+    # utf-8-sig: Excel открывает кириллицу без ручного выбора кодировки
+    return buffer.getvalue().encode('utf-8-sig')
+
+def format_bulk_summary(skus: List[str], metrics: Dict[str, np.ndarray], valid: np.ndarray, elapsed: float) -> str:
+    total = len(skus)
+    valid_count = int(valid.sum())
+    lines = [
+        "📦 **ПАКЕТНЫЙ РАСЧЕТ ЭКОНОМИКИ**",
+        f"• Товаров: {total}, рассчитано: {valid_count}" + (f", с ошибками: {total - valid_count}" if total > valid_count else ""),
+    ]
+    if valid_count:
+        margin = metrics['чистая_маржа_%'][valid]
+        profit = metrics['чистая_прибыль'][valid]
+        lines += [
+            f"• Убыточных: {int((profit < 0).sum())}, с маржой ниже {BENCHMARKS['чистая_маржа']['низкая']}%: "
+            f"{int((margin < BENCHMARKS['чистая_маржа']['низкая']).sum())}",
+            f"• Медианная чистая маржа: {float(np.median(margin)):.1f}%",
+            "",
+            "📉 **ХУДШИЕ ПО ЧИСТОЙ МАРЖЕ:**",
+        ]
+        valid_indices = np.flatnonzero(valid)
+        worst = valid_indices[np.argsort(margin, kind='stable')[:BULK_WORST_COUNT]]
+        for i in worst.tolist():
+            sku = escape_markdown(skus[i][:40])
+            lines.append(f"• {sku}: {metrics['чистая_маржа_%'][i]:.1f}% ({metrics['чистая_прибыль'][i]:.1f} ₽)")
+    lines.append(f"\n⏱ Расчет занял {elapsed * 1000:.0f} мс. Полный результат — в файле.")
+    return "\n".join(lines)
+
+def process_bulk_file(content: bytes, filename: str) -> tuple:
+    started = time.perf_counter()
+    skus, data, valid = build_bulk_input(read_bulk_rows(content, filename))
+    metrics = calculate_economy_metrics_batch(np.where(valid[:, None], data, 0.0))
+    verdicts = classify_margin_batch(metrics)
+    recommendations = generate_recommendations_batch(metrics)
+    result = write_bulk_result(skus, metrics, valid, verdicts, recommendations)
+    result_name = os.path.splitext(os.path.basename(filename))[0] + "_economy.csv"
+    return result, result_name, format_bulk_summary(skus, metrics, valid, time.perf_counter() - started)
+
+async def handle_bulk_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    document = update.message.document
+    if context.user_data.get('state') != BotState.CALCULATOR:
+        await update.message.reply_text("📎 Файлы с товарами принимает калькулятор маркетплейсов: откройте его в разделе «Для дела».")
+        return
+    filename = document.file_name or "products.csv"
+    if not filename.lower().endswith(('.csv', '.txt', '.xlsx', '.xlsm')):
+        await update.message.reply_text("❌ Поддерживаются файлы CSV и XLSX.")
+        return
+    if document.file_size and document.file_size > BULK_MAX_FILE_BYTES:
+        await update.message.reply_text(f"❌ Файл слишком большой (максимум {BULK_MAX_FILE_BYTES // (1024 * 1024)} МБ).")
+        return
+    telegram_file = await document.get_file()
+    content = bytes(await telegram_file.download_as_bytearray())
+    try:
+        # Разбор и расчёт — CPU-работа, уводим её с event loop
+        result, result_name, summary = await asyncio.to_thread(process_bulk_file, content, filename)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\nНужны колонки: себестоимость, цена, комиссия, логистика, ACOS, налог.")
+        return
+    except Exception as e:
+        logger.error(f"Ошибка пакетного расчета для {update.message.from_user.id}: {e}")
+        await update.message.reply_text("❌ Не удалось прочитать файл. Проверьте формат и попробуйте еще раз.")
+        return
+    await update.message.reply_document(InputFile(result, filename=result_name))
+    await update.message.reply_text(summary, parse_mode=ParseMode.MARKDOWN)
+    await update_usage_stats(update.message.from_user.id, 'calculator')
+
 async def send_long_message(chat_id: int, text: str, context: ContextTypes.DEFAULT_TYPE, 
                           prefix: str = "", parse_mode: str = None):
-    parts = split_message_efficiently(text)
+    # Запас под префикс и номер части «*(12/12)*», чтобы итоговое сообщение не вышло за лимит
+    parts = split_message_efficiently(text, 4096 - utf16_len(prefix) - 12)
     total_parts = len(parts)
     for i, part in enumerate(parts, 1):
         part_prefix = prefix if total_parts == 1 else f"{prefix}*({i}/{total_parts})*\n"
         await context.bot.send_message(chat_id, f"{part_prefix}{part}", parse_mode=parse_mode)
 
+async def generate_llm_reply(reply: StreamingReply, messages: List[Dict[str, str]], call_type: str,
+                             tag: Optional[str] = None, hedge: bool = False) -> str:
+    if not STREAMING_ENABLED:
+        return await llm_client.complete(messages, call_type=call_type, tag=tag, hedge=hedge)
+    stream = llm_client.stream(messages, call_type=call_type, tag=tag, hedge=hedge)
+    try:
+        async for delta in stream:
+            await reply.feed(delta)
+    finally:
+        await stream.aclose()
+    return reply.text
+
 async def handle_groq_request(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt_key: str):
-    if not groq_client or not update.message:
+    if not llm_client or not update.message:
         return
     user_id = update.message.from_user.id
-    if not rate_limiter.is_allowed(user_id):
+    if not rate_limiter.is_allowed(user_id, prompt_key):
         await update.message.reply_text("🚫 Слишком много запросов. Подождите минуту.")
         return
     user_query = sanitize_user_input(update.message.text)
     system_prompt = SYSTEM_PROMPTS.get(prompt_key, "Вы — полезный ассистент.")
-    await update.message.chat.send_message(f"⌛ **{prompt_key.capitalize()}** обрабатывает ваш запрос...", parse_mode=ParseMode.MARKDOWN)
-    try:
-        cached_response = ai_cache.get_cached_response(prompt_key, user_query)
-        if cached_response:
-            await send_long_message(
-                update.message.chat.id,
-                cached_response,
-                context,
-                prefix=f"🤖 Ответ {prompt_key.capitalize()} (из кэша):\n",
-                parse_mode=None
-            )
-            await update_usage_stats(user_id, 'ai')
-            return
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_query}
-        ]
-        chat_completion = groq_client.chat.completions.create(
-            messages=messages,
-            model="llama-3.1-8b-instant",
-            max_tokens=4000
-        )
-        ai_response = chat_completion.choices[0].message.content
-        ai_cache.cache_response(prompt_key, user_query, ai_response)
+    # Кэш и объединение запросов — только для первой реплики: продолжение диалога зависит от истории
+    first_turn = not conversation_memory.has_history(user_id, prompt_key)
+    cached_response = await ai_cache.lookup(prompt_key, user_query) if first_turn else None
+    if cached_response:
         await send_long_message(
             update.message.chat.id,
-            ai_response,
+            cached_response,
             context,
-            prefix=f"🤖 Ответ {prompt_key.capitalize()}:\n",
+            prefix=f"🤖 Ответ {prompt_key.capitalize()} (из кэша):\n",
             parse_mode=None
         )
+        conversation_memory.append(user_id, prompt_key, user_query, cached_response)
+        await update_usage_stats(user_id, 'ai')
+        return
+    reply = StreamingReply(context.bot, update.message.chat.id, prefix=f"🤖 Ответ {prompt_key.capitalize()}:\n")
+    try:
+        await reply.start(f"⌛ **{prompt_key.capitalize()}** обрабатывает ваш запрос...", parse_mode=ParseMode.MARKDOWN)
+        messages = conversation_memory.build_messages(user_id, prompt_key, system_prompt, user_query)
+        if first_turn:
+            async def generate_and_cache() -> str:
+                response = await generate_llm_reply(reply, messages, call_type='chat', tag=prompt_key, hedge=True)
+                await ai_cache.store(prompt_key, user_query, response)
+                return response
+            # Одинаковые запросы, пришедшие одновременно, ждут один вызов Groq
+            ai_response, _ = await llm_singleflight.do(ai_cache.get_cache_key(prompt_key, user_query), generate_and_cache)
+        else:
+            ai_response = await generate_llm_reply(reply, messages, call_type='chat', tag=prompt_key, hedge=True)
+        conversation_memory.append(user_id, prompt_key, user_query, ai_response)
+        await reply.finish(f"{reply.prefix}{ai_response}")
         await update_usage_stats(user_id, 'ai')
     except APIError as e:
         logger.error(f"ОШИБКА GROQ API: {e}")
-        if e.status_code == 429:
-            user_message = "❌ **Превышен лимит запросов.** Подождите минуту."
-        elif e.status_code == 400:
+        status_code = getattr(e, 'status_code', None)
+        if status_code == 429:
+            user_message = "⏳ **Сервис сейчас перегружен.** Попробуйте через минуту — ваш запрос не потерян, просто отправьте его ещё раз."
+        elif status_code == 400:
             user_message = "❌ **Ошибка 400: Неверный запрос или лимиты.**"
-        elif e.status_code == 401:
+        elif status_code == 401:
             user_message = "❌ **Ошибка 401: Неверный API ключ.**"
         else:
-            user_message = f"❌ **Ошибка Groq API:** Код {e.status_code}"
-        await update.message.chat.send_message(user_message, parse_mode=ParseMode.MARKDOWN)
+            user_message = f"❌ **Ошибка Groq API:** Код {status_code or type(e).__name__}"
+        await reply.fail(user_message, parse_mode=ParseMode.MARKDOWN)
+    except TokenBudgetExceeded as e:
+        logger.warning(f"Запрос пользователя {user_id} отклонён: {e}")
+        await reply.fail("⏳ **Сервис сейчас перегружен.** Попробуйте через минуту.", parse_mode=ParseMode.MARKDOWN)
     except Exception as e:
         logger.error(f"Неизвестная ошибка: {e}")
-        await update.message.chat.send_message("Произошла ошибка при обращении к AI.", parse_mode=ParseMode.MARKDOWN)
+        await reply.fail("Произошла ошибка при обращении к AI.", parse_mode=ParseMode.MARKDOWN)
 
 # ==============================================================================
 # 6. ОСНОВНОЙ ХЕНДЛЕР
@@ -650,6 +3477,26 @@ REPLY_KEYBOARD = ReplyKeyboardMarkup(
     resize_keyboard=True
 )
 
+user_data_checked = LRUCache(max_size=10000)
+
+async def load_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user:
+        return
+    await active_skill_sessions.ensure_loaded(user.id)
+    if not context.user_data and user.id not in user_data_checked:
+        stored = await state_manager.load('user_data', user.id)
+        user_data_checked.set(user.id, True)
+        if stored:
+            context.user_data.update(stored)
+
+async def save_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user:
+        return
+    state_manager.mark_dirty('user_data', user.id, context.user_data)
+    active_skill_sessions.mark_dirty(user.id)
+
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> BotState:
     user_text = update.message.text.strip()
     user_id = update.message.from_user.id
@@ -905,6 +3752,8 @@ async def activate_access(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await start_skilltrainer_session(update, context)
         return BotState.AI_SELECTION
     context.user_data['active_groq_mode'] = prompt_key
+    # Повторная активация — новый диалог
+    conversation_memory.reset(query.from_user.id, prompt_key)
     await query.edit_message_text(
         f"✅ Режим **{prompt_key.capitalize()}** активирован!\n"
         f"Напишите ваш первый запрос, и {prompt_key.capitalize()} приступит к работе.\n"
@@ -973,6 +3822,8 @@ async def send_skilltrainer_question(update: Update, context: ContextTypes.DEFAU
                 [InlineKeyboardButton("❌ Отмена", callback_data="st_cancel")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
+            ranked = sorted(TrainingMode, key=lambda mode: -training_mode_choices[mode])
+            prefetch_training_tasks(session, ranked[:SKILLTRAINER_PREFETCH_MODES])
             if update.callback_query:
                 await update.callback_query.edit_message_text(
                     f"{hud}\n{question}\n**Выберите режим тренировки:**",
@@ -1016,7 +3867,8 @@ async def handle_skilltrainer_response(update: Update, context: ContextTypes.DEF
         await update.message.reply_text(hint)
         return
 
-    session.add_answer(session.current_step, user_text)
+    # Ответы уходят в промпты Groq — сохраняем их уже очищенными
+    session.add_answer(session.current_step, sanitize_user_input(user_text))
     check_gate(session, "interview_complete")
 
     import random
@@ -1031,6 +3883,194 @@ async def handle_skilltrainer_response(update: Update, context: ContextTypes.DEF
         session.state = SessionState.MODE_SELECTION
         await send_skilltrainer_question(update, context, session)
 
+def build_training_messages(session: SkillSession, mode: Optional[TrainingMode]) -> List[Dict[str, str]]:
+    answers_text = "\n".join([f"Вопрос {i+1}: {answer}" for i, answer in session.answers.items()])
+    training_request = f"""
+Пользователь хочет развить навык. Вот его ответы на диагностику:
+{answers_text}
+Выбранный режим тренировки: {mode.name if mode else 'Не выбран'}
+Создай одно тренировочное задание в выбранном режиме. Задание должно быть:
+1. Практическим и конкретным
+2. Соответствовать выбранному режиму
+3. Иметь четкую инструкцию
+4. Быть выполнимым за 5-15 минут
+5. Включать критерии успешного выполнения (DOD)
+Формат ответа:
+**ЗАДАНИЕ:**
+[Название задания]
+**ИНСТРУКЦИЯ:**
+[Пошаговая инструкция]
+**КРИТЕРИИ УСПЕХА (DOD):**
+1. [Критерий 1]
+2. [Критерий 2]
+3. [Критерий 3]
+**ПОДСКАЗКА:**
+[Короткая подсказка ≤240 символов]
+"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPTS['skilltrainer']},
+        {"role": "user", "content": training_request}
+    ]
+
+# Сколько раз выбирали каждый режим — предзагрузка начинается с самого популярного
+training_mode_choices: Dict[TrainingMode, int] = {mode: 0 for mode in TrainingMode}
+
+def prefetch_training_tasks(session: SkillSession, modes: List[TrainingMode]) -> int:
+    # Задание генерируется, пока пользователь читает описания режимов; ключ свежести — сам текст промпта
+    if not llm_client or SKILLTRAINER_PREFETCH_MODES <= 0:
+        return 0
+    now = time.monotonic()
+    started = 0
+    for mode in modes:
+        messages = build_training_messages(session, mode)
+        entry = session._prefetch.get(mode)
+        if entry:
+            task, expires_at, request = entry
+            failed = task.done() and (task.cancelled() or task.exception() is not None)
+            if expires_at > now and request == messages[1]['content'] and not failed:
+                continue
+            task.cancel()
+            del session._prefetch[mode]
+        task = background_jobs.submit('training_prefetch', lambda messages=messages: background_jobs.complete(
+            messages, 'training', tag='skilltrainer_prefetch'))
+        if task is None:
+            SKILLTRAINER_PRECOMPUTE.inc('training', 'rejected')
+            break
+        session._prefetch[mode] = (task, now + SKILLTRAINER_PREFETCH_TTL, messages[1]['content'])
+        started += 1
+    return started
+
+def cancel_training_prefetch(session: SkillSession, keep: Optional[TrainingMode] = None):
+    for mode in [m for m in session._prefetch if m != keep]:
+        session._prefetch.pop(mode)[0].cancel()
+        SKILLTRAINER_PRECOMPUTE.inc('training', 'cancelled')
+
+async def take_training_prefetch(session: SkillSession) -> Optional[str]:
+    entry = session._prefetch.pop(session.selected_mode, None)
+    if entry is None:
+        SKILLTRAINER_PRECOMPUTE.inc('training', 'miss')
+        return None
+    task, expires_at, request = entry
+    # Ответы или режим поменялись после запуска — такое задание не подходит
+    if time.monotonic() > expires_at or request != build_training_messages(session, session.selected_mode)[1]['content']:
+        task.cancel()
+        SKILLTRAINER_PRECOMPUTE.inc('training', 'stale')
+        return None
+    return await await_precomputed(task, 'training')
+
+async def await_precomputed(task: asyncio.Task, kind: str) -> Optional[str]:
+    # Готовый результат — 'hit', дождались начатого — 'joined'; ошибка фоновой задачи не ошибка для пользователя
+    outcome = 'hit' if task.done() else 'joined'
+    try:
+        result = await task
+    except asyncio.CancelledError:
+        if not task.cancelled() or asyncio.current_task().cancelling():
+            raise
+        result = None
+    except Exception:
+        result = None
+    SKILLTRAINER_PRECOMPUTE.inc(kind, outcome if result else 'failed')
+    return result or None
+
+def finish_packet_inputs(session: SkillSession) -> str:
+    # Всё, от чего зависит текст пакета; одновременно ключ свежести заготовленного пакета
+    answers_text = "\n".join([f"Шаг {i+1}: {answer}" for i, answer in session.answers.items()])
+    return f"""ДАННЫЕ ПОЛЬЗОВАТЕЛЯ:
+{answers_text}
+Выбранный режим тренировки: {session.selected_mode.name if session.selected_mode else 'Не выбран'}"""
+
+def build_finish_section_messages(inputs: str, index: int) -> List[Dict[str, str]]:
+    title, instruction, _, _ = FINISH_PACKET_SECTIONS[index]
+    section_request = f"""
+На основе диагностики пользователя напиши один раздел Finish Packet (Итогового пакета).
+{inputs}
+РАЗДЕЛ {index + 1}. {title} — {instruction}.
+Пиши только этот раздел, без заголовка и без вступления. Будь конкретным, практичным и мотивирующим.
+"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPTS['skilltrainer']},
+        {"role": "user", "content": section_request}
+    ]
+
+async def generate_finish_sections(inputs: str, on_section: Optional[Callable[[str], Awaitable[None]]] = None,
+                                   tag: str = 'skilltrainer', hedge: bool = False, background: bool = False) -> str:
+    # Разделы генерируются параллельно, а склеиваются и отдаются по порядку: раздел уходит, как только готовы все до него.
+    # background=True — заготовка: вызовы идут через слоты фона, а пакет с запасным разделом не сохраняется
+    semaphore = asyncio.Semaphore(FINISH_SECTION_CONCURRENCY)
+    async def generate(index: int) -> tuple:
+        title, _, max_tokens, fallback = FINISH_PACKET_SECTIONS[index]
+        messages = build_finish_section_messages(inputs, index)
+        async with semaphore:
+            try:
+                if background:
+                    request = background_jobs.complete(messages, 'finish_section', max_tokens=max_tokens, tag=tag)
+                else:
+                    request = llm_client.complete(messages, call_type='finish_section', max_tokens=max_tokens, tag=tag,
+                                                  hedge=hedge)
+                text = await asyncio.wait_for(request, FINISH_SECTION_TIMEOUT)
+                FINISH_SECTIONS.inc(str(index + 1), 'ok')
+                return text.strip(), None
+            except asyncio.TimeoutError as e:
+                FINISH_SECTIONS.inc(str(index + 1), 'timeout')
+                error = e
+            except Exception as e:
+                FINISH_SECTIONS.inc(str(index + 1), 'error')
+                error = e
+        logger.warning(f"Раздел Finish Packet «{title}» заменён запасным: {type(error).__name__}")
+        return fallback, error
+    tasks = [asyncio.create_task(generate(i)) for i in range(len(FINISH_PACKET_SECTIONS))]
+    parts = []
+    errors = []
+    try:
+        for index, task in enumerate(tasks):
+            text, error = await task
+            if error is not None:
+                if background:
+                    # Живой путь сгенерирует пакет заново, а не покажет заготовку с заглушкой
+                    raise error
+                errors.append(error)
+            part = f"**{index + 1}. {FINISH_PACKET_SECTIONS[index][0]}**\n{text}"
+            parts.append(part)
+            if on_section:
+                await on_section(part + "\n\n")
+    finally:
+        for task in tasks:
+            task.cancel()
+    if len(errors) == len(tasks):
+        # Ни одного раздела от модели — это не пакет, а сбой
+        raise errors[-1]
+    return "\n\n".join(parts)
+
+def precompute_finish_packet(session: SkillSession) -> bool:
+    # После гейта training_complete входы пакета (ответы и режим) зафиксированы — генерируем его, не дожидаясь кнопки
+    if not llm_client:
+        return False
+    inputs = finish_packet_inputs(session)
+    if session._finish_job:
+        task, request = session._finish_job
+        failed = task.done() and (task.cancelled() or task.exception() is not None)
+        if request == inputs and not failed:
+            return True
+        session.cancel_finish_job()
+    task = background_jobs.submit('finish_packet', lambda: generate_finish_sections(inputs, tag='skilltrainer_precompute', background=True))
+    if task is None:
+        SKILLTRAINER_PRECOMPUTE.inc('finish', 'rejected')
+        return False
+    session._finish_job = (task, inputs)
+    return True
+
+async def take_finish_packet(session: SkillSession) -> Optional[str]:
+    job, session._finish_job = session._finish_job, None
+    if job is None:
+        SKILLTRAINER_PRECOMPUTE.inc('finish', 'miss')
+        return None
+    task, request = job
+    if request != finish_packet_inputs(session):
+        task.cancel()
+        SKILLTRAINER_PRECOMPUTE.inc('finish', 'stale')
+        return None
+    return await await_precomputed(task, 'finish')
+
 async def handle_skilltrainer_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -1072,6 +4112,11 @@ async def handle_skilltrainer_mode(update: Update, context: ContextTypes.DEFAULT
     }
     if mode_data in mode_map:
         session.selected_mode = mode_map[mode_data]
+        training_mode_choices[session.selected_mode] += 1
+        if session._finish_job and finish_packet_inputs(session) != session._finish_job[1]:
+            session.cancel_finish_job()
+        # Режим выбран — остальные заготовки больше не нужны
+        cancel_training_prefetch(session, keep=session.selected_mode)
         session.current_step = 7
         session.update_progress()
         check_gate(session, "mode_selected")
@@ -1095,6 +4140,9 @@ async def start_training_session(update: Update, context: ContextTypes.DEFAULT_T
         [InlineKeyboardButton("❌ Завершить", callback_data="st_finish_early")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
+    # Пока пользователь читает описание режима, задание уже генерируется
+    if session.selected_mode:
+        prefetch_training_tasks(session, [session.selected_mode])
     await update.callback_query.edit_message_text(
         f"{hud}\n{prompt}",
         reply_markup=reply_markup,
@@ -1109,46 +4157,25 @@ async def handle_training_start(update: Update, context: ContextTypes.DEFAULT_TY
         await query.edit_message_text("❌ Сессия не найдена.")
         return
     session = active_skill_sessions[user_id]
+    if not rate_limiter.is_allowed(user_id, 'skilltrainer'):
+        await query.message.reply_text("🚫 Слишком много запросов. Подождите минуту.")
+        return
     session.state = SessionState.TRAINING
-    if groq_client:
+    if llm_client:
+        reply = StreamingReply(context.bot, query.message.chat.id, prefix=f"{generate_hud(session)}\n", message=query.message)
         try:
-            answers_text = "\n".join([f"Вопрос {i+1}: {answer}" for i, answer in session.answers.items()])
-            training_request = f"""
-Пользователь хочет развить навык. Вот его ответы на диагностику:
-{answers_text}
-Выбранный режим тренировки: {session.selected_mode.name if session.selected_mode else 'Не выбран'}
-Создай одно тренировочное задание в выбранном режиме. Задание должно быть:
-1. Практическим и конкретным
-2. Соответствовать выбранному режиму
-3. Иметь четкую инструкцию
-4. Быть выполнимым за 5-15 минут
-5. Включать критерии успешного выполнения (DOD)
-Формат ответа:
-**ЗАДАНИЕ:**
-[Название задания]
-**ИНСТРУКЦИЯ:**
-[Пошаговая инструкция]
-**КРИТЕРИИ УСПЕХА (DOD):**
-1. [Критерий 1]
-2. [Критерий 2]
-3. [Критерий 3]
-**ПОДСКАЗКА:**
-[Короткая подсказка ≤240 символов]
-"""
-            messages = [
-                {"role": "system", "content": SYSTEM_PROMPTS['skilltrainer']},
-                {"role": "user", "content": training_request}
-            ]
-            await query.edit_message_text(f"{generate_hud(session)}\n🎯 Генерирую задание...")
-            chat_completion = groq_client.chat.completions.create(
-                messages=messages,
-                model="llama-3.1-8b-instant",
-                max_tokens=1500
-            )
-            training_task = chat_completion.choices[0].message.content
+            prefetched = session._prefetch.get(session.selected_mode)
+            if not (prefetched and prefetched[0].done()):
+                await reply.start(f"{generate_hud(session)}\n🎯 Генерирую задание...")
+            training_task = await take_training_prefetch(session)
+            if training_task is None:
+                messages = build_training_messages(session, session.selected_mode)
+                training_task = await generate_llm_reply(reply, messages, call_type='training', tag='skilltrainer', hedge=True)
             session.data = {'training_task': training_task}
             session.training_complete = True
-            check_gate(session, "training_complete")
+            passed, _ = check_gate(session, "training_complete")
+            if passed:
+                precompute_finish_packet(session)
             keyboard = [
                 [InlineKeyboardButton("✅ Задание выполнено", callback_data="st_task_done")],
                 [InlineKeyboardButton("💡 Нужна подсказка", callback_data="st_need_hint")],
@@ -1156,14 +4183,14 @@ async def handle_training_start(update: Update, context: ContextTypes.DEFAULT_TY
                 [InlineKeyboardButton("🏁 Завершить сессию", callback_data="st_finish_session")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
+            await reply.finish(
                 f"{generate_hud(session)}\n{training_task}",
                 reply_markup=reply_markup,
                 parse_mode=ParseMode.MARKDOWN
             )
         except Exception as e:
             logger.error(f"Ошибка генерации задания SKILLTRAINER: {e}")
-            await query.edit_message_text(
+            await reply.fail(
                 f"{generate_hud(session)}\n❌ Ошибка при генерации задания. Попробуйте еще раз или выберите другой режим.",
                 parse_mode=ParseMode.MARKDOWN
             )
@@ -1182,34 +4209,15 @@ async def finish_skilltrainer_session(update: Update, context: ContextTypes.DEFA
         return
     session.state = SessionState.FINISH
     session.progress = 1.0
-    if groq_client:
+    if llm_client:
+        reply = StreamingReply(context.bot, update.callback_query.message.chat.id, message=update.callback_query.message)
         try:
-            answers_text = "\n".join([f"Шаг {i+1}: {answer}" for i, answer in session.answers.items()])
-            finish_request = f"""
-На основе диагностики пользователя сформируй Finish Packet (Итоговый пакет).
-ДАННЫЕ ПОЛЬЗОВАТЕЛЯ:
-{answers_text}
-Выбранный режим тренировки: {session.selected_mode.name if session.selected_mode else 'Не выбран'}
-СФОРМИРУЙ FINISH PACKET СО СЛЕДУЮЩИМИ РАЗДЕЛАМИ:
-1. **КРАТКАЯ ДИАГНОСТИКА** - основные выводы из ответов
-2. **РЕКОМЕНДОВАННЫЕ МЕТОДИКИ** - 3-5 конкретных методик для развития навыка
-3. **ПЛАН ТРЕНИРОВОК** - понедельный план на 4 недели
-4. **ИНСТРУМЕНТЫ И РЕСУРСЫ** - полезные инструменты, книги, курсы
-5. **КРИТЕРИИ ПРОГРЕССА** - как отслеживать улучшения
-6. **ЧЕК-ЛИСТ ПРОВЕРКИ** - что проверить через 2 недели
-Будь конкретным, практичным и мотивирующим.
-"""
-            messages = [
-                {"role": "system", "content": SYSTEM_PROMPTS['skilltrainer']},
-                {"role": "user", "content": finish_request}
-            ]
-            await update.callback_query.edit_message_text(f"{generate_hud(session)}\n🎓 Формирую Finish Packet...")
-            chat_completion = groq_client.chat.completions.create(
-                messages=messages,
-                model="llama-3.1-8b-instant",
-                max_tokens=4000
-            )
-            ai_response = chat_completion.choices[0].message.content
+            if not (session._finish_job and session._finish_job[0].done()):
+                await reply.start(f"{generate_hud(session)}\n🎓 Формирую Finish Packet...")
+            ai_response = await take_finish_packet(session)
+            if ai_response is None:
+                ai_response = await generate_finish_sections(finish_packet_inputs(session),
+                                                             on_section=reply.feed if STREAMING_ENABLED else None, hedge=True)
             session.finish_packet = format_finish_packet(session, ai_response)
             await update_usage_stats(session.user_id, 'skilltrainer')
             if session.user_id in active_skill_sessions:
@@ -1221,13 +4229,7 @@ async def finish_skilltrainer_session(update: Update, context: ContextTypes.DEFA
                 [InlineKeyboardButton("🔙 В меню", callback_data="main_menu")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await send_long_message(
-                update.callback_query.message.chat.id,
-                session.finish_packet,
-                context,
-                prefix="",
-                parse_mode=None
-            )
+            await reply.finish(session.finish_packet)
             await update.callback_query.message.reply_text(
                 "✅ **СЕССИЯ SKILLTRAINER ЗАВЕРШЕНА!**\n"
                 "Вы можете пригласить друга или начать новую сессию.",
@@ -1236,7 +4238,7 @@ async def finish_skilltrainer_session(update: Update, context: ContextTypes.DEFA
             )
         except Exception as e:
             logger.error(f"Ошибка генерации Finish Packet: {e}")
-            await update.callback_query.edit_message_text(
+            await reply.fail(
                 "❌ Ошибка при формировании Finish Packet. Основные результаты сохранены.\n"
                 f"Ваши ответы: {len(session.answers)} из 7\n"
                 f"Режим: {session.selected_mode.name if session.selected_mode else 'Не выбран'}",
@@ -1312,11 +4314,39 @@ async def finish_skilltrainer_interview(update: Update, context: ContextTypes.DE
 # ==============================================================================
 # 10. ЗАПУСК
 # ==============================================================================
+def instrument_handler(callback):
+    name = getattr(callback, '__name__', type(callback).__name__)
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+    return wrapper
+
+# Все исходящие вызовы бота (reply_text, правки стрима, Finish Packet, документы) проходят через диспетчер
+outbound_dispatcher = OutboundDispatcher()
+
 if not TELEGRAM_TOKEN:
     logger.error("❌ TELEGRAM_TOKEN не установлен. Запуск невозможен.")
     application = None
 else:
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .rate_limiter(outbound_dispatcher)
+        .build()
+    )
+    # 🔹 Состояние пользователя подгружается до всех хендлеров и помечается к записи после них
+    application.add_handler(TypeHandler(Update, load_user_state), group=-1)
+    application.add_handler(TypeHandler(Update, save_user_state), group=100)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("menu", menu_command))
     application.add_handler(CommandHandler("version", version_command))
@@ -1334,19 +4364,167 @@ else:
     application.add_handler(CallbackQueryHandler(handle_training_start, pattern='^st_start_training$'))
     application.add_handler(CallbackQueryHandler(handle_skilltrainer_actions, pattern='^st_.+$'))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_bulk_upload))
+    for group_handlers in application.handlers.values():
+        for handler in group_handlers:
+            handler.callback = instrument_handler(handler.callback)
+
+def get_update_queue_key(update: Update) -> int:
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return 0
+
+async def process_queued_update(update: Update):
+    token = _REPLY_ALLOWANCE.set([update.effective_chat.id, TELEGRAM_CHAT_BURST] if update.effective_chat else None)
+    try:
+        await application.process_update(update)
+    finally:
+        _REPLY_ALLOWANCE.reset(token)
+
+update_queue: Optional[UpdateQueue] = UpdateQueue(process_queued_update) if application else None
 
 async def telegram_webhook_handler(request: web.Request) -> web.Response:
+    started = time.perf_counter()
+    response = await accept_update(request)
+    WEBHOOK_LATENCY.observe(time.perf_counter() - started, str(response.status))
+    return response
+
+async def accept_update(request: web.Request) -> web.Response:
     global application
-    if application is None:
+    if application is None or update_queue is None:
         return web.Response(status=500, text="Application not initialized.")
     try:
         data = await request.json()
     except Exception:
         return web.Response(status=400, text="Invalid JSON")
-    update = Update.de_json(data, application.bot)
-    await application.process_update(update)
+    if not isinstance(data, dict) or 'update_id' not in data:
+        return web.Response(status=400, text="Invalid update")
+    try:
+        update = Update.de_json(data, application.bot)
+    except Exception:
+        return web.Response(status=400, text="Invalid update")
+    if not update_queue.put(get_update_queue_key(update), update):
+        logger.warning(f"Очередь апдейтов переполнена ({update_queue.depth}), апдейт {update.update_id} не принят")
+        if UPDATE_QUEUE_OVERFLOW == "reject":
+            return web.Response(status=503, text="Queue is full", headers={"Retry-After": "1"})
+    elif webhook_capture:
+        # Пишем только принятые апдейты: повторы Telegram после 503 не задваивают запись
+        webhook_capture.record(data)
     return web.Response(text="OK")
 
+def ops_endpoint(handler: Callable[[web.Request], Awaitable[web.Response]]):
+    # /metrics и /queue слушают тот же публичный порт, что и webhook, поэтому отвечают только по токену
+    @functools.wraps(handler)
+    async def guarded(request: web.Request) -> web.Response:
+        if not METRICS_TOKEN:
+            raise web.HTTPNotFound()
+        supplied = request.headers.get("Authorization", "").encode()
+        if not hmac.compare_digest(supplied, f"Bearer {METRICS_TOKEN}".encode()):
+            return web.Response(status=401, text="Unauthorized", headers={"WWW-Authenticate": "Bearer"})
+        return await handler(request)
+    return guarded
+
+async def queue_stats_handler(request: web.Request) -> web.Response:
+    if update_queue is None:
+        return web.Response(status=500, text="Application not initialized.")
+    return web.json_response(update_queue.stats())
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=metrics.render().encode(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+metrics.callback("bot_ai_cache_lookups_total", "Поиски в кэше AI-ответов по результату",
+                 lambda: {(k,): ai_cache.stats()[k] for k in ('hits', 'near_hits', 'l2_hits', 'misses')},
+                 labels=("result",), kind="counter")
+metrics.callback("bot_ai_cache_hit_ratio", "Доля попаданий в кэш AI-ответов", lambda: ai_cache.stats()['hit_ratio'])
+metrics.callback("bot_ai_cache_bytes", "Размер кэша AI-ответов",
+                 lambda: {('l1',): ai_cache.bytes_used, ('l2',): ai_disk_cache.bytes_used if ai_disk_cache else 0},
+                 labels=("tier",))
+metrics.callback("bot_rate_limiter_rejections_total", "Отказы лимитеров",
+                 lambda: {('user',): rate_limiter.rejections,
+                          ('tokens',): llm_client.budget.rejections if llm_client else 0},
+                 labels=("limiter",), kind="counter")
+metrics.callback("bot_skilltrainer_active_sessions", "Активные сессии SKILLTRAINER в памяти", lambda: len(active_skill_sessions))
+metrics.callback("bot_cache_entries", "Размеры кэшей и таблиц в памяти",
+                 lambda: {('user_stats',): len(user_stats_cache.cache), ('ai_cache',): len(ai_cache.entries),
+                          ('rate_limiter',): len(rate_limiter.buckets), ('user_data_checked',): len(user_data_checked.cache),
+                          ('state_dirty',): len(state_manager.dirty)},
+                 labels=("cache",))
+metrics.callback("bot_conversations", "Диалоги AI-инструментов в памяти и реплики в них",
+                 lambda: {('conversations',): len(conversation_memory.conversations),
+                          ('messages',): sum(len(c.messages) for c in conversation_memory.conversations.values())},
+                 labels=("kind",))
+metrics.callback("bot_conversation_compactions_total", "Сжатия истории диалога: сводкой, неудачные, вытеснено по простою",
+                 lambda: {('summarized',): conversation_memory.compactions, ('failed',): conversation_memory.compaction_failures,
+                          ('evicted',): conversation_memory.evictions},
+                 labels=("result",), kind="counter")
+metrics.callback("bot_background_jobs_running", "Фоновые вызовы Groq, выполняющиеся сейчас", lambda: len(background_jobs.tasks))
+metrics.callback("bot_background_jobs_rejected_total", "Фоновые вызовы Groq, отклонённые из-за нагрузки",
+                 lambda: background_jobs.rejected, kind="counter")
+metrics.callback("bot_singleflight_upstream_calls_saved_total", "Вызовы Groq, сэкономленные объединением одинаковых запросов",
+                 lambda: llm_singleflight.shared, kind="counter")
+metrics.callback("bot_update_queue_depth", "Апдейты в очереди", lambda: update_queue.depth if update_queue else 0)
+metrics.callback("bot_update_queue_rejected_total", "Апдейты, не принятые из-за переполнения очереди",
+                 lambda: update_queue.rejected if update_queue else 0, kind="counter")
+metrics.callback("bot_webhook_capture_updates_total", "Захват webhook: записанные и отброшенные апдейты",
+                 lambda: {('written',): webhook_capture.written, ('dropped',): webhook_capture.dropped} if webhook_capture else {},
+                 labels=("result",), kind="counter")
+metrics.callback("bot_telegram_outbound_total", "Исходящие в Telegram: отправлено, пропущено правок стрима, повторов после flood wait",
+                 lambda: {('sent',): outbound_dispatcher.sent, ('dropped',): outbound_dispatcher.dropped,
+                          ('retried',): outbound_dispatcher.retries},
+                 labels=("result",), kind="counter")
+metrics.callback("bot_llm_concurrency", "Планировщик Groq: текущий лимит и занятые слоты",
+                 lambda: {('limit',): llm_client.scheduler.limit, ('active',): llm_client.scheduler.active} if llm_client else {},
+                 labels=("kind",))
+metrics.callback("bot_llm_model_circuit_open", "Модель выключена автоматом: 1 — open, 0.5 — half_open (проба), 0 — closed",
+                 lambda: {(model,): {'closed': 0.0, 'half_open': 0.5, 'open': 1.0}[health.state]
+                          for model, health in llm_client.router.models.items()} if llm_client else {},
+                 labels=("model",))
+metrics.callback("bot_llm_hedge_rejected_total", "Хеджи, не отправленные из-за бюджета или нагрузки",
+                 lambda: llm_client.hedges.rejected if llm_client else 0, kind="counter")
+metrics.callback("bot_llm_model_errors", "Отказы модели в скользящем окне маршрутизатора",
+                 lambda: {(model,): health.stats()['errors'] for model, health in llm_client.router.models.items()} if llm_client else {},
+                 labels=("model",))
+
+def build_web_app(webhook_path: str = "/") -> web.Application:
+    app = web.Application()
+    app.add_routes([
+        web.post(webhook_path, telegram_webhook_handler),
+        web.get("/queue", ops_endpoint(queue_stats_handler)),
+        web.get("/metrics", ops_endpoint(metrics_handler)),
+    ])
+    return app
+
+async def start_services(application: Application):
+    await application.initialize()
+    rate_limiter.start()
+    conversation_memory.start()
+    if ai_disk_cache and AI_CACHE_WARM_FILE:
+        try:
+            warmed = await asyncio.to_thread(ai_disk_cache.warm_from_file, AI_CACHE_WARM_FILE)
+            logger.info(f"{BOT_VERSION} - L2-кэш прогрет из {AI_CACHE_WARM_FILE}: {warmed} записей")
+        except Exception as e:
+            logger.error(f"{BOT_VERSION} - Не удалось прогреть L2-кэш из {AI_CACHE_WARM_FILE}: {e}")
+    state_manager.start()
+    if webhook_capture:
+        webhook_capture.start()
+    update_queue.start()
+    logger.info(f"{BOT_VERSION} - Очередь апдейтов: {UPDATE_QUEUE_WORKERS} воркеров, глубина {UPDATE_QUEUE_MAX_DEPTH}")
+
+async def stop_services(application: Application):
+    await rate_limiter.stop()
+    await update_queue.stop()
+    await conversation_memory.stop()
+    await background_jobs.stop()
+    if webhook_capture:
+        await webhook_capture.stop()
+    await state_manager.stop()
+    if llm_client:
+        await llm_client.close()
+    await application.shutdown()
+
 async def init_webhook_and_start_server(application: Application):
     if not os.environ.get('PORT') or not WEBHOOK_URL:
         logger.error("❌ Недостаточно переменных окружения (PORT или WEBHOOK_URL) для Webhook.")
@@ -1355,7 +4533,7 @@ async def init_webhook_and_start_server(application: Application):
     full_webhook_url = f"{WEBHOOK_URL}{webhook_path}"
     async with httpx.AsyncClient() as client:
         response = await client.post(
-            f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/setWebhook",
+            f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/setWebhook",
             json={"url": full_webhook_url}
         )
         if response.status_code == 200 and response.json().get('ok'):
@@ -1363,15 +4541,17 @@ async def init_webhook_and_start_server(application: Application):
         else:
             logger.error(f"{BOT_VERSION} - ❌ Ошибка установки Webhook: {response.text}")
             return
-    app = web.Application()
-    app.add_routes([web.post(webhook_path, telegram_webhook_handler)])
+    app = build_web_app(webhook_path)
     app_runner = web.AppRunner(app)
     await app_runner.setup()
     site = web.TCPSite(app_runner, '0.0.0.0', PORT)
     logger.info(f"{BOT_VERSION} - 🚀 AIOHTTP Server запущен на порту {PORT}")
-    await application.initialize()
+    await start_services(application)
     await site.start()
-    await asyncio.Future() 
+    try:
+        await asyncio.Future()
+    finally:
+        await stop_services(application)
 
 if __name__ == '__main__':
     if TELEGRAM_TOKEN and os.environ.get('PORT') and application:
@@ -0,0 +1,176 @@
+# Воспроизведение записанного webhook-трафика (WEBHOOK_CAPTURE_PATH) с исходными интервалами.
+#   python replay.py captures/updates.jsonl.gz --local                  # в локальный стек с фейковыми Bot API и Groq
+#   python replay.py captures/updates.jsonl.gz --local --speed 10       # в 10 раз быстрее оригинала
+#   python replay.py captures/updates.jsonl.gz --speed 0 --url http://127.0.0.1:10000/   # без пауз, в запущенный бот
+# Ротированные файлы (updates.jsonl.gz.N) подхватываются автоматически, от старых к новым.
+import argparse
+import asyncio
+import glob
+import gzip
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+from loadtest import add_stack_arguments, percentile, start_stack, stop_stack
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных апдейтов Telegram")
+    parser.add_argument("capture", nargs="+", help="файлы захвата; для базового пути добавляются его ротации")
+    parser.add_argument("--speed", type=float, default=1.0, help="множитель скорости; 0 — максимально быстро")
+    parser.add_argument("--url", default="http://127.0.0.1:10000/", help="webhook бота, если не --local")
+    parser.add_argument("--local", action="store_true", help="поднять бота в процессе с фейковыми Bot API и Groq")
+    parser.add_argument("--max-inflight", type=int, default=500, help="одновременных запросов к webhook")
+    parser.add_argument("--limit", type=int, default=0, help="воспроизвести только первые N апдейтов")
+    parser.add_argument("--no-rate-limits", action="store_true", help="(--local) снять пользовательские лимиты")
+    parser.add_argument("--drain-timeout", type=float, default=120.0, help="(--local) ждать разбора очереди, с")
+    parser.add_argument("--json", help="сохранить результат в JSON")
+    add_stack_arguments(parser)
+    return parser.parse_args()
+
+def capture_files(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        rotated = [p for p in glob.glob(f"{glob.escape(path)}.*") if p.rsplit(".", 1)[1].isdigit()]
+        # .5 старше .1, а базовый файл — самый свежий
+        rotated.sort(key=lambda p: int(p.rsplit(".", 1)[1]), reverse=True)
+        files.extend(rotated)
+        if os.path.exists(path):
+            files.append(path)
+    return files
+
+def read_capture(files: List[str]) -> Iterator[Tuple[float, Dict[str, Any]]]:
+    for path in files:
+        opener = gzip.open if path.endswith(".gz") or ".gz." in path else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record["t"], record["u"]
+
+class Replayer:
+    def __init__(self, url: str, speed: float, max_inflight: int):
+        self.url = url
+        self.speed = speed
+        self.semaphore = asyncio.Semaphore(max_inflight)
+        self.statuses: Dict[str, int] = {}
+        self.latencies: List[float] = []
+        self.lags: List[float] = []
+        self.sent = 0
+        self.started = 0.0
+    async def post(self, session: ClientSession, update: Dict[str, Any]):
+        started = time.monotonic()
+        try:
+            async with session.post(self.url, json=update) as response:
+                status = str(response.status)
+        except Exception as e:
+            status = type(e).__name__
+        finally:
+            self.semaphore.release()
+        self.latencies.append(time.monotonic() - started)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+    async def run(self, records: Iterator[Tuple[float, Dict[str, Any]]], limit: int = 0):
+        tasks = set()
+        first_t: Optional[float] = None
+        last_t: Optional[float] = None
+        started = self.started = time.monotonic()
+        timeout = ClientTimeout(total=60)
+        async with ClientSession(connector=TCPConnector(limit=0), timeout=timeout) as session:
+            for arrived, update in records:
+                if limit and self.sent >= limit:
+                    break
+                if first_t is None:
+                    first_t = arrived
+                if self.speed > 0:
+                    # Расписание считаем от начала, а не от предыдущего апдейта — задержки не накапливаются
+                    due = started + (arrived - first_t) / self.speed
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    self.lags.append(max(0.0, time.monotonic() - due))
+                await self.semaphore.acquire()
+                task = asyncio.create_task(self.post(session, update))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                self.sent += 1
+                last_t = arrived
+            await asyncio.gather(*tasks)
+        return time.monotonic() - started, (last_t - first_t if first_t is not None else 0.0)
+
+async def main_async(args) -> Dict[str, Any]:
+    files = capture_files(args.capture)
+    if not files:
+        raise SystemExit(f"Файлы захвата не найдены: {', '.join(args.capture)}")
+    stack = None
+    url = args.url
+    if args.local:
+        stack = await start_stack(args)
+        url = stack.webhook_url
+    records = read_capture(files)
+    if stack and args.no_rate_limits:
+        records = lift_rate_limits(stack.bot, records)
+    replayer = Replayer(url, args.speed, args.max_inflight)
+    elapsed, original_span = await replayer.run(records, args.limit)
+    result = {
+        "files": files,
+        "updates": replayer.sent,
+        "speed": args.speed,
+        "original_span_seconds": original_span,
+        "elapsed_seconds": elapsed,
+        "updates_per_second": replayer.sent / elapsed if elapsed else 0.0,
+        "statuses": replayer.statuses,
+        "webhook_latency": {q: percentile(replayer.latencies, q) for q in (50, 95, 99)},
+        "schedule_lag": {q: percentile(replayer.lags, q) for q in (50, 95, 99)},
+    }
+    if stack:
+        # Webhook отвечает сразу; ждём, пока воркеры разберут очередь, чтобы учесть полное время обработки
+        deadline = time.monotonic() + args.drain_timeout
+        queue = stack.bot.update_queue
+        while (queue.depth or queue.in_progress) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        result["drained_seconds"] = time.monotonic() - replayer.started
+        result["bot"] = {
+            "queue": queue.stats(),
+            "ai_cache": stack.bot.ai_cache.stats(),
+            "scheduler": stack.bot.llm_client.scheduler.stats(),
+        }
+        result["telegram_calls"] = stack.api.methods
+        result["groq_requests"] = stack.groq.requests
+        await stop_stack(stack)
+    return result
+
+def lift_rate_limits(bot, records):
+    for arrived, update in records:
+        for part in update.values():
+            if isinstance(part, dict) and isinstance(part.get("from"), dict):
+                bot.PREMIUM_USER_IDS.add(part["from"].get("id"))
+        yield arrived, update
+
+def main():
+    args = parse_args()
+    result = asyncio.run(main_async(args))
+    speed = "максимальной скорости" if args.speed <= 0 else f"скорости {args.speed:g}×"
+    print(f"\nВоспроизведено {result['updates']} апдейтов из {len(result['files'])} файлов на {speed}")
+    print(f"Исходный интервал: {result['original_span_seconds']:.1f} с, воспроизведение: {result['elapsed_seconds']:.1f} с "
+          f"({result['updates_per_second']:.1f} апдейтов/с)")
+    print(f"Ответы webhook: {result['statuses']}")
+    latency = result["webhook_latency"]
+    print(f"Задержка webhook p50/p95/p99: {latency[50]:.4f} / {latency[95]:.4f} / {latency[99]:.4f} с")
+    if args.speed > 0:
+        lag = result["schedule_lag"]
+        print(f"Отставание от расписания p50/p95/p99: {lag[50]:.4f} / {lag[95]:.4f} / {lag[99]:.4f} с")
+    if "bot" in result:
+        print(f"Очередь разобрана за {result['drained_seconds']:.1f} с от начала: {result['bot']['queue']}")
+        print(f"Кэш AI: {result['bot']['ai_cache']}")
+        print(f"Планировщик: {result['bot']['scheduler']}")
+        print(f"Вызовы Bot API: {result['telegram_calls']}, запросов к Groq: {result['groq_requests']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())